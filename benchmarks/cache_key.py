@@ -0,0 +1,104 @@
+"""
+Cache key derivation microbenchmark: the original key (json.dumps + MD5 per argument, model attributes concatenated
+in front) against the current versioned BLAKE2b key with the str fast path.
+
+Run with:
+  PYTHONPATH=. python benchmarks/cache_key.py
+  PYTHONPATH=. python benchmarks/cache_key.py --sizes 2000 20000 --calls 2000
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import string
+import time
+from typing import Callable, List
+
+from src.utils.redis_cache import RedisCache
+
+
+class FakeModel:
+    engine = 'gpt-4'
+    num_samples = 1
+    log_probs = 1
+    echo = False
+    temperature = 0.0
+    top_p = 1.0
+    stop_token = None
+    max_tokens = 500
+
+    def inference(self, prompt: str, *args, **kwargs):
+        pass
+
+
+PREPENDED_KEY_ATTR = 'engine,num_samples,log_probs,echo,temperature=float(0),top_p=float(1.0),stop_token,max_tokens'
+
+
+def legacy_key(f, *args, **kwargs) -> str:
+    """The key as RedisCache built it before (without the sample counter suffix)."""
+    def make_hash(o):
+        return hashlib.md5(json.dumps(o, sort_keys=True).encode()).hexdigest()
+
+    s = f.__qualname__
+    if len(args) > 1:
+        for arg in args[1:]:
+            s += "_{0}".format(make_hash(arg))
+    elif len(args) == 1:
+        s += "_{0}".format(make_hash(args[0]))
+    for k in sorted(kwargs.keys()):
+        s += "_{0}={1}".format(k, make_hash(kwargs[k]))
+
+    prepended_str = ''
+    for attr in PREPENDED_KEY_ATTR.split(','):
+        if '=' in attr:
+            name, val = attr.split('=')
+            value = getattr(args[0], name)
+            prepended_str += f'{str(value)}'
+            value != eval(val)
+        else:
+            prepended_str += f'{str(getattr(args[0], attr))}'
+    return f'{prepended_str}{s}'
+
+
+def time_calls(fn: Callable[[], str], calls: int) -> float:
+    """Mean microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def random_prompt(size: int) -> str:
+    # Tax case prompts are mostly plain text with some quotes/newlines that json has to escape.
+    alphabet = string.ascii_letters + ' ' * 12 + '\n"\\.,;:§äöü'
+    return ''.join(random.choice(alphabet) for _ in range(size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cache key derivation')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 20000], help='Prompt sizes in characters')
+    parser.add_argument('--calls', type=int, default=5000, help='Keys derived per measurement')
+    args = parser.parse_args()
+
+    random.seed(0)
+    cache = RedisCache(disabled=True)
+    model = FakeModel()
+    f = FakeModel.inference
+    key_attrs = cache.parse_key_attrs(PREPENDED_KEY_ATTR)
+
+    rows: List[str] = [f'{"prompt chars":>12} {"legacy us":>10} {"v2 us":>10} {"speedup":>8}']
+    for size in args.sizes:
+        prompt = random_prompt(size)
+        kwargs = {'system_prompt': 'You are a helpful assistant that will answer the questions given by the user.'}
+
+        legacy = time_calls(lambda: legacy_key(f, model, prompt, **kwargs), args.calls)
+        current = time_calls(lambda: cache._cache_key(f.__qualname__, key_attrs, model, prompt, **kwargs), args.calls)
+        rows.append(f'{size:>12} {legacy:>10.1f} {current:>10.1f} {legacy / current:>7.1f}x')
+
+    print('\n'.join(rows))
+    print(f'\nexample v2 key: {cache._cache_key(f.__qualname__, key_attrs, model, "prompt")}')
+
+
+if __name__ == "__main__":
+    main()
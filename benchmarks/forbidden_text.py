@@ -0,0 +1,109 @@
+"""
+ForbiddenTextValidator throughput on synthetic deductions: the original per word loop (lowercasing every fact again for
+every word) against the shared WordMatcher check, with a word list the size create_validators uses.
+
+Run with:
+  PYTHONPATH=. python benchmarks/forbidden_text.py
+  PYTHONPATH=. python benchmarks/forbidden_text.py --deductions 20000 --words 60
+"""
+
+import argparse
+import random
+import string
+import time
+from typing import List, Tuple, Union
+
+from src.logic_tree.tree import LogicNode
+from src.validators.types.forbidden_text_validator import ForbiddenTextValidator
+
+
+def legacy_validate(
+        forbidden_words: List[Union[Tuple[str, str], str]],
+        template: LogicNode,
+        explicit_facts: List[str],
+        commonsense_facts: List[str]
+) -> bool:
+    """ForbiddenTextValidator.validate as it was before WordMatcher."""
+    for word in forbidden_words:
+        if isinstance(word, str):
+            forbidden_word = word
+        else:
+            conditional_text = word[0]
+            forbidden_word = word[1]
+
+            check_validity = False
+
+            p = template
+            while p is not None:
+                if conditional_text.lower() in p.value.lower():
+                    check_validity = True
+                    break
+                p = p.parent
+
+            if not check_validity:
+                continue
+        if any([forbidden_word.lower() in x.lower() for x in explicit_facts]) or any([forbidden_word.lower() in x.lower() for x in commonsense_facts]):
+            return False
+    return True
+
+
+def random_words(n: int, rng: random.Random) -> List[str]:
+    return [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12))) for _ in range(n)]
+
+
+def random_fact(vocabulary: List[str], rng: random.Random) -> str:
+    return ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(12, 30))).capitalize() + '.'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ForbiddenTextValidator')
+    parser.add_argument('--deductions', type=int, default=100000, help='Synthetic deductions to validate')
+    parser.add_argument('--words', type=int, default=32, help='Forbidden words per validator')
+    parser.add_argument('--conditional', type=int, default=8, help='How many of them are conditional')
+    parser.add_argument('--hit-rate', type=float, default=0.1, help='Share of deductions containing a forbidden word')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    vocabulary = random_words(2000, rng)
+    words = random_words(args.words, rng)
+    conditions = random_words(3, rng)
+    forbidden_words = words[:args.words - args.conditional] + [
+        [rng.choice(conditions), w] for w in words[args.words - args.conditional:]
+    ]
+
+    root = LogicNode(f'The case: {conditions[0]} and {random_fact(vocabulary, rng)}')
+    template = LogicNode(random_fact(vocabulary, rng))
+    root.children = [template]
+    template.parent = root
+
+    deductions = []
+    for _ in range(args.deductions):
+        explicit = [random_fact(vocabulary, rng) for _ in range(2)]
+        commonsense = [random_fact(vocabulary, rng)]
+        if rng.random() < args.hit_rate:
+            explicit[0] += f' {rng.choice(words).upper()}'
+        deductions.append((explicit, commonsense))
+
+    validator = ForbiddenTextValidator(forbidden_words)
+
+    start = time.perf_counter()
+    legacy = [legacy_validate(validator.forbidden_words, template, e, c) for e, c in deductions]
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matched = [validator.validate(template, e, c, '') for e, c in deductions]
+    matched_s = time.perf_counter() - start
+
+    if legacy != matched:
+        mismatches = sum(a != b for a, b in zip(legacy, matched))
+        raise SystemExit(f'Matcher disagrees with the legacy loop on {mismatches} deductions')
+
+    print(f'{args.deductions} deductions, {args.words} forbidden words ({args.conditional} conditional), '
+          f'{legacy.count(False)} rejected')
+    print(f'{"legacy loop":<16} {legacy_s:>8.2f} s {args.deductions / legacy_s:>12,.0f} deductions/s')
+    print(f'{"matcher":<16} {matched_s:>8.2f} s {args.deductions / matched_s:>12,.0f} deductions/s')
+    print(f'speedup {legacy_s / matched_s:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Import-time budget for the generation and eval entry points, measured with `python -X importtime`.
+
+Each entry point is imported in a fresh interpreter, the cumulative time of its top level imports is summed (minus a
+bare interpreter baseline) and compared against a budget.  Some modules must never be pulled in by these entry points
+at all: transformers and torch are only needed once an HF model is actually used, redis once the cache is enabled.
+
+Run with:
+  PYTHONPATH=. python benchmarks/import_time.py
+  PYTHONPATH=. python benchmarks/import_time.py --budget src.model=80 --repeat 5
+
+Exits with a non-zero status if any entry point is over budget or imports a forbidden module.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+from src.utils.paths import ROOT_FOLDER
+
+
+# Entry point module -> budget in milliseconds.
+DEFAULT_BUDGETS_MS: Dict[str, float] = {
+    'src.model': 100,
+    'src.model.openai': 120,
+    'eval.eval': 400,
+    'src.crews.runner': 6000,
+}
+
+FORBIDDEN_MODULES: Tuple[str, ...] = ('transformers', 'torch', 'redis')
+
+
+def measure_import(module: str) -> Tuple[float, List[str]]:
+    """
+    Import module in a fresh interpreter with -X importtime.
+
+    :param module: Dotted module path to import.
+    :return: (cumulative import time in ms of all top level imports, list of every imported module name)
+    """
+    env = {**os.environ, 'PYTHONPATH': str(ROOT_FOLDER)}
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}' if module else 'pass'],
+        cwd=str(ROOT_FOLDER),
+        env=env,
+        capture_output=True,
+        text=True
+    )
+    if proc.returncode != 0:
+        error = '\n'.join(x for x in proc.stderr.splitlines() if not x.startswith('import time:'))
+        raise RuntimeError(f'Importing {module} failed:\n{error}')
+
+    total_us = 0
+    imported = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|', 2)
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        imported.append(name.strip())
+        # Nested imports are indented, only count the top level ones (their cumulative time includes the children).
+        if not name[1:].startswith(' '):
+            total_us += int(cumulative.strip())
+    return total_us / 1000, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check import time budgets of the entry points')
+    parser.add_argument('--budget', action='append', default=[], help='Override a budget, e.g. src.model=150 (ms)')
+    parser.add_argument('--repeat', type=int, default=3, help='Take the best of N runs per module')
+    args = parser.parse_args()
+
+    budgets = dict(DEFAULT_BUDGETS_MS)
+    for b in args.budget:
+        module, ms = b.split('=')
+        budgets[module] = float(ms)
+
+    baseline = min(measure_import('')[0] for _ in range(args.repeat))
+
+    failed = False
+    print(f'{"entry point":<24} {"import ms":>10} {"budget ms":>10}  status')
+    for module, budget in budgets.items():
+        try:
+            runs = [measure_import(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f'{module:<24} {"-":>10} {budget:>10.0f}  ERROR')
+            print(e)
+            failed = True
+            continue
+
+        ms = max(0.0, min(r[0] for r in runs) - baseline)
+        imported = set(runs[0][1])
+        forbidden = [m for m in FORBIDDEN_MODULES if m in imported]
+
+        status = 'ok'
+        if forbidden:
+            status = f'FORBIDDEN IMPORT ({", ".join(forbidden)})'
+        elif ms > budget:
+            status = 'OVER BUDGET'
+        failed = failed or status != 'ok'
+
+        print(f'{module:<24} {ms:>10.1f} {budget:>10.0f}  {status}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+NearDuplicateValidator lookups on synthetic facts: the FactIndex LSH query against comparing a new fact's shingles with
+every indexed fact, and whether both find the same near-duplicates.
+
+Run with:
+  PYTHONPATH=. python benchmarks/near_duplicate.py
+  PYTHONPATH=. python benchmarks/near_duplicate.py --indexed 20000 --queries 50 --duplicate-rate 0.5
+"""
+
+import argparse
+import random
+import string
+import time
+from typing import List, Optional
+
+from src.validators.types.near_duplicate_validator import FactIndex
+
+
+def random_words(n: int, rng: random.Random) -> List[str]:
+    return [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10))) for _ in range(n)]
+
+
+def random_fact(vocabulary: List[str], rng: random.Random) -> str:
+    return ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(12, 25))).capitalize() + '.'
+
+
+def brute_force(index: FactIndex, text: str) -> Optional[str]:
+    shingles = index.shingles(text)
+    best = None
+    for fact, other in zip(index.facts, index.shingle_sets):
+        similarity = FactIndex.jaccard(shingles, other)
+        if similarity >= index.threshold and (best is None or similarity > best[1]):
+            best = (fact, similarity)
+    return best[0] if best else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the near-duplicate fact index')
+    parser.add_argument('--indexed', type=int, default=5000, help='Facts in the index')
+    parser.add_argument('--queries', type=int, default=200, help='Facts looked up')
+    parser.add_argument('--duplicate-rate', type=float, default=0.2, help='Share of queries that are edited copies')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    vocabulary = random_words(3000, rng)
+    index = FactIndex()
+    facts = [random_fact(vocabulary, rng) for _ in range(args.indexed)]
+    start = time.perf_counter()
+    index.add_many(facts)
+    add_s = time.perf_counter() - start
+
+    queries = []
+    for _ in range(args.queries):
+        if rng.random() < args.duplicate_rate:
+            words = rng.choice(facts).split()
+            words[rng.randrange(len(words))] = rng.choice(vocabulary)
+            queries.append(' '.join(words))
+        else:
+            queries.append(random_fact(vocabulary, rng))
+
+    start = time.perf_counter()
+    expected = [brute_force(index, q) for q in queries]
+    brute_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found = [index.query(q) for q in queries]
+    lsh_s = time.perf_counter() - start
+
+    duplicates = sum(e is not None for e in expected)
+    missed = sum(e is not None and f is None for e, f in zip(expected, found))
+    print(f'{args.indexed} indexed facts ({add_s / args.indexed * 1e6:.0f} us per add), {args.queries} queries, '
+          f'{duplicates} near-duplicates, {missed} missed by LSH')
+    print(f'{"brute force":<16} {brute_s / args.queries * 1e6:>10.0f} us per query')
+    print(f'{"lsh index":<16} {lsh_s / args.queries * 1e6:>10.0f} us per query')
+    print(f'speedup {brute_s / lsh_s:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,8 @@ import sys
 from pathlib import Path
 import random
 from tqdm import tqdm
-from transformers import AutoTokenizer
-import transformers
-from transformers import AutoModelForCausalLM, AutoTokenizer
 import collections
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Add project root to Python path for imports
@@ -18,8 +16,8 @@ load_dotenv()
 
 random.seed(0)
 
-from src import cache
-from src.model import OpenAIModel, HFModel
+from src import cache, telemetry
+from src.model import OpenAIModel, HFModel, CircuitOpenError, ModelAPIError, ModelRouter, RouteStep
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.madlib.madlib import Madlib
 from src.utils.paths import OUTPUT_FOLDER
@@ -36,6 +34,61 @@ from team_allocation_solved_ex import team_allocation_solved_ex
 from german_tax_solved_ex import german_tax_solved_ex
 
 
+def build_example_str(d, a):
+    """The (optional) solved ICL example every prompt of a dataset (d) under an ablation (a) starts with."""
+    if a.get('use_example') and d.get('ex'):
+        return 'Here is an example of solving the task:\n\n' + d.get('ex') + '\n\nThis is the end of the example. The real task is below.\n\n---\n\n'
+    return ''
+
+
+def build_prompt(d, a, context, question, choices):
+    """Builds the prompt for one question of a dataset (d) under an ablation (a), None if the ablation is skipped."""
+    ex_str = build_example_str(d, a)
+
+    prompt_style = a.get('prompt')
+    if prompt_style == 'regular':
+        prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
+    elif prompt_style == 'cot':
+        prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
+    elif prompt_style == 'cot+':
+        if d.get("hint_before_question"):
+            prompt = f'{ex_str}{context}\n\n{d["hint"]}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
+        else:
+            prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. {d["hint"]} Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
+    else:
+        if len(question["intermediate_trees"]) == 0 or d.get('skip_ablated'):
+            return None
+
+        prompt = f'{ex_str}Answer the following questions given the list of facts per answer choice.\n\n'
+        for c, t in zip(choices.split('\n'), question['intermediate_trees']):
+            facts = list(set([x.value for x in LogicTree.from_json(t).get_facts(include_cs=a.get('include_cs', False), include_deductions_past_level=-1, no_facts_after_depth=a.get('no_facts_after_depth', 3) + d.get('ablation_depth_modifier', 0))]))
+            facts = list(sorted(facts)) if d.get('allow_sorted_facts', True) else facts
+            facts_str = "\n".join([f'- {x}' for x in facts])
+            prompt += f'Facts for Choice {c}:\n{facts_str}\n\n'
+        prompt += f'Given the list of facts per answer choice answer the following question\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick on option.  After you have found the answer, say it in this format "ANSWER: (your answer here, include the choice number)"'
+
+    return prompt
+
+
+def apply_system_prompt_template(prompt, d, model_info):
+    """Local models get the system prompt baked into the prompt through the model's template."""
+    if d.get("system_prompt") and model_info.get("system_prompt_template"):
+        return model_info.get("system_prompt_template").replace("{system_prompt}", d.get('system_prompt')).replace("{prompt}", prompt)
+    return prompt
+
+
+def static_prompt_prefix(d, a, model_info):
+    """
+    Text shared by every prompt of a dataset (d) under an ablation (a) for a local model: the templated system prompt
+    and the ICL example.  The hint comes after the per-example context, so it can't be part of it.
+    """
+    prefix = build_example_str(d, a)
+    if d.get("system_prompt") and model_info.get("system_prompt_template"):
+        template = model_info.get("system_prompt_template")
+        prefix = template.split("{prompt}")[0].replace("{system_prompt}", d.get('system_prompt')) + prefix
+    return prefix
+
+
 def main():
     """
     This script will run a bunch of models over the datasets created in MuSR.  Furthermore, it can test different
@@ -44,12 +97,19 @@ def main():
     There are also a ton of parameters you can set to control the eval and visualize intermediate answers etc.
     """
 
-    # CACHE
+    # CACHE (a fixed namespace, eval answers are reused across runs and never dropped by generation runs)
     cache.enable()
+    cache.use_namespace('eval')
+
+    # TELEMETRY (per call latency/tokens/cost/cache hits, sinks from MUSR_TELEMETRY_JSONL / MUSR_TELEMETRY_PROM)
+    telemetry.configure_from_env()
 
     DATASETS_FOLDER = OUTPUT_FOLDER
 
-    gpt4 = OpenAIModel(engine='gpt-4', api_max_attempts=30, api_endpoint='chat', temperature=1.0, top_p=1.0, max_tokens=2400, num_samples=1, prompt_cost=0.03/1000, completion_cost=0.06/1000)
+    # The eval step of the routing policy (src/model/router.py) also collects the accuracy per model for its report.
+    router = ModelRouter()
+
+    gpt4 = router.model_for(RouteStep.EVAL)
     gpt3516k = OpenAIModel(engine='gpt-3.5-turbo-16k', api_endpoint='chat', api_max_attempts=30, temperature=1.0, max_tokens=2400, num_samples=1, prompt_cost=0.003/1000, completion_cost=0.004/1000)
     gpt35 = OpenAIModel(engine='gpt-3.5-turbo', api_endpoint='chat', api_max_attempts=30, temperature=1.0, max_tokens=700, num_samples=1, prompt_cost=0.0015/1000, completion_cost=0.002/1000)
 
@@ -107,6 +167,7 @@ def main():
 
     models_to_test = [
         {'model': gpt4},
+        # {'model': gpt4, 'prefetch_workers': 8},
         # {'model': gpt3516k},
         # {'model': gpt35},
         # {'model': HFModel('meta-llama/Llama-2-7b-hf', load_in_4bit=True), 'system_prompt_template': "{system_prompt}\n\n{prompt}"},
@@ -114,6 +175,7 @@ def main():
         # {'model': HFModel('meta-llama/Llama-2-13b-chat-hf', load_in_4bit=True), 'system_prompt_template': "<s>[INST] <<SYS>>\n{system_prompt}\n<</SYS>>\n{prompt}[/INST]"},
         # {'model': HFModel('meta-llama/Llama-2-70b-chat-hf', load_in_4bit=True), 'system_prompt_template': "<s>[INST] <<SYS>>\n{system_prompt}\n<</SYS>>\n{prompt}[/INST]"},
         # {'model': HFModel('lmsys/vicuna-7b-v1.5', load_in_4bit=True), 'system_prompt_template': "{system_prompt}\n\nUSER: {prompt}\nASSISTANT: "},
+        # {'model': HFModel('lmsys/vicuna-7b-v1.5', max_batch_size=8), 'system_prompt_template': "{system_prompt}\n\nUSER: {prompt}\nASSISTANT: ", 'dynamic_batching': True, 'batching_args': {'max_batch_tokens': 16384}},
         # {'model': HFModel('lmsys/vicuna-13b-v1.5', load_in_4bit=True), 'system_prompt_template': "{system_prompt}\n\nUSER: {prompt}\nASSISTANT: "},
         # {'model': HFModel('lmsys/vicuna-33b-v1.3', load_in_4bit=True), 'system_prompt_template': "{system_prompt}\n\nUSER: {prompt}\nASSISTANT: "},
     ]
@@ -148,6 +210,7 @@ def main():
                     m.total_cost = 0.0
 
                 ablation_name = a['name']
+                tags_token = telemetry.push_tags(dataset=d['name'], ablation=ablation_name)
 
                 total = 0
                 correct = 0
@@ -184,6 +247,42 @@ def main():
 
                     datasets[d['name']] = dataset
 
+                # Local models with dynamic batching get every prompt of this run up front, requested from a thread pool so
+                # the batcher can group them into real batches.
+                # Local models encode the shared prefix (system prompt + ICL example) once and reuse its kv cache.
+                if isinstance(m, HFModel) and model_info.get('prefix_cache', True) and not skip_inference:
+                    m.register_prefix(static_prompt_prefix(d, a, model_info))
+
+                prefetched = {}
+                if isinstance(m, HFModel) and model_info.get('dynamic_batching') and not skip_inference:
+                    m.enable_dynamic_batching(**model_info.get('batching_args', {}))
+                    prompts = []
+                    for example in dataset:
+                        for question in example['questions']:
+                            choices = "\n".join([f'{idx + 1} - {x}' for idx, x in enumerate(question["choices"])])
+                            prompt = build_prompt(d, a, example['context'], question, choices)
+                            if prompt is not None:
+                                prompts.append(apply_system_prompt_template(prompt, d, model_info))
+                    prompts = list(dict.fromkeys(prompts))
+                    with ThreadPoolExecutor(max_workers=max(1, m.max_batch_size * 2)) as executor:
+                        prefetched = dict(zip(prompts, executor.map(m.inference, prompts)))
+
+                # Api models with prefetch_workers resolve every prompt of this run up front: cached answers come back in
+                # one MGET, the rest is requested from a thread pool and written back in one pipeline.  Prompts are listed
+                # in the order the loop below asks for them (self consistency samples included) so sample keys line up.
+                if isinstance(m, OpenAIModel) and model_info.get('prefetch_workers') and not skip_inference:
+                    prompts = []
+                    for example in dataset:
+                        for question in example['questions']:
+                            choices = "\n".join([f'{idx + 1} - {x}' for idx, x in enumerate(question["choices"])])
+                            prompt = build_prompt(d, a, example['context'], question, choices)
+                            if prompt is not None:
+                                prompts.extend([prompt] * self_consistency_n)
+                    calls = [((m, prompt), {'system_prompt': d.get("system_prompt")}) for prompt in prompts]
+                    outputs = OpenAIModel.inference.call_many(calls, max_workers=model_info['prefetch_workers'], return_exceptions=True)
+                    for prompt, output in zip(prompts, outputs):
+                        prefetched.setdefault(prompt, []).append(output)
+
                 pbar = tqdm(enumerate(dataset), total=len(dataset), desc=f'RUNNING | {model_name} | {d["name"]} | {ablation_name} | {correct} / {total} | (run cost = {run_cost:.2f}, iteration cost = {total_cost:.2f})', disable=not progress_bar)
 
                 for eidx, example in pbar:
@@ -202,31 +301,9 @@ def main():
 
                         for scidx in range(self_consistency_n):
 
-                            ex_str = ''
-                            if a.get('use_example') and d.get('ex'):
-                                ex_str = 'Here is an example of solving the task:\n\n' + d.get('ex') + '\n\nThis is the end of the example. The real task is below.\n\n---\n\n'
-
-                            prompt_style = a.get('prompt')
-                            if prompt_style == 'regular':
-                                prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
-                            elif prompt_style == 'cot':
-                                prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
-                            elif prompt_style == 'cot+':
-                                if d.get("hint_before_question"):
-                                    prompt = f'{ex_str}{context}\n\n{d["hint"]}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
-                                else:
-                                    prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. {d["hint"]} Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
-                            else:
-                                if len(question["intermediate_trees"]) == 0 or d.get('skip_ablated'):
-                                    continue
-
-                                prompt = f'{ex_str}Answer the following questions given the list of facts per answer choice.\n\n'
-                                for c, t in zip(choices.split('\n'), question['intermediate_trees']):
-                                    facts = list(set([x.value for x in LogicTree.from_json(t).get_facts(include_cs=a.get('include_cs', False), include_deductions_past_level=-1, no_facts_after_depth=a.get('no_facts_after_depth', 3) + d.get('ablation_depth_modifier', 0))]))
-                                    facts = list(sorted(facts)) if d.get('allow_sorted_facts', True) else facts
-                                    facts_str = "\n".join([f'- {x}' for x in facts])
-                                    prompt += f'Facts for Choice {c}:\n{facts_str}\n\n'
-                                prompt += f'Given the list of facts per answer choice answer the following question\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick on option.  After you have found the answer, say it in this format "ANSWER: (your answer here, include the choice number)"'
+                            prompt = build_prompt(d, a, context, question, choices)
+                            if prompt is None:
+                                continue
 
                             if verbose:
                                 print(f'EX: {eidx +1}.{qidx +1}')
@@ -244,13 +321,27 @@ def main():
                                 continue
 
                             if isinstance(m, OpenAIModel):
-                                raw = m.inference(prompt, system_prompt=d.get("system_prompt"))
+                                try:
+                                    if prefetched.get(prompt):
+                                        raw = prefetched[prompt].pop(0)
+                                        if isinstance(raw, Exception):
+                                            raise raw
+                                    else:
+                                        raw = m.inference(prompt, system_prompt=d.get("system_prompt"))
+                                except CircuitOpenError:
+                                    # The api is down, stop instead of scoring the rest of the dataset on nothing.
+                                    raise
+                                except ModelAPIError as e:
+                                    print(f'ERROR: skipping EX {eidx + 1}.{qidx + 1}, the model call failed: {e}')
+                                    continue
                                 output = raw.choices[0].message.content
                             else:
-                                if d.get("system_prompt") and model_info.get("system_prompt_template"):
-                                    prompt = model_info.get("system_prompt_template").replace("{system_prompt}", d.get('system_prompt')).replace("{prompt}", prompt)
+                                prompt = apply_system_prompt_template(prompt, d, model_info)
 
-                                output = m.inference(prompt)
+                                if prompt in prefetched:
+                                    output = prefetched[prompt]
+                                else:
+                                    output = m.inference(prompt)
 
                             if verbose:
                                 print("MODEL OUTPUT")
@@ -306,6 +397,7 @@ def main():
                             continue
 
                         most_common = collections.Counter(answer_outs).most_common()[0][0]
+                        router.record(RouteStep.EVAL, model_name, passed=most_common == str(gold_answer))
                         if most_common == str(gold_answer):
                             correct += 1
                             answered_questions.append([x for x in raw_answers if x['correct']][0])
@@ -332,12 +424,22 @@ def main():
                 run_data[model_name] = model_data
 
                 print(f'RUNNING | {model_name} | {d["name"]} | {ablation_name} | {correct} / {total} | {(correct / max(1,total))*100:.1f}', flush=True)
+                telemetry.pop_tags(tags_token)
+
+                # The next dataset / ablation has its own prefix, drop this one's kv cache from the device.
+                if isinstance(m, HFModel):
+                    m.clear_prefixes()
 
                 if out_file:
                     json.dump(run_data, out_file.open('w'))
 
         if isinstance(m, HFModel):
+            m.disable_dynamic_batching()
             del m
 
+    print(telemetry.report())
+    print(router.report())
+    print(f'Cache tiers: {cache.stats()}')
+
 if __name__ == "__main__":
     main()
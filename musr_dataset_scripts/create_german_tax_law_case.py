@@ -8,12 +8,17 @@ Run with:
   # Advanced mode (with LLM-based validation - more accurate but expensive)
   PYTHONPATH=. python musr_dataset_scripts/create_german_tax_law_case.py --use-model-validator
 
+  # Stream tree expansions and stop each request once the 3 child lines are complete
+  PYTHONPATH=. python musr_dataset_scripts/create_german_tax_law_case.py --stream
+
 Make sure to set OPENAI_API_KEY in your .env file.
 """
 
 import argparse
 from dotenv import load_dotenv
 from src.crews.runner import run_single_german_tax_case
+from src.model.router import DEFAULT_OUTCOMES_PATH
+from src.validators.local_classifier import DEFAULT_MODEL_PATH
 
 # Load environment variables from .env file
 load_dotenv()
@@ -26,6 +31,66 @@ def main():
         action='store_true',
         help='Use LLM-based validation for element purity (more accurate but expensive)'
     )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Stream tree expansions and cancel them early once the node structure is filled (or clearly invalid)'
+    )
+    parser.add_argument(
+        '--reuse-cache',
+        action='store_true',
+        help='Replay cached model calls of the previous run instead of starting a fresh cache epoch'
+    )
+    parser.add_argument(
+        '--expand-workers',
+        type=int,
+        default=1,
+        help='Expand this many case trees at the same time (requires --stream)'
+    )
+    parser.add_argument(
+        '--validator-batch',
+        type=int,
+        default=1,
+        help='With --use-model-validator, ask up to this many deductions in one validator prompt'
+    )
+    parser.add_argument(
+        '--local-validator',
+        nargs='?',
+        const=str(DEFAULT_MODEL_PATH),
+        default=None,
+        help='With --use-model-validator, answer confident purity checks with the local classifier (default path: '
+             'the one python -m src.validators.local_classifier train writes)'
+    )
+    parser.add_argument(
+        '--dedupe-facts',
+        action='store_true',
+        help='Reject generated facts that nearly repeat an earlier fact of the run (siblings and the other case)'
+    )
+    parser.add_argument(
+        '--dedupe-dataset',
+        default=None,
+        help='Also reject near-duplicates of the facts in this dataset file (implies --dedupe-facts)'
+    )
+    parser.add_argument(
+        '--cheap-models',
+        action='store_true',
+        help='Route steps to cheaper engines once the saved router outcomes show they meet the step targets'
+    )
+    parser.add_argument(
+        '--explore-models',
+        action='store_true',
+        help='With --cheap-models, also start on cheaper engines that have too few saved outcomes yet'
+    )
+    parser.add_argument(
+        '--adaptive-max-tokens',
+        action='store_true',
+        help='Cap max_tokens of tree expansion and validation calls at the observed output lengths'
+    )
+    parser.add_argument(
+        '--router-outcomes',
+        default=str(DEFAULT_OUTCOMES_PATH),
+        help='Json file the router outcomes (pass rate, latency, cost per step and engine) are loaded from and saved to'
+    )
     args = parser.parse_args()
     
     print(f"Starting German tax case generation...")
@@ -34,7 +99,20 @@ def main():
     else:
         print("Using basic validators (Structure + Forbidden text)")
     
-    run_single_german_tax_case(use_model_validator=args.use_model_validator)
+    run_single_german_tax_case(
+        use_model_validator=args.use_model_validator,
+        use_streaming=args.stream,
+        fresh_cache=not args.reuse_cache,
+        expand_workers=args.expand_workers,
+        validator_batch=args.validator_batch,
+        local_validator_path=args.local_validator,
+        dedupe_facts=args.dedupe_facts,
+        dedupe_dataset=args.dedupe_dataset,
+        cheap_models=args.cheap_models,
+        explore_models=args.explore_models,
+        adaptive_max_tokens=args.adaptive_max_tokens,
+        router_outcomes_path=args.router_outcomes
+    )
 
 
 if __name__ == "__main__":
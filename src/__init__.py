@@ -1,3 +1,5 @@
 from src.utils.redis_cache import RedisCache
+from src.utils.telemetry import Telemetry
 
 cache = RedisCache(disabled=True)
+telemetry = Telemetry()
@@ -2,24 +2,27 @@
 CrewAI agent definitions for German tax case generation.
 """
 
+from functools import lru_cache
+
 from crewai import Agent
 from langchain_openai import ChatOpenAI
 
 from src.crews.prompts import TREE_AGENT_SYSTEM_PROMPT, STORY_AGENT_SYSTEM_PROMPT
 
 
-def create_tree_agent(model: str = "gpt-4", temperature: float = 1.0) -> Agent:
+def create_tree_agent(model: str = "gpt-4", temperature: float = 1.0, max_tokens: int = None) -> Agent:
     """
     Create the tree expansion agent responsible for generating child nodes.
     
     Args:
         model: OpenAI model name
         temperature: Sampling temperature
+        max_tokens: Cap on the completion length (provider default when None)
         
     Returns:
         CrewAI Agent configured for tree expansion
     """
-    llm = ChatOpenAI(model=model, temperature=temperature)
+    llm = ChatOpenAI(model=model, temperature=temperature, max_tokens=max_tokens)
     
     return Agent(
         role="German Tax Law Reasoning Tree Expander",
@@ -30,18 +33,19 @@ def create_tree_agent(model: str = "gpt-4", temperature: float = 1.0) -> Agent:
     )
 
 
-def create_story_agent(model: str = "gpt-4", temperature: float = 1.0) -> Agent:
+def create_story_agent(model: str = "gpt-4", temperature: float = 1.0, max_tokens: int = None) -> Agent:
     """
     Create the story generation agent responsible for writing court decision sections.
     
     Args:
         model: OpenAI model name
         temperature: Sampling temperature
+        max_tokens: Cap on the completion length (provider default when None)
         
     Returns:
         CrewAI Agent configured for story generation
     """
-    llm = ChatOpenAI(model=model, temperature=temperature)
+    llm = ChatOpenAI(model=model, temperature=temperature, max_tokens=max_tokens)
     
     return Agent(
         role="German Tax Court Document Writer",
@@ -51,3 +55,15 @@ def create_story_agent(model: str = "gpt-4", temperature: float = 1.0) -> Agent:
         verbose=True
     )
 
+
+
+@lru_cache(maxsize=None)
+def get_tree_agent(model: str = "gpt-4", temperature: float = 1.0, max_tokens: int = None) -> Agent:
+    """Tree expansion agent shared per (model, temperature, max_tokens), used when the model is picked per attempt by a router."""
+    return create_tree_agent(model=model, temperature=temperature, max_tokens=max_tokens)
+
+
+@lru_cache(maxsize=None)
+def get_story_agent(model: str = "gpt-4", temperature: float = 1.0, max_tokens: int = None) -> Agent:
+    """Story agent shared per (model, temperature, max_tokens)."""
+    return create_story_agent(model=model, temperature=temperature, max_tokens=max_tokens)
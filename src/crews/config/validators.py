@@ -0,0 +1,75 @@
+"""
+Validator sets for tree expansion, per level (l1_l2 / l2_l3) and element (law / econ / proc).
+
+shared_validators in src/crews/tasks.py builds the forbidden text validators once per level and element and shares
+them across nodes, cases and worker threads (the model validators are built per node, with the case description).
+The word lists are keys into the shared WordMatcher cache, so each list is compiled once per process.
+"""
+
+# Conclusive words, level-specific intensity.
+CONCLUSIVE_WORDS = {
+    # L1→L2: Strong constraints (prevent obvious conclusions)
+    'l1_l2': (
+        # Direct conclusions about element status (always forbidden at L1→L2)
+        'sufficient', 'insufficient', 'compliant', 'non-compliant', 'deficient',
+        'adequate', 'inadequate', 'appropriate', 'inappropriate',
+        'satisfactory', 'unsatisfactory',
+
+        # Strong conclusive adverbs
+        'independently', 'entirely', 'completely', 'fully', 'clearly', 'obviously',
+        'evidently', 'effectively', 'actively', 'substantially',
+        'significantly', 'materially', 'extensively', 'comprehensively',
+
+        # Strong conclusive adjectives
+        'robust', 'substantial', 'significant',
+
+        # Judgment verbs
+        'properly', 'improperly', 'prove', 'confirm', 'validate', 'verify',
+    ),
+    # L2→L3: Weaker constraints (allow concrete factual descriptions)
+    'l2_l3': (
+        # Only block the most direct conclusions at leaf level
+        'sufficient', 'insufficient', 'compliant', 'non-compliant', 'deficient',
+        'adequate', 'inadequate', 'appropriate', 'inappropriate',
+        'satisfactory', 'unsatisfactory',
+        'obviously', 'clearly', 'evidently', 'successfully', 'comprehensive', 'positive', 'negative',
+    ),
+}
+
+CONCLUSIVE_REASON = (
+    "these words make the conclusion too obvious and reduce reasoning difficulty. Use neutral, factual language instead."
+)
+
+_LAW_WORDS = ('applicable law', 'treaty', 'statute', 'article', 'provision', 'legal framework')
+_ECON_WORDS = ('economic', 'revenue', 'profit', 'income', 'investment', 'business development')
+_PROC_WORDS = ('procedural', 'documentation', 'filing', 'submission', 'deadline', 'form')
+
+# Element purity: prevent cross-contamination between law/econ/proc branches.
+ELEMENT_FORBIDDEN_WORDS = {
+    'law': _ECON_WORDS + _PROC_WORDS,
+    'econ': _LAW_WORDS + _PROC_WORDS,
+    'proc': _LAW_WORDS + _ECON_WORDS,
+}
+
+ELEMENT_PURITY_REASON = (
+    "Element purity: the '{element}' branch must only contain facts about {element}, not other legal elements."
+)
+
+# Element-specific model validation, the prompt is formatted with the case description.
+MODEL_VALIDATORS = {
+    'law': {
+        'prompt': "We are analyzing applicable law in a German tax case. Does this deduction in any way prove or help to prove economic activity (revenue, business operations) or procedural requirements (filing, documentation) given the case description below?\n\n{description}",
+        'reason_why': "We are proving applicable law only. We do not want to prove economic activity or procedural requirements because that could make the reasoning complicated.",
+        'conditional': 'Applicable law',
+    },
+    'econ': {
+        'prompt': "We are analyzing economic activity in a German tax case. Does this deduction in any way prove or help to prove applicable law (treaties, statutes) or procedural requirements (filing, documentation) given the case description below?\n\n{description}",
+        'reason_why': "We are proving economic activity only. We do not want to prove applicable law or procedural requirements because that could make the reasoning complicated.",
+        'conditional': 'Economic activity',
+    },
+    'proc': {
+        'prompt': "We are analyzing procedural requirements in a German tax case. Does this deduction in any way prove or help to prove applicable law (treaties, statutes) or economic activity (revenue, business operations) given the case description below?\n\n{description}",
+        'reason_why': "We are proving procedural requirements only. We do not want to prove applicable law or economic activity because that could make the reasoning complicated.",
+        'conditional': 'Procedural requirements',
+    },
+}
@@ -2,95 +2,155 @@
 Main orchestration for German tax case generation using CrewAI.
 """
 
+import contextvars
 import json
 import random
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from crewai import Task, Crew
 
-from src import cache
-from src.model.openai import OpenAIModel
+from src import cache, telemetry
+from src.model.router import ModelRouter, RouteStep, routing_policy
+from src.validators import FactIndex, ValidationBatcher
+from src.validators.local_classifier import HashedNgramClassifier
 from src.utils.paths import OUTPUT_FOLDER, ROOT_FOLDER
 from src.dataset_types.german_tax_dataset import GermanTaxDataset
 
-from src.crews.agents import create_tree_agent, create_story_agent
+from src.crews.agents import get_tree_agent, get_story_agent
 from src.crews.scenario import sample_scenario, build_case_variants
 from src.crews.tree_builder import make_root_tree, expand_tree_with_crew
+from src.crews.tasks import llm_name
 from src.crews.html_renderer import generate_html_page_comparison
 from src.crews.config.prompts.story import STORY_GENERATION_PROMPT, COURT_DECISION_TASK_TEMPLATE
 
 
 
-def run_single_german_tax_case(use_model_validator: bool = False):
+def run_single_german_tax_case(
+        use_model_validator: bool = False,
+        use_streaming: bool = False,
+        cache_namespace: str = 'generation',
+        fresh_cache: bool = True,
+        expand_workers: int = 1,
+        validator_batch: int = 1,
+        local_validator_path: str = None,
+        dedupe_facts: bool = False,
+        dedupe_dataset: str = None,
+        cheap_models: bool = False,
+        explore_models: bool = False,
+        adaptive_max_tokens: bool = False,
+        router_outcomes_path: str = None
+):
     """
     Generate a single German tax case with reasoning tree and story using CrewAI.
     Outputs JSON dataset and HTML visualization.
     
     Args:
         use_model_validator: Whether to use LLM-based validation (more accurate but expensive)
+        use_streaming: Stream tree expansions and cancel them as soon as the 3 child lines arrived (or a cheap
+            validator already rejects them) instead of waiting for the full crew completion
+        cache_namespace: Cache namespace of the run's model calls (other namespaces, e.g. eval, are never touched)
+        fresh_cache: Start a new epoch of the namespace so every sample is generated fresh (entries of older epochs
+            are removed in the background), False reuses the current epoch
+        expand_workers: Expand up to this many case trees at the same time (needs use_streaming, crew agents are
+            shared and not safe to run on several threads)
+        validator_batch: With use_model_validator, ask up to this many deductions in one validator prompt (the trees
+            expanding at the same time batch their purity checks, see ValidationBatcher)
+        local_validator_path: With use_model_validator, a local classifier (python -m src.validators.local_classifier
+            train) that answers confident purity checks before the early escape model is asked
+        dedupe_facts: Reject generated facts that nearly repeat an earlier fact of the run (siblings, the other case)
+        dedupe_dataset: Also reject near-duplicates of the facts in this dataset file (implies dedupe_facts)
+        cheap_models: Add the cheaper engines of src/model/router.py CHEAP_RUNGS to the routing ladders.  They only
+            become the starting engine once the saved outcomes show they meet the step's targets (or with
+            explore_models)
+        explore_models: Start on cheaper engines that have too few saved outcomes yet, to collect them
+        adaptive_max_tokens: Cap max_tokens of tree expansion and validation calls at the observed output lengths
+        router_outcomes_path: Json file of the router's pass rate / latency / cost outcomes, loaded at the start and
+            written at the end of the run
     """
-    # Setup cache
+    # Setup cache and telemetry sinks (MUSR_TELEMETRY_JSONL / MUSR_TELEMETRY_PROM)
+    telemetry.configure_from_env()
     cache.enable()
-    if hasattr(cache, 'redis_backend') and cache.redis_backend:
-        cache.redis_backend.flushdb()
+    cache.use_namespace(cache_namespace, new_epoch=fresh_cache)
 
     # Setup output paths
     out_file = OUTPUT_FOLDER / 'german_tax_law_case.json'
     out_file.parent.mkdir(exist_ok=True, parents=True)
     html_file = ROOT_FOLDER / 'german_tax_law_case.html'
     
+    # Models per step (tree levels, story, purity validation) come from the routing policy, see src/model/router.py
+    router = ModelRouter(
+        policy=routing_policy(cheap_rungs=cheap_models, adaptive_max_tokens=adaptive_max_tokens),
+        explore=explore_models,
+        outcomes_path=router_outcomes_path
+    )
+
     # Optional: model for validation (if enabled)
     model_validator_model = None
     early_escape_model = None
     if use_model_validator:
-        model_validator_model = OpenAIModel(
-            engine='gpt-4',
-            api_max_attempts=30,
-            api_endpoint='chat',
-            temperature=0.0,  # Use deterministic for validation
-            max_tokens=500,
-            num_samples=1,
-            prompt_cost=0.03/1000,
-            completion_cost=0.06/1000
-        )
-        early_escape_model = OpenAIModel(
-            engine='gpt-3.5-turbo',
-            api_max_attempts=30,
-            api_endpoint='chat',
-            temperature=0.0,
-            max_tokens=500,
-            num_samples=1,
-            prompt_cost=0.0015/1000,
-            completion_cost=0.002/1000
-        )
-    
+        model_validator_model, early_escape_model = router.validator_models(RouteStep.PURITY_VALIDATION)
+    validation_batcher = None
+    if use_model_validator and validator_batch > 1:
+        validation_batcher = ValidationBatcher(max_batch=validator_batch)
+    local_validator = None
+    if use_model_validator and local_validator_path:
+        local_validator = HashedNgramClassifier.load(local_validator_path)
+    fact_index = None
+    if dedupe_dataset:
+        fact_index = FactIndex.from_dataset(dedupe_dataset)
+        print(f'Near-duplicate check seeded with {len(fact_index)} facts from {dedupe_dataset}')
+    elif dedupe_facts:
+        fact_index = FactIndex()
+
+    if expand_workers > 1 and not use_streaming:
+        print('WARNING: parallel tree expansion needs streaming (crew agents are shared), expanding one case at a time')
+        expand_workers = 1
+
     creator = GermanTaxDataset()
 
-    # Create agents
-    tree_agent = create_tree_agent(model="gpt-4", temperature=1.0)
-    story_agent = create_story_agent(model="gpt-4", temperature=1.0)
+    # Create agents (tree expansion picks its agent per level and attempt through the router)
+    tree_policy = router.step_policy(RouteStep.L1_L2)
+    tree_agent = get_tree_agent(router.engine_for(RouteStep.L1_L2), tree_policy['temperature'], tree_policy['max_tokens'])
+    story_engine = router.engine_for(RouteStep.STORY)
+    story_policy = router.step_policy(RouteStep.STORY)
+    story_agent = get_story_agent(story_engine, story_policy['temperature'], story_policy['max_tokens'])
 
     # Sample scenario and build two contrasting cases
     scenario_info, scenario_header, base_madlib, tx_madlib, tx_type = sample_scenario()
     business_sector = scenario_info.get('business_sector', 'N/A')
     cases = build_case_variants(base_madlib, tx_madlib, business_sector, tx_type)  # Returns 2 cases
 
-    # Process both cases
-    case_data = []
-    for idx, case in enumerate(cases):
+    def expand_case(case: dict):
         taxpayer = case['taxpayer']
         base_tree = make_root_tree({**case, 'taxpayer': taxpayer})
         
-        full_tree = expand_tree_with_crew(
+        return expand_tree_with_crew(
             tree_agent, 
             creator, 
             case, 
             base_tree,
             use_model_validator=use_model_validator,
             model_validator_model=model_validator_model,
-            early_escape_model=early_escape_model
+            early_escape_model=early_escape_model,
+            router=router,
+            use_streaming=use_streaming,
+            validation_batcher=validation_batcher,
+            local_validator=local_validator,
+            fact_index=fact_index
         )
-        
+
+    # Expand both case trees (concurrently with expand_workers, each in a copy of the caller's telemetry context)
+    if expand_workers > 1:
+        with ThreadPoolExecutor(max_workers=expand_workers, thread_name_prefix='expand') as executor:
+            futures = [executor.submit(contextvars.copy_context().run, expand_case, case) for case in cases]
+            full_trees = [future.result() for future in futures]
+    else:
+        full_trees = [expand_case(case) for case in cases]
+
+    # Process both cases
+    case_data = []
+    for idx, (case, full_tree) in enumerate(zip(cases, full_trees)):
         case_tree = {
             'tree': full_tree,
             'description': case['description'],
@@ -159,8 +219,10 @@ Tax authority: {tax_authority_str}"""
             verbose=True
         )
         
-        story_result = story_crew.kickoff()
+        with telemetry.tag(step='story'), telemetry.span(llm_name(story_agent), method='crew.kickoff') as record:
+            story_result = story_crew.kickoff()
         stories.append(str(story_result).strip())
+        router.record(RouteStep.STORY, story_engine, passed=bool(stories[-1]), latency_s=record.get('latency_s'))
 
     # Combine stories for comparison
     combined_context = f"""Following are two different tax law cases for similar transaction type.
@@ -207,5 +269,12 @@ Case 2:
     
     print('✅ Wrote dataset to', str(out_file))
     print('✅ Wrote HTML to', str(html_file))
+    print(telemetry.report())
+    print(router.report())
+    if router_outcomes_path:
+        router.save()
+    print(f'Cache tiers: {cache.stats()}')
+    if validation_batcher is not None:
+        print(f'Validator batching: {validation_batcher.stats()}')
 
 
@@ -2,20 +2,40 @@
 Task creation and node expansion logic for German tax case tree generation.
 """
 
-from typing import List
+import time
+from functools import lru_cache
+from typing import Iterable, List, Tuple
 
 from crewai import Agent, Task, Crew
 
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.crews.assets_loader import load_tree_prompts
-from src.validators import StructureValidator, ForbiddenTextValidator, ModelValidator, Validator
+from src.crews.prompts import TREE_AGENT_SYSTEM_PROMPT
+from src.crews.agents import get_tree_agent
+from src.crews.config.validators import (
+    CONCLUSIVE_REASON, CONCLUSIVE_WORDS, ELEMENT_FORBIDDEN_WORDS, ELEMENT_PURITY_REASON, MODEL_VALIDATORS
+)
+from src.validators import (
+    StructureValidator, ForbiddenTextValidator, ModelValidator, ValidationBatcher, Validator, ValidatorPipeline,
+    NearDuplicateValidator, FactIndex
+)
+from src.validators.local_classifier import HashedNgramClassifier
 from src.model.openai import OpenAIModel
+from src.model.router import ModelRouter, RouteStep
+from src.model.circuit_breaker import CircuitOpenError, ModelAPIError
+from src import telemetry
 
 
 # Load prompts once at module level
 _PROMPTS_ASSET = load_tree_prompts()
 
 
+def llm_name(agent: Agent) -> str:
+    """Model name behind a crew agent (used to label telemetry)."""
+    llm = getattr(agent, 'llm', None)
+    return str(getattr(llm, 'model_name', None) or getattr(llm, 'model', None) or 'crew')
+
+
 def get_node_depth(node: LogicNode) -> int:
     """Calculate the depth of a node in the tree."""
     depth = 0
@@ -72,15 +92,119 @@ def join_lines(value) -> str:
     return str(value)
 
 
+def clean_child_line(line: str) -> str:
+    """Strip the leading '>' markers from a generated child line."""
+    return line.strip().lstrip('> ').strip()
+
+
+def parse_child_lines(lines: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Split cleaned child lines into explicit and commonsense facts.
+
+    Args:
+        lines: Lines in the format "text | Fact From Story" or "text | Commonsense Knowledge"
+
+    Returns:
+        Tuple of (explicit_facts, commonsense_facts)
+    """
+    explicit_facts = []
+    commonsense_facts = []
+
+    for line in lines:
+        if '| Commonsense Knowledge' in line:
+            text = line.split('|')[0].strip()
+            commonsense_facts.append(text)
+        elif '| Fact From Story' in line or '| Complex Fact' in line:
+            text = line.split('|')[0].strip()
+            explicit_facts.append(text)
+
+    return explicit_facts, commonsense_facts
+
+
+class NodeStreamMonitor:
+    """
+    Line callback for OpenAIModel.stream_inference.  Parses child lines as they stream in and stops the request once
+    the node template's structure is filled, or as soon as a validator rejects the partial output.
+    """
+
+    def __init__(self, node: LogicNode, validators: Iterable[Validator]):
+        """
+        Args:
+            node: Node being expanded (children carry the expected fact types)
+            validators: Validators (or a ValidatorPipeline, cheapest first) whose validate_partial is checked after
+                every line
+        """
+        self.node = node
+        self.validators = validators
+
+        self.num_explicit = len([x for x in node.children if x.fact_type == LogicNodeFactType.EXPLICIT])
+        self.num_commonsense = len([x for x in node.children if x.fact_type == LogicNodeFactType.COMMONSENSE])
+
+        self.lines = []
+        self.retry_prompt = None
+
+    def __call__(self, line: str) -> bool:
+        line = clean_child_line(line)
+        if '|' not in line:
+            return False
+
+        self.lines.append(line)
+        explicit_facts, commonsense_facts = parse_child_lines(self.lines)
+        raw_output = '\n'.join(self.lines)
+
+        for validator in self.validators:
+            if not validator.validate_partial(self.node, explicit_facts, commonsense_facts, raw_output):
+                self.retry_prompt = validator.retry_prompt(self.node, explicit_facts, commonsense_facts, raw_output)
+                return True
+
+        return len(explicit_facts) >= self.num_explicit and len(commonsense_facts) >= self.num_commonsense
+
+
+def validator_level(depth: int) -> str:
+    """Validator set level of a node: L1→L2 constraints up to depth 1, the weaker L2→L3 ones below."""
+    return 'l1_l2' if depth <= 1 else 'l2_l3'
+
+
+@lru_cache(maxsize=None)
+def shared_validators(level: str, element: str) -> Tuple[Validator, ...]:
+    """
+    The validators that only depend on the level and the element (structure and forbidden text), built once per
+    (level, element) and shared by every node, case and worker thread.
+    """
+    validators = [StructureValidator()]
+
+    # 1. Avoid conclusive words - level-specific intensity
+    conclusive_words = CONCLUSIVE_WORDS.get(level)
+    if conclusive_words:
+        validators.append(ForbiddenTextValidator(
+            forbidden_words=list(conclusive_words),
+            reason_why=CONCLUSIVE_REASON
+        ))
+
+    # 2. Element purity: prevent cross-contamination between law/econ/proc branches
+    forbidden_words = ELEMENT_FORBIDDEN_WORDS.get(element)
+    if forbidden_words:
+        validators.append(ForbiddenTextValidator(
+            forbidden_words=list(forbidden_words),
+            reason_why=ELEMENT_PURITY_REASON.format(element=element)
+        ))
+
+    return tuple(validators)
+
+
 def create_validators(
     node: LogicNode, 
     case: dict, 
     use_model_validator: bool = True,
     model_validator_model: OpenAIModel = None,
-    early_escape_model: OpenAIModel = None
+    early_escape_model: OpenAIModel = None,
+    router: ModelRouter = None,
+    validation_batcher: ValidationBatcher = None,
+    local_validator: HashedNgramClassifier = None,
+    fact_index: FactIndex = None
 ) -> List[Validator]:
     """
-    Create validators for the node expansion.
+    Create validators for the node expansion from the validator sets in src/crews/config/validators.py.
     
     Args:
         node: Node being expanded (should have children with fact_type already set)
@@ -88,109 +212,72 @@ def create_validators(
         use_model_validator: Whether to use LLM-based validation (more accurate but expensive)
         model_validator_model: Main model for LLM validation
         early_escape_model: Cheaper model for initial validation attempt
+        router: If given, model validator answers are recorded on it (purity_validation step)
+        validation_batcher: If given, model validator questions are batched with other nodes' (see ValidationBatcher)
+        local_validator: If given, answers the model validator's confident cases locally before any model is asked
+        fact_index: If given, facts that nearly repeat a fact of the index (or of the same output) are rejected
         
     Returns:
         List of validators to apply
     """
-    validators = [StructureValidator()]
-    
-    # Get node depth to apply level-specific validation
-    depth = get_node_depth(node)
-    
-    # 1. Avoid conclusive words - level-specific intensity
-    if depth <= 1:  # L1→L2: Strong constraints (prevent obvious conclusions)
-        conclusive_words = [
-            # Direct conclusions about element status (always forbidden at L1→L2)
-            'sufficient', 'insufficient', 'compliant', 'non-compliant', 'deficient',
-            'adequate', 'inadequate', 'appropriate', 'inappropriate',
-            'satisfactory', 'unsatisfactory',
-            
-            # Strong conclusive adverbs
-            'independently', 'entirely', 'completely', 'fully', 'clearly', 'obviously',
-            'evidently', 'effectively', 'actively', 'substantially',
-            'significantly', 'materially', 'extensively', 'comprehensively',
-            
-            # Strong conclusive adjectives
-            'robust', 'substantial', 'significant',
-            
-            # Judgment verbs
-            'properly', 'improperly', 'prove', 'confirm', 'validate', 'verify'
-        ]
-    else:  # L2→L3: Weaker constraints (allow concrete factual descriptions)
-        conclusive_words = [
-            # Only block the most direct conclusions at leaf level
-            'sufficient', 'insufficient', 'compliant', 'non-compliant', 'deficient',
-            'adequate', 'inadequate', 'appropriate', 'inappropriate',
-            'satisfactory', 'unsatisfactory',
-            'obviously', 'clearly', 'evidently', 'successfully','comprehensive','positive','negative'
-        ]
-    
-    if conclusive_words:
-        validators.append(ForbiddenTextValidator(
-            forbidden_words=conclusive_words,
-            reason_why="these words make the conclusion too obvious and reduce reasoning difficulty. Use neutral, factual language instead."
-        ))
-    
-    # 2. Element purity: prevent cross-contamination between law/econ/proc branches
+    validators = list(shared_validators(validator_level(get_node_depth(node)), get_node_element(node)))
     element = get_node_element(node)
-    
-    if element == 'law':
-        forbidden_words = [
-            'economic', 'revenue', 'profit', 'income', 'investment', 'business development',
-            'procedural', 'documentation', 'filing', 'submission', 'deadline', 'form'
-        ]
-    elif element == 'econ':
-        forbidden_words = [
-            'applicable law', 'treaty', 'statute', 'article', 'provision', 'legal framework',
-            'procedural', 'documentation', 'filing', 'submission', 'deadline', 'form'
-        ]
-    elif element == 'proc':
-        forbidden_words = [
-            'applicable law', 'treaty', 'statute', 'article', 'provision', 'legal framework',
-            'economic', 'revenue', 'profit', 'income', 'investment', 'business development'
-        ]
-    else:
-        forbidden_words = []
-    
-    if forbidden_words:
-        validators.append(ForbiddenTextValidator(
-            forbidden_words=forbidden_words,
-            reason_why=f"Element purity: the '{element}' branch must only contain facts about {element}, not other legal elements."
-        ))
-    
+
+    # 3. No near-duplicates of facts generated before (siblings, the other case, the seeded dataset)
+    if fact_index is not None:
+        validators.append(NearDuplicateValidator(fact_index))
+
     # Optional: Add model-based validation (expensive but more accurate)
-    if use_model_validator and model_validator_model:
-        description = case.get('description', '')
-        
-        # Element-specific model validation prompts
-        if element == 'law':
-            validators.append(ModelValidator(
-                model_validator_model,
-                f"We are analyzing applicable law in a German tax case. Does this deduction in any way prove or help to prove economic activity (revenue, business operations) or procedural requirements (filing, documentation) given the case description below?\n\n{description}",
-                "We are proving applicable law only. We do not want to prove economic activity or procedural requirements because that could make the reasoning complicated.",
-                conditional='Applicable law',
-                early_escape_model=early_escape_model
-            ))
-        elif element == 'econ':
-            validators.append(ModelValidator(
-                model_validator_model,
-                f"We are analyzing economic activity in a German tax case. Does this deduction in any way prove or help to prove applicable law (treaties, statutes) or procedural requirements (filing, documentation) given the case description below?\n\n{description}",
-                "We are proving economic activity only. We do not want to prove applicable law or procedural requirements because that could make the reasoning complicated.",
-                conditional='Economic activity',
-                early_escape_model=early_escape_model
-            ))
-        elif element == 'proc':
-            validators.append(ModelValidator(
-                model_validator_model,
-                f"We are analyzing procedural requirements in a German tax case. Does this deduction in any way prove or help to prove applicable law (treaties, statutes) or economic activity (revenue, business operations) given the case description below?\n\n{description}",
-                "We are proving procedural requirements only. We do not want to prove applicable law or economic activity because that could make the reasoning complicated.",
-                conditional='Procedural requirements',
-                early_escape_model=early_escape_model
-            ))
-    
+    model_config = MODEL_VALIDATORS.get(element)
+    if use_model_validator and model_validator_model and model_config:
+        validators.append(ModelValidator(
+            model_validator_model,
+            model_config['prompt'].format(description=case.get('description', '')),
+            model_config['reason_why'],
+            conditional=model_config['conditional'],
+            early_escape_model=early_escape_model,
+            router=router,
+            route_step=RouteStep.PURITY_VALIDATION,
+            batcher=validation_batcher,
+            local_model=local_validator
+        ))
+
     return validators
 
 
+def get_validators(
+    node: LogicNode,
+    case: dict,
+    use_model_validator: bool = True,
+    model_validator_model: OpenAIModel = None,
+    early_escape_model: OpenAIModel = None,
+    router: ModelRouter = None,
+    validation_batcher: ValidationBatcher = None,
+    local_validator: HashedNgramClassifier = None,
+    fact_index: FactIndex = None
+) -> ValidatorPipeline:
+    """
+    The ValidatorPipeline for a node expansion, its memo covers the retries of the node.
+
+    The structure and forbidden text validators are shared per level and element (shared_validators).  The model and
+    near-duplicate validators depend on the case and on state of the run, so they are built per call.
+
+    With a fact_index, the explicit facts of every accepted deduction are added to it.
+    """
+    with_model = bool(use_model_validator and model_validator_model and get_node_element(node) in MODEL_VALIDATORS)
+    return ValidatorPipeline(create_validators(
+        node,
+        case or {},
+        use_model_validator=with_model,
+        model_validator_model=model_validator_model,
+        early_escape_model=early_escape_model,
+        router=router,
+        validation_batcher=validation_batcher,
+        local_validator=local_validator,
+        fact_index=fact_index
+    ), on_accept=fact_index.add_deduction if fact_index is not None else None)
+
+
 def expand_node_with_crew(
     agent: Agent,
     tree: LogicTree,
@@ -200,7 +287,13 @@ def expand_node_with_crew(
     max_retries: int = 3,
     use_model_validator: bool = False,
     model_validator_model: OpenAIModel = None,
-    early_escape_model: OpenAIModel = None
+    early_escape_model: OpenAIModel = None,
+    stream_model: OpenAIModel = None,
+    router: ModelRouter = None,
+    use_streaming: bool = False,
+    validation_batcher: ValidationBatcher = None,
+    local_validator: HashedNgramClassifier = None,
+    fact_index: FactIndex = None
 ) -> List[str]:
     """
     Use CrewAI to generate child lines for the given node with validation.
@@ -215,6 +308,15 @@ def expand_node_with_crew(
         use_model_validator: Whether to use LLM-based validation (expensive)
         model_validator_model: Main model for LLM validation
         early_escape_model: Cheaper model for initial validation
+        stream_model: If given, stream the expansion from this chat model instead of running the crew, cancelling
+            the request once the node structure is complete or a cheap validator fails
+        router: If given, picks the model of every attempt for this level (agent / stream model), escalating to a
+            stronger model after failed attempts, and records the outcome of each attempt
+        use_streaming: With a router, stream the expansion from the routed model (like stream_model)
+        validation_batcher: If given, model validator questions are batched with the ones of nodes expanding on
+            other threads
+        local_validator: If given, local classifier tier of the model validator (see local_classifier)
+        fact_index: If given, near-duplicates of its facts are rejected and the accepted facts are added to it
         
     Returns:
         List of child line strings in format: "text | Fact From Story" or "text | Commonsense Knowledge"
@@ -280,71 +382,99 @@ Output ONLY the 3 child lines in the following format (one per line):
 Do NOT include any other text, explanations, or markdown. Just the 3 lines.
 """.strip()
 
-    # Create validators
-    validators = create_validators(
-        node, 
-        case or {}, 
+    # Shared validators for this level/element, run cheapest first and only until one rejects (results are memoized)
+    validators = get_validators(
+        node,
+        case or {},
         use_model_validator=use_model_validator,
         model_validator_model=model_validator_model,
-        early_escape_model=early_escape_model
+        early_escape_model=early_escape_model,
+        router=router,
+        validation_batcher=validation_batcher,
+        local_validator=local_validator,
+        fact_index=fact_index
     )
     
-    # Retry loop with validation
-    for retry_attempt in range(max_retries + 1):
-        task = Task(
-            description=task_description,
-            agent=agent,
-            expected_output="Exactly 3 child node lines in the specified format"
-        )
-        
-        crew = Crew(
-            agents=[agent],
-            tasks=[task],
-            verbose=True
-        )
-        
-        result = crew.kickoff()
-        
-        # Parse result
-        output = str(result).strip()
-        lines = [line.strip() for line in output.split('\n') if line.strip() and '|' in line]
-        
-        # Clean up lines (remove leading '>')
-        cleaned_lines = []
-        for line in lines:
-            line = line.lstrip('> ').strip()
-            if '|' in line:
-                cleaned_lines.append(line)
+    # Every model call made while expanding this node is tagged with the asset it belongs to.
+    with telemetry.tag(asset_key=asset_key):
+        # Retry loop with validation
+        for retry_attempt in range(max_retries + 1):
+            attempt_agent, attempt_model, engine = agent, stream_model, None
+            if router is not None:
+                # Every failed attempt so far counts towards escalating to a stronger model.
+                engine = router.engine_for(level_key, failures=retry_attempt)
+                if use_streaming:
+                    attempt_model = router.model_for(level_key, engine=engine)
+                else:
+                    policy = router.step_policy(level_key)
+                    attempt_agent = get_tree_agent(engine, policy.get('temperature', 1.0), policy.get('max_tokens'))
+            started = time.perf_counter()
+            cost_before = getattr(attempt_model, 'total_cost', None)
+
+            def record_attempt(passed: bool):
+                if router is not None:
+                    cost = attempt_model.total_cost - cost_before if cost_before is not None else None
+                    router.record(level_key, engine, passed, time.perf_counter() - started, cost)
+
+            if attempt_model is not None:
+                monitor = NodeStreamMonitor(node, validators)
+                try:
+                    output = attempt_model.stream_inference(
+                        task_description,
+                        system_prompt=TREE_AGENT_SYSTEM_PROMPT,
+                        on_line=monitor
+                    ).strip()
+                except CircuitOpenError:
+                    raise
+                except ModelAPIError as e:
+                    print(f"Model call failed (attempt {retry_attempt + 1}/{max_retries + 1}): {e}")
+                    record_attempt(False)
+                    continue
+
+                if monitor.retry_prompt:
+                    print(f"Validation failed while streaming (attempt {retry_attempt + 1}/{max_retries + 1})")
+                    print(f"Retry reason: {monitor.retry_prompt}")
+                    task_description += f"\n\n{monitor.retry_prompt}"
+                    record_attempt(False)
+                    continue
+            else:
+                task = Task(
+                    description=task_description,
+                    agent=attempt_agent,
+                    expected_output="Exactly 3 child node lines in the specified format"
+                )
+
+                crew = Crew(
+                    agents=[attempt_agent],
+                    tasks=[task],
+                    verbose=True
+                )
+
+                with telemetry.span(llm_name(attempt_agent), method='crew.kickoff'):
+                    result = crew.kickoff()
+                output = str(result).strip()
         
-        # Parse into explicit and commonsense facts
-        explicit_facts = []
-        commonsense_facts = []
+            # Parse result (remove leading '>')
+            cleaned_lines = [clean_child_line(line) for line in output.split('\n') if line.strip() and '|' in line]
+            cleaned_lines = [line for line in cleaned_lines if '|' in line]
         
-        for line in cleaned_lines[:3]:
-            if '| Commonsense Knowledge' in line:
-                text = line.split('|')[0].strip()
-                commonsense_facts.append(text)
-            elif '| Fact From Story' in line or '| Complex Fact' in line:
-                text = line.split('|')[0].strip()
-                explicit_facts.append(text)
+            # Parse into explicit and commonsense facts
+            explicit_facts, commonsense_facts = parse_child_lines(cleaned_lines[:3])
         
-        # Run validators (node.children already has fact_type set by build_structure)
-        all_valid = True
-        for validator in validators:
-            valid, retry_prompt = validator(node, explicit_facts, commonsense_facts, output)
-            if not valid:
+            # Run validators (node.children already has fact_type set by build_structure)
+            all_valid, retry_prompt = validators(node, explicit_facts, commonsense_facts, output)
+            if not all_valid:
                 print(f"Validation failed (attempt {retry_attempt + 1}/{max_retries + 1})")
                 print(f"Retry reason: {retry_prompt}")
-                
+
                 # Append retry prompt to task description
                 task_description += f"\n\n{retry_prompt}"
-                all_valid = False
-                break
-        
-        if all_valid:
-            return cleaned_lines[:3]
+
+            record_attempt(all_valid)
+            if all_valid:
+                return cleaned_lines[:3]
     
-    # If all retries failed, return empty (will kill branch)
-    print(f"All validation attempts failed for node: {node.value}")
-    return []
+        # If all retries failed, return empty (will kill branch)
+        print(f"All validation attempts failed for node: {node.value}")
+        return []
 
@@ -54,7 +54,13 @@ def expand_tree_with_crew(
     base_tree: LogicTree,
     use_model_validator: bool = False,
     model_validator_model = None,
-    early_escape_model = None
+    early_escape_model = None,
+    stream_model = None,
+    router = None,
+    use_streaming: bool = False,
+    validation_batcher = None,
+    local_validator = None,
+    fact_index = None
 ) -> LogicTree:
     """
     Expand the tree structure using CrewAI agents.
@@ -68,6 +74,12 @@ def expand_tree_with_crew(
         use_model_validator: Whether to use LLM-based validation
         model_validator_model: Model for LLM validation
         early_escape_model: Cheaper model for initial validation
+        stream_model: Optional chat model used to stream expansions (stops early once the node is filled)
+        router: Optional ModelRouter picking the model per level and attempt (overrides tree_agent / stream_model)
+        use_streaming: With a router, stream expansions from the routed models
+        validation_batcher: Optional ValidationBatcher shared with trees expanding on other threads
+        local_validator: Optional local classifier answering confident model validations without an API call
+        fact_index: Optional FactIndex shared by both cases, rejects facts nearly repeating an earlier one
         
     Returns:
         Fully expanded LogicTree (depth 3)
@@ -98,7 +110,13 @@ def expand_tree_with_crew(
                 case=case,
                 use_model_validator=use_model_validator,
                 model_validator_model=model_validator_model,
-                early_escape_model=early_escape_model
+                early_escape_model=early_escape_model,
+                stream_model=stream_model,
+                router=router,
+                use_streaming=use_streaming,
+                validation_batcher=validation_batcher,
+                local_validator=local_validator,
+                fact_index=fact_index
             )
             
             # Parse output into facts
@@ -10,8 +10,8 @@ from functools import partial
 
 from src.madlib.madlib import Madlib
 from src.logic_tree.tree import LogicNode, LogicTree, LogicNodeFactType
-from src.model import Model
-from src.validators import Validator, StructureValidator
+from src.model import Model, CircuitOpenError, ModelAPIError
+from src.validators import Validator, StructureValidator, ValidatorPipeline
 
 
 # This prompt can be overwritten when needed, but this is the base prompt we use to create a deduction.
@@ -340,7 +340,7 @@ class DatasetBuilder:
             progress_bar: bool = False,
             test_prompt: bool = False,
             use_iterative_complete_v2: bool = False,
-            validators: List[Validator] = (StructureValidator())
+            validators: Union[Validator, List[Validator], ValidatorPipeline] = (StructureValidator())
     ) -> LogicTree:
         """
         This is the beginning of the Recursive Reasoning Tree Expansion algorithm.
@@ -362,7 +362,8 @@ class DatasetBuilder:
         :param progress_bar: Show a TQDM progress bar while we fill in the tree.
         :param test_prompt: Prints the first prompt for the first deduction then kills the entire program (used for debugging)
         :param use_iterative_complete_v2: For full use of validators beyond structural set this to True (our datasets use this)
-        :param validators: List of validators to be used.
+        :param validators: Validators to be used (a single validator, a list or a ValidatorPipeline).  They run
+            cheapest first until one rejects, and results are memoized for the whole tree.
         """
 
         def get_num_steps(node):
@@ -454,6 +455,8 @@ class DatasetBuilder:
                 iteratively_complete(description, tree, c, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt)
 
         if use_iterative_complete_v2:
+            if not isinstance(validators, ValidatorPipeline):
+                validators = ValidatorPipeline(validators)
             [self.iteratively_complete_v2(description, tree, x, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt, validators=validators) for x in tree.nodes]
         else:
             [iteratively_complete(description, tree, x, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt) for x in tree.nodes]
@@ -518,10 +521,14 @@ class DatasetBuilder:
             pad_char='> ',
             max_retries_on_error: int = 1,
             test_prompt: bool = False,
-            validators: List[Validator] = (StructureValidator()),
+            validators: Union[Validator, List[Validator], ValidatorPipeline] = (StructureValidator()),
     ):
         """Recursive Reasoning Tree Expansion Algorithm v2"""
 
+        if not isinstance(validators, ValidatorPipeline):
+            # Also turns the single StructureValidator default into something that can be run.
+            validators = ValidatorPipeline(validators)
+
         children = node.children
 
         if any([x.value == '' for x in children]):
@@ -561,21 +568,28 @@ class DatasetBuilder:
             all_valid = True
             while retry_idx <= max_retries_on_error:
                 all_valid = True
-                raw = model.inference(prompt)
+                try:
+                    raw = model.inference(prompt)
+                except CircuitOpenError:
+                    # The model is down, killing every remaining branch would only produce a broken tree.
+                    raise
+                except ModelAPIError as e:
+                    print(f'ERROR Model call failed, retrying deduction: {e}')
+                    all_valid = False
+                    retry_idx += 1
+                    continue
                 output = raw.choices[0]['message']['content']
 
                 facts_from_story, cs_knowledge = parse_out(output)
 
-                for v in validators:
-                    valid, retry_prompt = v(node, facts_from_story, cs_knowledge, output)
-                    if not valid:
-                        # If we fail, we will append the retry prompt from the validator to our deduction prompt before
-                        # we ask for the new deduction.
-                        prompt_parts = prompt.split('Entailment Step to Complete:')
+                valid, retry_prompt = validators(node, facts_from_story, cs_knowledge, output)
+                if not valid:
+                    # If we fail, we will append the retry prompt from the validator to our deduction prompt before
+                    # we ask for the new deduction.
+                    prompt_parts = prompt.split('Entailment Step to Complete:')
 
-                        prompt = prompt_parts[0] + f'\n\n{retry_prompt}\n\nEntailment Step to Complete:\n{prompt_parts[1]}'
-                        all_valid = False
-                        break
+                    prompt = prompt_parts[0] + f'\n\n{retry_prompt}\n\nEntailment Step to Complete:\n{prompt_parts[1]}'
+                    all_valid = False
                 if all_valid:
                     break
 
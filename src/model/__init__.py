@@ -1,3 +1,47 @@
+"""
+Model backends are registered by import path and only imported the first time they are used.  This keeps
+`from src.model import OpenAIModel` from paying for heavy backends (transformers, torch) that are never called.
+"""
+
+import importlib
+from typing import Dict, Type
+
 from src.model.model import Model
-from src.model.openai import OpenAIModel
-from src.model.hf import HFModel
+from src.model.circuit_breaker import CircuitBreaker, CircuitOpenError, ModelAPIError
+from src.model.router import ModelRouter, RouteStep
+
+
+# Backend name -> module that defines a class of the same name.
+_BACKENDS: Dict[str, str] = {
+    'OpenAIModel': 'src.model.openai',
+    'HFModel': 'src.model.hf',
+}
+
+
+def register_backend(name: str, module_path: str):
+    """
+    Register a model backend without importing it.
+
+    :param name: Class name of the backend (also the attribute exposed on src.model)
+    :param module_path: Dotted import path of the module defining the class
+    """
+    _BACKENDS[name] = module_path
+
+
+def get_backend(name: str) -> Type[Model]:
+    """Import (on first use) and return the backend class registered under name."""
+    if name not in _BACKENDS:
+        raise KeyError(f"Unknown model backend: {name} (registered: {', '.join(sorted(_BACKENDS))})")
+    module = importlib.import_module(_BACKENDS[name])
+    backend = getattr(module, name)
+    globals()[name] = backend
+    return backend
+
+
+def __getattr__(name: str):
+    if name in _BACKENDS:
+        return get_backend(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ['Model', 'CircuitBreaker', 'CircuitOpenError', 'ModelAPIError', 'ModelRouter', 'RouteStep', 'register_backend', 'get_backend', *_BACKENDS.keys()]
@@ -0,0 +1,109 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Tuple
+
+
+class DynamicBatcher:
+    """
+    Gathers requests coming in concurrently (from several threads) into batches and runs them together on a single
+    worker thread.
+
+    A batch is closed once the padded token budget or the max batch size is hit, or after the oldest request waited
+    max_wait seconds.  Only requests with identical keyword arguments (generation settings) are batched together.
+    """
+
+    def __init__(
+            self,
+            run_batch: Callable[..., List[Any]],
+            count_tokens: Callable[[Any], int],
+            max_batch_tokens: int = 8192,
+            max_batch_size: int = 16,
+            max_wait: float = 0.02,
+    ):
+        """
+        :param run_batch: Called as run_batch(items, **kwargs) and must return one result per item (in order).
+        :param count_tokens: Number of tokens an item will take up in a batch.
+        :param max_batch_tokens: Budget of the padded batch (longest item * number of items).
+        :param max_batch_size: Max number of items in one batch.
+        :param max_wait: How long (seconds) the oldest request waits for others to join its batch.
+        """
+        self.run_batch = run_batch
+        self.count_tokens = count_tokens
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._pending: List[Tuple[Any, Dict, int, float, Future]] = []
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._worker = threading.Thread(target=self._loop, name='dynamic-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, item: Any, **kwargs) -> Future:
+        """Queue an item, the returned future resolves to its result (future.queue_wait holds the seconds spent queued)."""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('DynamicBatcher is closed.')
+            self._pending.append((item, kwargs, self.count_tokens(item), time.monotonic(), future))
+            self._cond.notify()
+        return future
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    def _take_batch(self) -> Tuple[List[Tuple[Any, Dict, int, float, Future]], Dict]:
+        """Pop the next batch (oldest request first) from the pending list, must hold the lock."""
+        kwargs = self._pending[0][1]
+        batch = []
+        longest = 0
+        for entry in list(self._pending):
+            if entry[1] != kwargs:
+                continue
+            new_longest = max(longest, entry[2])
+            if batch and (len(batch) >= self.max_batch_size or new_longest * (len(batch) + 1) > self.max_batch_tokens):
+                break
+            batch.append(entry)
+            longest = new_longest
+        for entry in batch:
+            self._pending.remove(entry)
+        return batch, kwargs
+
+    def _batch_full(self) -> bool:
+        kwargs = self._pending[0][1]
+        matching = [x for x in self._pending if x[1] == kwargs]
+        longest = max(x[2] for x in matching)
+        return len(matching) >= self.max_batch_size or longest * len(matching) >= self.max_batch_tokens
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+
+                deadline = self._pending[0][3] + self.max_wait
+                while not self._closed and not self._batch_full():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch, kwargs = self._take_batch()
+
+            started = time.monotonic()
+            for _, _, _, enqueued, future in batch:
+                future.queue_wait = started - enqueued
+            try:
+                results = self.run_batch([x[0] for x in batch], **kwargs)
+                for entry, result in zip(batch, results):
+                    entry[4].set_result(result)
+            except Exception as e:
+                for entry in batch:
+                    entry[4].set_exception(e)
@@ -0,0 +1,152 @@
+import threading
+import time
+from typing import Dict, Optional
+
+
+class ModelAPIError(Exception):
+    """A model call failed for good (all retries used up, or a request no retry can fix).  Nothing is cached for it."""
+
+    def __init__(self, engine: str, message: str, last_exception: Optional[BaseException] = None):
+        super().__init__(f'{engine}: {message}')
+        self.engine = engine
+        self.last_exception = last_exception
+
+
+class CircuitOpenError(ModelAPIError):
+    """The circuit breaker for this engine is open, the call was not attempted."""
+
+
+# openai exception types worth retrying (matched by name so this module never imports openai).
+TRANSIENT_ERROR_TYPES = {'APIConnectionError', 'APITimeoutError', 'RateLimitError', 'InternalServerError'}
+# 4xx statuses that may succeed on a retry (request timeout, conflict, rate limit), every other 4xx never will.
+TRANSIENT_STATUS_CODES = {408, 409, 429}
+
+
+def status_code(e: BaseException) -> Optional[int]:
+    code = getattr(e, 'status_code', None)
+    if code is None:
+        code = getattr(getattr(e, 'response', None), 'status_code', None)
+    return code if isinstance(code, int) else None
+
+
+def is_transient(e: BaseException) -> bool:
+    """
+    Whether a failed call may succeed when retried: connection problems, timeouts, rate limits and 5xx.  Bad requests,
+    context length errors, auth and other 4xx fail the same way every time, so they are neither retried nor counted
+    against the circuit breaker.
+    """
+    if any(t.__name__ in TRANSIENT_ERROR_TYPES for t in type(e).__mro__):
+        return True
+    code = status_code(e)
+    if code is not None:
+        return code >= 500 or code in TRANSIENT_STATUS_CODES
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    message = str(e).lower()
+    return any(x in message for x in ('rate', 'timeout', 'timed out', 'connection', 'overloaded', 'unavailable'))
+
+
+class CircuitBreaker:
+    """
+    Per engine circuit breaker.
+
+    CLOSED: calls go through, consecutive failures are counted.
+    OPEN: after failure_threshold consecutive failures every call fails fast with CircuitOpenError.
+    HALF_OPEN: once reset_timeout seconds passed, a single probe call is let through.  If it succeeds the circuit
+        closes again, if it fails it re-opens for another reset_timeout.
+
+    Breakers are shared per engine (see for_engine) so every model instance/thread calling the same engine sees the
+    same outage.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    _registry: Dict[str, 'CircuitBreaker'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param name: Usually the engine name, used in errors.
+        :param failure_threshold: Consecutive failures before the circuit opens.
+        :param reset_timeout: Seconds to stay open before a probe call is allowed.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_engine(cls, engine: str, failure_threshold: int = 5, reset_timeout: float = 30.0) -> 'CircuitBreaker':
+        """
+        The engine's shared breaker, created with these settings by the first caller.
+
+        :raises ValueError: When the engine's breaker already exists with a different threshold or timeout (every
+            instance of an engine has to agree on them, the breaker is shared).
+        """
+        with cls._registry_lock:
+            if engine not in cls._registry:
+                cls._registry[engine] = cls(engine, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+            breaker = cls._registry[engine]
+        if breaker.failure_threshold != failure_threshold or breaker.reset_timeout != reset_timeout:
+            raise ValueError(
+                f'Circuit breaker for {engine} already exists with failure_threshold={breaker.failure_threshold}, '
+                f'reset_timeout={breaker.reset_timeout} (asked for {failure_threshold}, {reset_timeout})'
+            )
+        return breaker
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpenError unless a call may go through now (closed, or this call is the half open probe).
+
+        :return: Whether this call is the probe, which has to end in record_success, record_failure or release_probe
+            (otherwise no other call is ever let through again).
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.probing = True
+                return True
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            raise CircuitOpenError(
+                self.name,
+                f'circuit open after {self.failures} consecutive failures (next probe in {retry_in:.0f}s)'
+            )
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release_probe(self):
+        """End a probe that neither succeeded nor failed (interrupted), the next call after it may probe again."""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.probing:
+                    print(f'ERROR: circuit for {self.name} opened after {self.failures} consecutive failures.')
+                self.opened_at = time.monotonic()
+                self.probing = False
@@ -0,0 +1,163 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from src.utils.telemetry import percentile
+
+
+class LatencyTracker:
+    """Sliding window of the most recent successful call latencies (seconds)."""
+
+    def __init__(self, window: int = 200):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self.lock:
+            return percentile(list(self.latencies), p)
+
+    def __len__(self):
+        return len(self.latencies)
+
+
+class RequestHedger:
+    """
+    Hedged requests: when a call has not returned after the p-th percentile of recently observed latencies, the same
+    call is sent a second time and whichever returns first wins.  The slower one is left to finish in the background
+    (its result is only handed to on_discard, i.e. for cost tracking).  Both requests, and on_discard, run in a copy of
+    the caller's context, so they see the caller's telemetry span and tags.  The loser's latency is recorded once it
+    finishes (only recording winners would pull the hedge threshold down and make hedges ever more frequent).
+
+    Hedges are bounded by a budget: at most `budget` extra requests per request made (0.05 = 5% extra).  Hedgers are
+    shared per engine (see for_engine) so the latency window and budget cover every caller of that engine.
+    """
+
+    _registry: Dict[str, 'RequestHedger'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+            self,
+            hedge_percentile: float = 95,
+            budget: float = 0.05,
+            min_samples: int = 20,
+            max_workers: int = 32,
+    ):
+        """
+        :param hedge_percentile: Latency percentile after which the duplicate request is sent.
+        :param budget: Max fraction of extra (hedged) requests.
+        :param min_samples: Latencies to observe before hedging starts.
+        :param max_workers: Threads available for in flight requests.
+        """
+        self.hedge_percentile = hedge_percentile
+        self.budget = budget
+        self.min_samples = min_samples
+
+        self.tracker = LatencyTracker()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedged-request')
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_engine(cls, engine: str, **kwargs) -> 'RequestHedger':
+        with cls._registry_lock:
+            if engine not in cls._registry:
+                cls._registry[engine] = cls(**kwargs)
+            return cls._registry[engine]
+
+    def _take_hedge(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def _timed(self, fn: Callable[[], Any]) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        result = fn()
+        return result, time.perf_counter() - start
+
+    def _submit(self, fn: Callable[[], Any], contexts: Dict[Future, contextvars.Context]) -> Future:
+        """
+        Run fn on the executor in a copy of the calling thread's context (one copy per request, a context can only be
+        entered by one thread at a time).
+        """
+        context = contextvars.copy_context()
+        future = self.executor.submit(context.run, self._timed, fn)
+        contexts[future] = context
+        return future
+
+    def call(self, fn: Callable[[], Any], on_discard: Callable[[Any], None] = None) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Run fn, hedging it if it is slow.
+
+        :param fn: The request (must be safe to run twice).
+        :param on_discard: Called with the result of the losing request if it finishes successfully (in a copy of the
+            caller's context, possibly after call returned).
+        :return: (result, info) where info has hedged / hedge_won / hedge_after_s for telemetry.
+        """
+        with self.lock:
+            self.requests += 1
+
+        threshold = self.tracker.percentile(self.hedge_percentile) if len(self.tracker) >= self.min_samples else None
+        if threshold is None:
+            result, latency = self._timed(fn)
+            self.tracker.add(latency)
+            return result, {'hedged': False}
+
+        contexts: Dict[Future, contextvars.Context] = {}
+        primary = self._submit(fn, contexts)
+        done, _ = wait([primary], timeout=threshold)
+        if done or not self._take_hedge():
+            result, latency = primary.result()
+            self.tracker.add(latency)
+            return result, {'hedged': False}
+
+        hedge = self._submit(fn, contexts)
+        pending = {primary, hedge}
+        first_exc = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    first_exc = first_exc or future.exception()
+                    continue
+
+                result, latency = future.result()
+                self.tracker.add(latency)
+                hedge_won = future is hedge
+                if hedge_won:
+                    with self.lock:
+                        self.hedge_wins += 1
+                loser = primary if hedge_won else hedge
+
+                def finish_loser(f: Future):
+                    if f.exception() is not None:
+                        return
+                    loser_result, loser_latency = f.result()
+                    self.tracker.add(loser_latency)
+                    if on_discard is not None:
+                        contexts[f].run(on_discard, loser_result)
+
+                loser.add_done_callback(finish_loser)
+                return result, {'hedged': True, 'hedge_won': hedge_won, 'hedge_after_s': threshold}
+
+        raise first_exc
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'hedge_rate': self.hedges / self.requests if self.requests else 0.0,
+            'hedge_after_s': self.tracker.percentile(self.hedge_percentile),
+        }
@@ -1,38 +1,71 @@
 import os
+import copy
 import itertools
 import time
-import openai
 from datetime import timedelta
 import random
 
-from typing import List, Dict, Union, Any, Generator
-from tqdm import tqdm
-from transformers import GPT2TokenizerFast, AutoModel, AutoTokenizer, Pipeline, AutoModelForCausalLM
+from typing import List, Dict, Union, Any, Generator, Optional, Tuple
 
 from src.model.model import Model
-from src import cache
+from src.model.batching import DynamicBatcher
+from src import cache, telemetry
+from src.utils.telemetry import annotate
+
+
+def pick_device() -> str:
+    """Best available torch device (cuda, then apple mps, then cpu)."""
+    import torch
+
+    if torch.cuda.is_available():
+        return 'cuda'
+    if getattr(torch.backends, 'mps', None) is not None and torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
 
 
 class HFModel(Model):
     """
     Wrapper for a huggingface model that mostly benefits from a caching mechanism.
 
+    Prompts can be generated in batches (inference_batch, left padded) and concurrent inference calls can be gathered
+    into batches automatically with enable_dynamic_batching().
+
+    Static prompt prefixes (system prompt, ICL example, ...) can be registered with register_prefix(), their key/value
+    cache is computed once and reused by every single prompt generation that starts with them.
+
     NOTE: the caching mechanism here is fairly aggressive and doesn't distinguish hyperparameters from the model
     (i.e. A model at temperature 1 vs 0.5 will have the same request cached under the same key!)
     """
 
     model_name: str
+    device: Optional[str]
+    max_new_tokens: Optional[int]
+    max_length: int
+    stop_strings: List[str]
+    max_batch_size: int
 
     def __init__(
             self,
             model_name: str,
             *args,
             load_in_4bit: bool = False,
+            device: str = None,
+            max_new_tokens: int = None,
+            max_length: int = 2000,
+            stop_strings: List[str] = None,
+            max_batch_size: int = 8,
     ):
         """
         :param model_name: Huggingface model name
         :param args: Model arguments that will be passed into AutoModelForCausalLM.from_pretrained().generate(,**args)
-        :param load_in_4bit: Bits and Bytes quantization to 4bit.
+        :param load_in_4bit: Bits and Bytes quantization to 4bit (only applied on cuda).
+        :param device: Torch device to run on, picked automatically (cuda > mps > cpu) when None.
+        :param max_new_tokens: Default number of tokens to generate past the prompt, None to use max_length instead.
+        :param max_length: Default budget of prompt plus generated tokens per prompt (the generate(max_length=2000)
+            default this wrapper always had), used while max_new_tokens is None.
+        :param stop_strings: Default strings that end a generation (the stop string is not included in the output).
+        :param max_batch_size: Max prompts per generate() call in inference_batch.
         """
 
         self.model_name = model_name
@@ -40,27 +73,229 @@ class HFModel(Model):
 
         self.model_args = args
 
+        self.device = device
+        self.max_new_tokens = max_new_tokens
+        self.max_length = max_length
+        self.stop_strings = list(stop_strings) if stop_strings else []
+        self.max_batch_size = max_batch_size
+
         # Note initialized here so you can have instantiations of the model floating around.
         self.model = None
-        self.tokenize = None
+        self.tokenizer = None
+        self.batcher = None
+
+        # prefix string -> (token ids covered by the cache, key/value cache)
+        self.prefix_caches: Dict[str, Tuple[List[int], Any]] = {}
 
     def load_model(self):
-        self.model = AutoModelForCausalLM.from_pretrained(self.model_name, device_map="auto", load_in_4bit=self.load_in_4bit)
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        # transformers (and torch) are only imported once a HF model is actually used.
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+
+        if self.device is None:
+            self.device = pick_device()
+
+        model_kwargs = {}
+        if self.device == 'cuda':
+            model_kwargs['device_map'] = 'auto'
+            model_kwargs['load_in_4bit'] = self.load_in_4bit
+        elif self.load_in_4bit:
+            print(f'WARNING: 4bit quantization needs cuda, loading {self.model_name} unquantized on {self.device}.')
+
+        self.model = AutoModelForCausalLM.from_pretrained(self.model_name, **model_kwargs)
+        if self.device != 'cuda':
+            self.model.to(self.device)
+        self.model.eval()
+
+        # Left padding so every prompt in a batch ends right where generation starts.
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, padding_side='left')
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def enable_dynamic_batching(self, max_batch_tokens: int = 8192, max_wait: float = 0.02):
+        """
+        Route inference() calls through a DynamicBatcher so that calls made concurrently (i.e. from a thread pool) are
+        generated together.
+
+        :param max_batch_tokens: Padded token budget of one batch (longest prompt * batch size).
+        :param max_wait: Seconds a request waits for others to join its batch.
+        """
+        if self.batcher is not None:
+            return
+        if not self.model or not self.tokenizer:
+            self.load_model()
+
+        self.batcher = DynamicBatcher(
+            run_batch=self.inference_batch,
+            count_tokens=lambda prompt: len(self.tokenizer(prompt)['input_ids']),
+            max_batch_tokens=max_batch_tokens,
+            max_batch_size=self.max_batch_size,
+            max_wait=max_wait
+        )
+
+    def disable_dynamic_batching(self):
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+    def register_prefix(self, prefix: str):
+        """
+        Precompute the key/value cache for a prompt prefix that many requests share.  Any later single prompt
+        generation whose tokens start with the prefix tokens skips encoding them again.
+
+        The last prefix token is left out of the cache, tokenizers often merge it with whatever text follows, which
+        would otherwise make the token ids of the full prompt diverge from the cached ones.
+
+        :param prefix: Literal text every matching prompt starts with.
+        """
+        import torch
+        from transformers import DynamicCache
+
+        if not prefix or prefix in self.prefix_caches:
+            return
+        if not self.model or not self.tokenizer:
+            self.load_model()
+
+        input_ids = self.tokenizer(prefix, return_tensors="pt")['input_ids'][:, :-1].to(self.model.device)
+        if input_ids.shape[1] == 0:
+            return
+
+        kv_cache = DynamicCache()
+        with torch.no_grad():
+            self.model(input_ids=input_ids, past_key_values=kv_cache, use_cache=True)
+
+        self.prefix_caches[prefix] = (input_ids[0].tolist(), kv_cache)
 
+    def clear_prefixes(self):
+        """Drop every registered prefix cache (frees their device memory once no generate call uses them)."""
+        self.prefix_caches = {}
+
+    def find_prefix_cache(self, input_ids: List[int]) -> Optional[Any]:
+        """Longest registered prefix cache whose tokens are a strict prefix of input_ids (None when there is none)."""
+        best_ids, best_cache = [], None
+        for ids, kv_cache in self.prefix_caches.values():
+            if len(best_ids) < len(ids) < len(input_ids) and input_ids[:len(ids)] == ids:
+                best_ids, best_cache = ids, kv_cache
+        return best_cache
+
+    @telemetry.instrumented(model_attr='model_name')
     @cache.cached(data_ex=timedelta(days=30), no_data_ex=timedelta(hours=1), prepended_key_attr='model_name')
-    def inference(self, prompt: str, *args, tokenizer_args=None, model_args=None, decode_args=None, **kwargs) -> Any:
-        if model_args is None:
-            model_args = {'max_length': 2000}
+    def inference(
+            self,
+            prompt: str,
+            *args,
+            tokenizer_args=None,
+            model_args=None,
+            decode_args=None,
+            max_new_tokens: int = None,
+            stop: List[str] = None,
+            **kwargs
+    ) -> Any:
+        """
+        Generate for a single prompt, the output is the prompt followed by the completion (like the original decode of
+        the full sequence).
+        """
+        if self.batcher is not None and not tokenizer_args and not model_args and not decode_args:
+            future = self.batcher.submit(prompt, max_new_tokens=max_new_tokens, stop=stop, echo=True)
+            output = future.result()
+            annotate(queue_wait_s=getattr(future, 'queue_wait', None))
+            return output
+
+        return self.inference_batch(
+            [prompt],
+            tokenizer_args=tokenizer_args,
+            model_args=model_args,
+            decode_args=decode_args,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            echo=True
+        )[0]
+
+    def inference_batch(
+            self,
+            prompts: List[str],
+            tokenizer_args=None,
+            model_args=None,
+            decode_args=None,
+            max_new_tokens: int = None,
+            stop: List[str] = None,
+            echo: bool = False,
+    ) -> List[str]:
+        """
+        Generate completions for many prompts at once (left padded, max_batch_size prompts per generate call).
+
+        :param prompts: Prompts to complete.
+        :param tokenizer_args: Extra arguments for the tokenizer call.
+        :param model_args: Extra arguments for model.generate().
+        :param decode_args: Extra arguments for tokenizer.decode().
+        :param max_new_tokens: Tokens to generate past the prompt (defaults to self.max_new_tokens, and while that is
+            None to max_length minus the prompt's own length, as if it were generated alone).
+        :param stop: Strings that end a generation (defaults to self.stop_strings).
+        :param echo: Prepend the prompt to each returned completion.
+        :return: One completion per prompt.
+        """
+        import torch
+
         if tokenizer_args is None:
             tokenizer_args = {}
+        if model_args is None:
+            model_args = {}
         if decode_args is None:
             decode_args = {}
+        if max_new_tokens is None:
+            max_new_tokens = self.max_new_tokens
+        if stop is None:
+            stop = self.stop_strings
 
         if not self.model or not self.tokenizer:
             self.load_model()
 
-        model_inputs = self.tokenizer(prompt, return_tensors="pt", **tokenizer_args).to('cuda')
-        output = self.model.generate(**model_inputs, **model_args)
-        output = self.tokenizer.decode(output[0], skip_special_tokens=True, **decode_args)
-        return output
+        generate_args = {'pad_token_id': self.tokenizer.pad_token_id, **model_args}
+        # Without max_new_tokens every prompt gets max_length tokens in total (its own length, not the padded one)
+        length_budget = max_new_tokens is None and 'max_length' not in model_args and 'max_new_tokens' not in model_args
+        if max_new_tokens is not None:
+            generate_args['max_new_tokens'] = max_new_tokens
+        if stop:
+            generate_args['stop_strings'] = stop
+            generate_args['tokenizer'] = self.tokenizer
+
+        outputs = []
+        for start in range(0, len(prompts), self.max_batch_size):
+            batch = prompts[start:start + self.max_batch_size]
+
+            model_inputs = self.tokenizer(batch, return_tensors="pt", padding=True, **tokenizer_args).to(self.model.device)
+
+            # Left padding shifts every prompt differently, so a prefix cache can only be reused when generating alone.
+            batch_args = generate_args
+            lengths = model_inputs['attention_mask'].sum(dim=1).tolist()
+            if length_budget:
+                # Generate for the shortest prompt's budget, the longer ones are cut to theirs below.
+                batch_args = {**generate_args, 'max_new_tokens': max(self.max_length - min(lengths), 1)}
+            if len(batch) == 1 and self.prefix_caches:
+                prefix_cache = self.find_prefix_cache(model_inputs['input_ids'][0].tolist())
+                if prefix_cache is not None:
+                    # generate() extends the cache in place, hand it a copy so the registered one stays untouched.
+                    batch_args = {**batch_args, 'past_key_values': copy.deepcopy(prefix_cache)}
+
+            with torch.no_grad():
+                generated = self.model.generate(**model_inputs, **batch_args)
+
+            prompt_length = model_inputs['input_ids'].shape[1]
+            for prompt, sequence, length in zip(batch, generated, lengths):
+                new_tokens = sequence[prompt_length:]
+                if length_budget:
+                    new_tokens = new_tokens[:max(self.max_length - length, 0)]
+                completion = self.tokenizer.decode(new_tokens, skip_special_tokens=True, **decode_args)
+                completion = self.truncate_at_stop(completion, stop)
+                outputs.append(prompt + completion if echo else completion)
+
+        return outputs
+
+    @staticmethod
+    def truncate_at_stop(text: str, stop: List[str]) -> str:
+        """Cut text at the earliest stop string (generate may overshoot by a few tokens and includes the stop)."""
+        cut = len(text)
+        for s in stop or []:
+            idx = text.find(s)
+            if idx != -1:
+                cut = min(cut, idx)
+        return text[:cut]
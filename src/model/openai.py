@@ -1,17 +1,25 @@
+import asyncio
 import os
+import math
 import itertools
 import time
-from openai import OpenAI
 
 from datetime import timedelta
 import random
 
-from typing import List, Dict, Union, Any, Generator
-from tqdm import tqdm
-from transformers import GPT2TokenizerFast
+from typing import List, Any, Generator, Callable
 
 from src.model.model import Model
-from src import cache
+from src.model.circuit_breaker import CircuitBreaker, CircuitOpenError, ModelAPIError, is_transient
+from src.model.hedging import RequestHedger
+from src.model.output_length import OutputLengthTracker
+from src.model.response import CompletionResponse
+from src import cache, telemetry
+from src.utils.telemetry import annotate, current_tags
+
+
+# Model parameters that are part of the inference cache key (see RedisCache.cached).
+INFERENCE_KEY_ATTR = 'engine,num_samples,log_probs,echo,temperature=float(0),top_p=float(1.0),stop_token,max_tokens'
 
 
 class OpenAIModel(Model):
@@ -48,7 +56,17 @@ class OpenAIModel(Model):
             echo: bool = True,
 
             prompt_cost: float = None,
-            completion_cost: float = None
+            completion_cost: float = None,
+
+            circuit_failure_threshold: int = 5,
+            circuit_reset_timeout: float = 30.0,
+
+            hedge_percentile: float = None,
+            hedge_budget: float = 0.05,
+
+            adaptive_max_tokens: bool = False,
+            adaptive_percentile: float = 99,
+            adaptive_margin: float = 1.25
 
     ):
         """
@@ -65,10 +83,22 @@ class OpenAIModel(Model):
         :param echo: (only for completion) https://platform.openai.com/docs/api-reference/completions/create#completions/create-echo
         :param prompt_cost: Pass in the current cost of the api you are calling to track costs (optional)
         :param completion_cost: Pass in the current cost of the api you are calling to track costs (optional)
+        :param circuit_failure_threshold: Consecutive failures (across all instances of this engine) before calls to the
+            engine fail fast with CircuitOpenError.  Only transient failures count (connection, timeout, rate limit,
+            5xx), other errors raise ModelAPIError right away without a retry.  All instances of an engine must use
+            the same threshold and timeout (the breaker is shared, CircuitBreaker.for_engine raises otherwise).
+        :param circuit_reset_timeout: Seconds the circuit stays open before a single probe call is let through.
+        :param hedge_percentile: If set (i.e. 95), a request still running after this percentile of the engine's
+            observed latencies is sent a second time and the first response wins (see RequestHedger).
+        :param hedge_budget: Max fraction of extra requests hedging may add (0.05 = at most 5% more requests).
+        :param adaptive_max_tokens: Cap max_tokens per caller (telemetry tags) at a percentile of the output lengths
+            observed so far (never above max_tokens).  A response cut off by the cap is retried with a larger cap.
+        :param adaptive_percentile: Percentile of observed output lengths the cap is based on.
+        :param adaptive_margin: Factor added on top of that percentile.
         """
 
         self.engine = engine
-        self.client = OpenAI()  # Initialize OpenAI client
+        self._client = None  # Created on first use (see client), importing openai is not free.
 
         self.api_max_attempts = api_max_attempts
         self.api_endpoint = api_endpoint.lower()
@@ -90,15 +120,127 @@ class OpenAIModel(Model):
         self.completion_cost = completion_cost
         self.total_cost = 0.0
 
+        self.circuit_breaker = CircuitBreaker.for_engine(
+            engine,
+            failure_threshold=circuit_failure_threshold,
+            reset_timeout=circuit_reset_timeout
+        )
+
+        self.length_tracker = None
+        if adaptive_max_tokens:
+            self.length_tracker = OutputLengthTracker.for_engine(
+                engine, length_percentile=adaptive_percentile, margin=adaptive_margin
+            )
+
+        self.hedger = None
+        if hedge_percentile is not None:
+            self.hedger = RequestHedger.for_engine(engine, hedge_percentile=hedge_percentile, budget=hedge_budget)
+
         # API key is now handled automatically by OpenAI client
 
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
     def __update_cost__(self, raw):
+        usage = getattr(raw, 'usage', None)
+        if usage is None:
+            return
+        cost = None
         if self.prompt_cost and self.completion_cost:
-            cost = raw.usage.completion_tokens * self.completion_cost + raw.usage.prompt_tokens * self.prompt_cost
+            cost = usage.completion_tokens * self.completion_cost + usage.prompt_tokens * self.prompt_cost
             self.total_cost += cost
+        annotate(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens, cost=cost)
+
+    def __record_discarded__(self, raw):
+        """
+        Cost of a losing hedged request.  It usually finishes after the caller's span was emitted, so it gets a span of
+        its own (with the caller's tags, the hedger runs this in a copy of the caller's context).
+        """
+        with telemetry.span(self.engine, method='hedge_discarded'):
+            self.__update_cost__(raw)
 
-    @cache.cached(data_ex=timedelta(days=30), no_data_ex=timedelta(hours=1), prepended_key_attr='engine,num_samples,log_probs,echo,temperature=float(0),top_p=float(1.0),stop_token,max_tokens')
-    def inference(self, prompt: str, *args, **kwargs) -> Any:
+    def __create__(self, request: Callable[[], Any]) -> Any:
+        """Send one api request, hedged when hedging is enabled (the losing duplicate's cost is still tracked)."""
+        if self.hedger is None:
+            return request()
+
+        out, info = self.hedger.call(request, on_discard=self.__record_discarded__)
+        annotate(**info)
+        return out
+
+    def __raise_permanent_error__(self, e: Exception):
+        """
+        A failure a retry can't fix (bad request, context length, auth, other 4xx).  The server answered, so for the
+        breaker it counts as a success (and closes a half open circuit).
+        """
+        self.circuit_breaker.record_success()
+        print(f"ERROR: OPENAI Request Error (not retried): {e}")
+        raise ModelAPIError(self.engine, f'request rejected: {e}', e)
+
+    def __raise_api_error__(self, last_exc: Exception):
+        """All attempts failed (or the circuit opened while retrying), raise the typed error instead of a fake response."""
+        if self.circuit_breaker.is_open:
+            raise CircuitOpenError(self.engine, f'circuit opened while retrying, last error: {last_exc}', last_exc)
+        raise ModelAPIError(self.engine, f'failed after {self.api_max_attempts} attempts, last error: {last_exc}', last_exc)
+
+    @telemetry.instrumented(model_attr='engine')
+    @cache.cached(data_ex=timedelta(days=30), no_data_ex=timedelta(hours=1), prepended_key_attr=INFERENCE_KEY_ATTR)
+    def inference(self, prompt: str, *args, **kwargs) -> CompletionResponse:
+        """
+        :return: The normalized response, read it as raw.choices[0].message.content or raw.choices[0]['message']['content'].
+        :raises ModelAPIError: When every attempt failed.
+        :raises CircuitOpenError: When the engine's circuit breaker is open (no call is made).
+        """
+        return self.__inference__(prompt, *args, **kwargs)
+
+    @telemetry.instrumented(model_attr='engine')
+    @cache.acached(
+        data_ex=timedelta(days=30),
+        no_data_ex=timedelta(hours=1),
+        prepended_key_attr=INFERENCE_KEY_ATTR,
+        key_name='OpenAIModel.inference'
+    )
+    async def ainference(self, prompt: str, *args, **kwargs) -> CompletionResponse:
+        """
+        inference for asyncio code, sharing its cache entries.  Cache I/O is awaited and a cache miss runs the api call
+        in a worker thread, so neither blocks the event loop.
+        """
+        return await asyncio.to_thread(self.__inference__, prompt, *args, **kwargs)
+
+    def __inference__(self, prompt: str, *args, **kwargs) -> CompletionResponse:
+        if self.length_tracker is None or args or kwargs.get('max_tokens') is not None:
+            out = self.__call_endpoint__(prompt, *args, **kwargs)
+            self.__update_cost__(out)
+            return out
+
+        caller = OutputLengthTracker.caller_key(current_tags())
+        max_tokens = self.length_tracker.cap(caller, self.max_tokens)
+        truncated_retries = 0
+        while True:
+            out = self.__call_endpoint__(prompt, *args, **{**kwargs, 'max_tokens': max_tokens})
+            self.__update_cost__(out)
+            if max_tokens is None or max_tokens >= self.max_tokens or not self.__truncated__(out):
+                break
+            # Cut off by the adaptive cap, ask again with more room (up to the configured max_tokens).
+            truncated_retries += 1
+            max_tokens = min(self.max_tokens, max_tokens * 2)
+        annotate(max_tokens_cap=max_tokens, truncated_retries=truncated_retries)
+
+        usage = getattr(out, 'usage', None)
+        if usage is not None and out.choices and not self.__truncated__(out):
+            self.length_tracker.record(caller, math.ceil(usage.completion_tokens / len(out.choices)))
+        return out
+
+    def __call_endpoint__(self, prompt: str, *args, **kwargs) -> CompletionResponse:
+        """Responses are normalized into a CompletionResponse, a small plain record that caches compactly."""
         if self.api_endpoint == 'completion':
             out = self.__safe_openai_completion_call__(
                 prompt,
@@ -113,9 +255,131 @@ class OpenAIModel(Model):
             )
         else:
             raise Exception(f"Unknown api endpoint for openai model: {self.api_endpoint}")
+        return CompletionResponse.from_openai(out)
+
+    @staticmethod
+    def __truncated__(out: Any) -> bool:
+        """True if any returned choice stopped because it hit max_tokens."""
+        for choice in out.choices:
+            reason = choice.get('finish_reason') if isinstance(choice, dict) else getattr(choice, 'finish_reason', None)
+            if reason == 'length':
+                return True
+        return False
+
+    @telemetry.instrumented(model_attr='engine', streamed=True)
+    def stream_inference(
+            self,
+            prompt: str,
+            system_prompt: str = None,
+            on_line: Callable[[str], bool] = None,
+            temperature: float = None,
+            top_p: float = None,
+            max_tokens: int = None,
+            stop_token: str = None,
+    ) -> str:
+        """
+        Streams a chat completion and hands every finished line to on_line as soon as it arrives.  If on_line returns
+        True the request is cancelled (the http stream is closed) and whatever text was received so far is returned.
 
-        self.__update_cost__(out)
-        return out
+        This is not cached, the partial outputs depend on when the caller decides to stop.
+
+        :param prompt: The prompt to give to the language model
+        :param system_prompt: Optional system message
+        :param on_line: Callback receiving each complete line, return True to stop the stream early.
+        :param temperature: https://platform.openai.com/docs/api-reference/chat/create#chat/create-temperature
+        :param top_p: https://platform.openai.com/docs/api-reference/chat/create#chat/create-top_p
+        :param max_tokens: https://platform.openai.com/docs/api-reference/chat/create#chat/create-max_tokens
+        :param stop_token: https://platform.openai.com/docs/api-reference/chat/create#chat/create-stop
+        :return: The text generated before the stream finished or was stopped.
+        :raises ModelAPIError: When every attempt failed before any text arrived.
+        :raises CircuitOpenError: When the engine's circuit breaker is open.
+        """
+        if self.api_endpoint != 'chat':
+            raise Exception(f"Streaming is only supported for the chat endpoint, not: {self.api_endpoint}")
+
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+        if temperature is None:
+            temperature = self.temperature
+        if top_p is None:
+            top_p = self.top_p
+        if stop_token is None:
+            stop_token = self.stop_token
+
+        messages = [{"role": "user", "content": prompt}]
+        if system_prompt:
+            messages = [{'role': 'system', 'content': system_prompt}, {"role": "user", "content": prompt}]
+
+        last_exc = None
+        for i in range(self.api_max_attempts):
+            probe = self.circuit_breaker.before_call()
+            text = ''
+            buffer = ''
+            stopped = False
+            try:
+                stream = self.client.chat.completions.create(
+                    model=self.engine,
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_tokens=max_tokens,
+                    n=1,
+                    stop=stop_token,
+                    stream=True,
+                    stream_options={'include_usage': True}
+                )
+                try:
+                    for chunk in stream:
+                        if chunk.usage is not None:
+                            self.__update_cost__(chunk)
+                        if not chunk.choices or not chunk.choices[0].delta.content:
+                            continue
+
+                        delta = chunk.choices[0].delta.content
+                        text += delta
+                        buffer += delta
+
+                        while '\n' in buffer:
+                            line, buffer = buffer.split('\n', 1)
+                            if on_line and on_line(line):
+                                stopped = True
+                                break
+                        if stopped:
+                            break
+                finally:
+                    # Closing the response cancels the generation on the server side.
+                    stream.close()
+                    annotate(retries=i, stopped_early=stopped)
+
+                self.circuit_breaker.record_success()
+                if not stopped and buffer and on_line:
+                    on_line(buffer)
+                return text
+            except Exception as e:
+                last_exc = e
+                if not is_transient(e):
+                    if text:
+                        self.circuit_breaker.record_success()
+                        print(f"ERROR: OPENAI Stream interrupted: {e}")
+                        return text
+                    self.__raise_permanent_error__(e)
+                self.circuit_breaker.record_failure()
+                if text:
+                    # Never replay lines to the caller, return what we have and let the validators decide.
+                    print(f"ERROR: OPENAI Stream interrupted: {e}")
+                    return text
+                if self.circuit_breaker.is_open:
+                    break
+                if "rate" in str(e).lower():
+                    print(f"ERROR: OPENAI Rate Error: {e}")
+                    time.sleep(self.gpt_waittime)
+                else:
+                    print(f"ERROR: OPENAI API Error: {e}")
+            finally:
+                # Every outcome above settles the probe, this only catches interrupted ones (e.g. a closed stream).
+                if probe:
+                    self.circuit_breaker.release_probe()
+        self.__raise_api_error__(last_exc)
 
     def __safe_openai_completion_call__(
             self,
@@ -126,7 +390,7 @@ class OpenAIModel(Model):
             logprobs: int = None,
             num_samples: int = None,
             echo: bool = None
-    ) -> Dict[str, Union[str, bool]]:
+    ) -> Any:
         if max_tokens is None:
             max_tokens = self.max_tokens
         if temperature is None:
@@ -142,8 +406,10 @@ class OpenAIModel(Model):
 
         last_exc = None
         for i in range(self.api_max_attempts):
+            probe = self.circuit_breaker.before_call()
+            annotate(retries=i)
             try:
-                return self.client.completions.create(
+                out = self.__create__(lambda: self.client.completions.create(
                     model=self.engine,
                     prompt=prompt,
                     temperature=temperature,
@@ -152,19 +418,26 @@ class OpenAIModel(Model):
                     n=num_samples,
                     echo=echo,
                     stop=stop_token
-                )
+                ))
+                self.circuit_breaker.record_success()
+                return out
             except Exception as e:
                 last_exc = e
+                if not is_transient(e):
+                    self.__raise_permanent_error__(e)
+                self.circuit_breaker.record_failure()
+                if self.circuit_breaker.is_open:
+                    break
                 if "rate" in str(e).lower():
                     print(f"ERROR: OPENAI Rate Error: {e}")
                     time.sleep(self.gpt_waittime + int(random.randint(1, 10)))
                 else:
                     print(f"ERROR: OPENAI API Error: {e}")
-        # make a fake response
-        return {
-                "text": prompt + " OPENAI Error - " + str(last_exc),
-                "API Error": True,
-        }
+            finally:
+                # Every outcome above settles the probe, this only catches interrupted ones (e.g. a closed stream).
+                if probe:
+                    self.circuit_breaker.release_probe()
+        self.__raise_api_error__(last_exc)
 
     def __safe_openai_chat_call__(
             self,
@@ -175,7 +448,7 @@ class OpenAIModel(Model):
             max_tokens: int = None,
             stop_token: str = None,
             num_samples: int = None,
-    ) -> Dict[str, Union[str, bool]]:
+    ) -> Any:
         if max_tokens is None:
             max_tokens = self.max_tokens
         if temperature is None:
@@ -189,6 +462,8 @@ class OpenAIModel(Model):
 
         last_exc = None
         for i in range(self.api_max_attempts):
+            probe = self.circuit_breaker.before_call()
+            annotate(retries=i)
             try:
                 # TODO - look at different roles?
                 messages = [
@@ -198,7 +473,7 @@ class OpenAIModel(Model):
                 if system_prompt:
                     messages = [{'role': 'system', 'content': system_prompt}, {"role": "user", "content": prompt}]
 
-                return self.client.chat.completions.create(
+                out = self.__create__(lambda: self.client.chat.completions.create(
                     model=self.engine,
                     messages=messages,
                     temperature=temperature,
@@ -206,9 +481,16 @@ class OpenAIModel(Model):
                     max_tokens=max_tokens,
                     n=num_samples,
                     stop=stop_token
-                )
+                ))
+                self.circuit_breaker.record_success()
+                return out
             except Exception as e:
                 last_exc = e
+                if not is_transient(e):
+                    self.__raise_permanent_error__(e)
+                self.circuit_breaker.record_failure()
+                if self.circuit_breaker.is_open:
+                    break
                 if "rate" in str(e).lower():
                     print(f"ERROR: OPENAI Rate Error: {e}")
                     time.sleep(self.gpt_waittime)
@@ -218,8 +500,8 @@ class OpenAIModel(Model):
                     print(f"ERROR: OPENAI Connection Error: {e}")
                 else:
                     print(f"ERROR: OPENAI API Error: {e}")
-        # make a fake response
-        return {
-            "text": prompt + " OPENAI Error - " + str(last_exc),
-            "API Error": True,
-        }
+            finally:
+                # Every outcome above settles the probe, this only catches interrupted ones (e.g. a closed stream).
+                if probe:
+                    self.circuit_breaker.release_probe()
+        self.__raise_api_error__(last_exc)
@@ -0,0 +1,65 @@
+import math
+import threading
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from src.utils.telemetry import percentile
+
+
+class OutputLengthTracker:
+    """
+    Tracks how many tokens responses actually use, per caller (the telemetry tags active at call time, i.e. asset_key
+    or validator), and turns that into a max_tokens cap: the p-th percentile of recent output lengths times a margin.
+
+    Trackers are shared per engine (see for_engine) so every instance of a model learns from the same calls.
+    """
+
+    _registry: Dict[str, 'OutputLengthTracker'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+            self,
+            length_percentile: float = 99,
+            margin: float = 1.25,
+            min_samples: int = 20,
+            window: int = 500,
+            min_cap: int = 32,
+    ):
+        """
+        :param length_percentile: Percentile of observed output lengths the cap is based on.
+        :param margin: Factor added on top of the percentile.
+        :param min_samples: Outputs to observe for a caller before it gets capped.
+        :param window: Most recent output lengths kept per caller.
+        :param min_cap: Never cap below this many tokens.
+        """
+        self.length_percentile = length_percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.window = window
+        self.min_cap = min_cap
+
+        self.lengths: Dict[Tuple, deque] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_engine(cls, engine: str, **kwargs) -> 'OutputLengthTracker':
+        with cls._registry_lock:
+            if engine not in cls._registry:
+                cls._registry[engine] = cls(**kwargs)
+            return cls._registry[engine]
+
+    @staticmethod
+    def caller_key(tags: Dict[str, str]) -> Tuple:
+        return tuple(sorted(tags.items()))
+
+    def record(self, key: Tuple, tokens: int):
+        with self.lock:
+            self.lengths.setdefault(key, deque(maxlen=self.window)).append(tokens)
+
+    def cap(self, key: Tuple, ceiling: int) -> Optional[int]:
+        """max_tokens to request for this caller (never above ceiling), None while there are too few samples."""
+        with self.lock:
+            lengths = list(self.lengths.get(key, ()))
+        if len(lengths) < self.min_samples:
+            return None
+        return min(ceiling, max(self.min_cap, math.ceil(percentile(lengths, self.length_percentile) * self.margin)))
@@ -0,0 +1,72 @@
+from typing import Any, Dict
+
+
+class Record(dict):
+    """A dict whose keys can also be read as attributes (record.choices[0].message.content == record['choices'][0]['message']['content'])."""
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @classmethod
+    def wrap(cls, value: Any) -> Any:
+        if isinstance(value, dict):
+            return Record({k: cls.wrap(v) for k, v in value.items()})
+        if isinstance(value, (list, tuple)):
+            return [cls.wrap(v) for v in value]
+        return value
+
+
+class CompletionResponse(Record):
+    """
+    The parts of an OpenAI (chat) completion response this repo uses, as a small versioned plain record: model,
+    choices (message / text, finish_reason, logprobs for the completion endpoint) and usage.
+
+    Supports both access styles used around the repo (raw.choices[0].message.content and
+    raw.choices[0]['message']['content']) and, being plain data, survives openai library upgrades in the cache.
+    """
+
+    VERSION = 1
+
+    @classmethod
+    def from_openai(cls, raw: Any) -> 'CompletionResponse':
+        """Normalize an SDK response object (pydantic model in openai>=1, dict like before)."""
+        if isinstance(raw, CompletionResponse):
+            return raw
+        data = raw.model_dump() if hasattr(raw, 'model_dump') else dict(raw)
+
+        choices = []
+        for idx, choice in enumerate(data.get('choices') or []):
+            choice = dict(choice)
+            normalized: Dict[str, Any] = {
+                'index': choice.get('index', idx),
+                'finish_reason': choice.get('finish_reason'),
+            }
+            if choice.get('message') is not None:
+                message = dict(choice['message'])
+                normalized['message'] = {'role': message.get('role', 'assistant'), 'content': message.get('content')}
+            if choice.get('text') is not None:
+                normalized['text'] = choice['text']
+            if choice.get('logprobs') is not None:
+                normalized['logprobs'] = choice['logprobs']
+            choices.append(normalized)
+
+        usage = data.get('usage')
+        if usage is not None:
+            usage = dict(usage)
+            usage = {
+                'prompt_tokens': usage.get('prompt_tokens') or 0,
+                'completion_tokens': usage.get('completion_tokens') or 0,
+                'total_tokens': usage.get('total_tokens') or 0,
+            }
+
+        return cls.from_record({'v': cls.VERSION, 'model': data.get('model'), 'choices': choices, 'usage': usage})
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> 'CompletionResponse':
+        return cls({k: Record.wrap(v) for k, v in record.items()})
+
+    def to_record(self) -> Dict[str, Any]:
+        return dict(self)
@@ -0,0 +1,307 @@
+"""
+Picks the model for each generation / validation step from a routing policy.
+
+Every step has a ladder of engines ordered from cheapest to strongest.  A step starts on the cheapest engine whose
+observed pass rate, p95 latency and cost per call stay within the step's targets, and climbs one rung after every
+`escalate_after` failed attempts.  Outcomes are recorded per (step, engine), so report() shows which cheap models
+actually hold up on which steps, and can be saved to and loaded from a json file across runs.
+
+The default policy uses the same engines as the unrouted pipeline (gpt-4 for every generation step, gpt-3.5-turbo only
+as the purity validation early escape) with fixed max_tokens.  Cheaper rungs (routing_policy(cheap_rungs=True)) only
+become the starting engine once enough saved outcomes show they meet the step's targets, or with explore=True, which
+tries engines without enough outcomes to collect them.
+"""
+
+import json
+import threading
+from copy import deepcopy
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from src.model.model import Model
+from src.utils.paths import ROOT_FOLDER
+from src.utils.telemetry import percentile
+
+
+class RouteStep:
+    L1_L2 = 'l1_l2'
+    L2_L3 = 'l2_l3'
+    STORY = 'story'
+    PURITY_VALIDATION = 'purity_validation'
+    EVAL = 'eval'
+
+
+# Engine -> price per token (dollars).
+DEFAULT_MODEL_CATALOG: Dict[str, Dict[str, float]] = {
+    'gpt-4': {'prompt_cost': 0.03 / 1000, 'completion_cost': 0.06 / 1000},
+    'gpt-3.5-turbo': {'prompt_cost': 0.0015 / 1000, 'completion_cost': 0.002 / 1000},
+    'gpt-3.5-turbo-16k': {'prompt_cost': 0.003 / 1000, 'completion_cost': 0.004 / 1000},
+}
+
+# Step -> routing policy.
+#   models: engines from cheapest to strongest (for validation the cheapest is the early escape model, the strongest
+#       the main model).
+#   latency_target_s / cost_target: an engine whose observed p95 latency / mean cost per call is above these is skipped
+#       as the starting engine (None = no target).
+#   min_pass_rate: an engine passing less often than this is skipped as the starting engine.
+#   adaptive_max_tokens: cap max_tokens of the router's OpenAIModels at the observed output lengths (max_tokens stays
+#       the ceiling, crew agents always use max_tokens).  Off in the default policy, see routing_policy.
+DEFAULT_ROUTING_POLICY: Dict[str, Dict[str, Any]] = {
+    RouteStep.L1_L2: {
+        'models': ['gpt-4'],
+        'temperature': 1.0,
+        'max_tokens': 500,
+        'latency_target_s': 30.0,
+        'cost_target': 0.05,
+        'min_pass_rate': 0.5,
+        'adaptive_max_tokens': False,
+    },
+    RouteStep.L2_L3: {
+        'models': ['gpt-4'],
+        'temperature': 1.0,
+        'max_tokens': 500,
+        'latency_target_s': 30.0,
+        'cost_target': 0.05,
+        'min_pass_rate': 0.5,
+        'adaptive_max_tokens': False,
+    },
+    RouteStep.STORY: {
+        'models': ['gpt-4'],
+        'temperature': 1.0,
+        'max_tokens': 2400,
+        'latency_target_s': 120.0,
+        'cost_target': None,
+        'min_pass_rate': 0.0,
+        'adaptive_max_tokens': False,
+    },
+    RouteStep.PURITY_VALIDATION: {
+        'models': ['gpt-3.5-turbo', 'gpt-4'],
+        'temperature': 0.0,
+        'max_tokens': 500,
+        'latency_target_s': 20.0,
+        'cost_target': 0.03,
+        'min_pass_rate': 0.0,
+        'adaptive_max_tokens': False,
+    },
+    RouteStep.EVAL: {
+        'models': ['gpt-4'],
+        'temperature': 1.0,
+        'max_tokens': 2400,
+        'latency_target_s': None,
+        'cost_target': None,
+        'min_pass_rate': 0.0,
+        'adaptive_max_tokens': False,
+    },
+}
+
+# Step -> engines tried below the default ladder with routing_policy(cheap_rungs=True).
+CHEAP_RUNGS: Dict[str, List[str]] = {
+    RouteStep.L2_L3: ['gpt-3.5-turbo'],
+}
+
+# Steps whose max_tokens is capped with routing_policy(adaptive_max_tokens=True).  Not eval (or story), whose long
+# reasoning outputs must not be cut below the baseline max_tokens.
+ADAPTIVE_MAX_TOKENS_STEPS = (RouteStep.L1_L2, RouteStep.L2_L3, RouteStep.PURITY_VALIDATION)
+
+DEFAULT_OUTCOMES_PATH = ROOT_FOLDER / '.cache' / 'router_outcomes.json'
+
+
+def routing_policy(cheap_rungs: bool = False, adaptive_max_tokens: bool = False) -> Dict[str, Dict[str, Any]]:
+    """
+    A copy of DEFAULT_ROUTING_POLICY with the opt-in changes.
+
+    :param cheap_rungs: Put the CHEAP_RUNGS engines below each step's ladder.
+    :param adaptive_max_tokens: Cap max_tokens at the observed output lengths for ADAPTIVE_MAX_TOKENS_STEPS.
+    """
+    policy = deepcopy(DEFAULT_ROUTING_POLICY)
+    if cheap_rungs:
+        for step, engines in CHEAP_RUNGS.items():
+            policy[step]['models'] = [e for e in engines if e not in policy[step]['models']] + policy[step]['models']
+    if adaptive_max_tokens:
+        for step in ADAPTIVE_MAX_TOKENS_STEPS:
+            policy[step]['adaptive_max_tokens'] = True
+    return policy
+
+
+class ModelRouter:
+    """
+    Example:
+        router = ModelRouter()
+        for attempt in range(4):
+            engine = router.engine_for(RouteStep.L2_L3, failures=attempt)
+            ...
+            router.record(RouteStep.L2_L3, engine, passed=valid, latency_s=latency)
+    """
+
+    def __init__(
+            self,
+            policy: Dict[str, Dict[str, Any]] = None,
+            catalog: Dict[str, Dict[str, float]] = None,
+            escalate_after: int = 1,
+            min_samples: int = 10,
+            api_max_attempts: int = 30,
+            explore: bool = False,
+            outcomes_path: Union[str, Path] = None,
+    ):
+        """
+        :param policy: Step -> routing policy (see DEFAULT_ROUTING_POLICY).
+        :param catalog: Engine -> prompt_cost / completion_cost (see DEFAULT_MODEL_CATALOG).
+        :param escalate_after: Failed attempts on one engine before moving up a rung.
+        :param min_samples: Outcomes recorded for an engine before its pass rate / latency / cost is trusted.
+        :param api_max_attempts: Passed to every OpenAIModel the router builds.
+        :param explore: Start on engines with fewer than min_samples outcomes (to collect them).  Without it, a cheaper
+            rung only becomes the starting engine once its outcomes show it meets the step's targets.
+        :param outcomes_path: Json file the outcomes of earlier runs are loaded from (if it exists) and save() writes.
+        """
+        self.policy = policy if policy is not None else DEFAULT_ROUTING_POLICY
+        self.catalog = catalog if catalog is not None else DEFAULT_MODEL_CATALOG
+        self.escalate_after = max(1, escalate_after)
+        self.min_samples = min_samples
+        self.api_max_attempts = api_max_attempts
+        self.explore = explore
+        self.outcomes_path = Path(outcomes_path) if outcomes_path else None
+
+        # (step, engine) -> {'attempts', 'passed', 'latency_s': [...], 'cost': float, 'costed': int}
+        self.outcomes: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.models: Dict[Tuple[str, float, int, bool], Model] = {}
+        self.lock = threading.Lock()
+        if self.outcomes_path is not None and self.outcomes_path.exists():
+            self.load(self.outcomes_path)
+
+    def step_policy(self, step: str) -> Dict[str, Any]:
+        if step not in self.policy:
+            raise KeyError(f"No routing policy for step: {step} (known: {', '.join(sorted(self.policy))})")
+        return self.policy[step]
+
+    def within_targets(self, step: str, engine: str, untried: bool = None) -> bool:
+        """
+        Whether the engine's outcomes meet the step's pass rate, latency and cost targets.
+
+        :param untried: Returned for an engine with fewer than min_samples outcomes (default: explore).
+        """
+        policy = self.step_policy(step)
+        with self.lock:
+            stats = self.outcomes.get((step, engine))
+            if stats is None or stats['attempts'] < self.min_samples:
+                return self.explore if untried is None else untried
+
+            if stats['passed'] / stats['attempts'] < policy.get('min_pass_rate', 0.0):
+                return False
+            latency_target = policy.get('latency_target_s')
+            if latency_target is not None and stats['latency_s'] and percentile(stats['latency_s'], 95) > latency_target:
+                return False
+            cost_target = policy.get('cost_target')
+            if cost_target is not None and stats['costed'] and stats['cost'] / stats['costed'] > cost_target:
+                return False
+        return True
+
+    def engine_for(self, step: str, failures: int = 0) -> str:
+        """
+        Engine for the next attempt at step.
+
+        :param step: One of RouteStep.
+        :param failures: Failed attempts so far (validator rejections / errors) for the current item.
+        """
+        ladder = self.step_policy(step)['models']
+        start = next((i for i, engine in enumerate(ladder[:-1]) if self.within_targets(step, engine)), len(ladder) - 1)
+        return ladder[min(start + failures // self.escalate_after, len(ladder) - 1)]
+
+    def build_model(self, engine: str, temperature: float, max_tokens: int, adaptive_max_tokens: bool = False) -> Model:
+        from src.model import get_backend
+
+        costs = self.catalog.get(engine, {})
+        return get_backend('OpenAIModel')(
+            engine=engine,
+            api_max_attempts=self.api_max_attempts,
+            api_endpoint='chat',
+            temperature=temperature,
+            max_tokens=max_tokens,
+            num_samples=1,
+            prompt_cost=costs.get('prompt_cost'),
+            completion_cost=costs.get('completion_cost'),
+            adaptive_max_tokens=adaptive_max_tokens
+        )
+
+    def model_for(self, step: str, failures: int = 0, engine: str = None) -> Model:
+        """Model instance (shared per engine/temperature/max_tokens) for the next attempt at step."""
+        policy = self.step_policy(step)
+        engine = engine or self.engine_for(step, failures)
+        key = (engine, policy.get('temperature', 1.0), policy.get('max_tokens', 500), policy.get('adaptive_max_tokens', False))
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = self.build_model(*key)
+            return self.models[key]
+
+    def validator_models(self, step: str = RouteStep.PURITY_VALIDATION) -> Tuple[Model, Optional[Model]]:
+        """
+        (main model, early escape model) for a validation step.  The early escape is the cheapest rung unless its
+        outcomes show it misses the targets, None for single rung ladders.
+        """
+        ladder = self.step_policy(step)['models']
+        main = self.model_for(step, engine=ladder[-1])
+        cheapest = next((engine for engine in ladder[:-1] if self.within_targets(step, engine, untried=True)), None)
+        early_escape = self.model_for(step, engine=cheapest) if cheapest is not None else None
+        return main, early_escape
+
+    def record(self, step: str, engine: str, passed: bool, latency_s: float = None, cost: float = None):
+        """Record the outcome of one attempt at step on engine."""
+        with self.lock:
+            stats = self.outcomes.setdefault((step, engine), {'attempts': 0, 'passed': 0, 'latency_s': [], 'cost': 0.0, 'costed': 0})
+            stats['attempts'] += 1
+            stats['passed'] += 1 if passed else 0
+            if latency_s is not None:
+                stats['latency_s'].append(latency_s)
+            if cost is not None:
+                stats['cost'] += cost
+                stats['costed'] += 1
+
+    def save(self, path: Union[str, Path] = None, max_latencies: int = 1000):
+        """Write the outcomes to path (default: outcomes_path), keeping the last max_latencies latencies per engine."""
+        path = Path(path) if path else self.outcomes_path
+        if path is None:
+            return
+        with self.lock:
+            rows = [
+                {'step': step, 'engine': engine, **stats, 'latency_s': stats['latency_s'][-max_latencies:]}
+                for (step, engine), stats in sorted(self.outcomes.items())
+            ]
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path.write_text(json.dumps(rows), encoding='utf-8')
+
+    def load(self, path: Union[str, Path]):
+        """Add the outcomes saved in path to the recorded ones."""
+        for row in json.loads(Path(path).read_text(encoding='utf-8')):
+            with self.lock:
+                stats = self.outcomes.setdefault((row['step'], row['engine']), {'attempts': 0, 'passed': 0, 'latency_s': [], 'cost': 0.0, 'costed': 0})
+                for name in ('attempts', 'passed', 'cost', 'costed'):
+                    stats[name] += row.get(name, 0)
+                stats['latency_s'].extend(row.get('latency_s', []))
+
+    def summary(self) -> List[Dict[str, Any]]:
+        rows = []
+        with self.lock:
+            for (step, engine), stats in sorted(self.outcomes.items()):
+                rows.append({
+                    'step': step,
+                    'engine': engine,
+                    'attempts': stats['attempts'],
+                    'pass_rate': stats['passed'] / stats['attempts'] if stats['attempts'] else None,
+                    'latency_p50_s': percentile(stats['latency_s'], 50),
+                    'latency_p95_s': percentile(stats['latency_s'], 95),
+                    'cost_per_call': stats['cost'] / stats['costed'] if stats['costed'] else None,
+                })
+        return rows
+
+    def report(self) -> str:
+        """Human readable pass rate / latency / cost table per step and engine."""
+        lines = [f'{"step":<18} {"engine":<22} {"attempts":>8} {"pass%":>6} {"p50 s":>7} {"p95 s":>7} {"$/call":>8}']
+        for row in self.summary():
+            def fmt(value, spec):
+                return format(value, spec) if value is not None else '-'
+            lines.append(
+                f'{row["step"]:<18} {row["engine"][:22]:<22} {row["attempts"]:>8} '
+                f'{fmt(row["pass_rate"] * 100 if row["pass_rate"] is not None else None, ">6.0f"):>6} '
+                f'{fmt(row["latency_p50_s"], ">7.2f"):>7} {fmt(row["latency_p95_s"], ">7.2f"):>7} '
+                f'{fmt(row["cost_per_call"], ">8.4f"):>8}'
+            )
+        return '\n'.join(lines)
@@ -0,0 +1,328 @@
+"""
+Inspect and prune the response cache without flushing it.
+
+  python -m src.utils.cache stats
+  python -m src.utils.cache ls --engine gpt-4 --older-than 7d --limit 20
+  python -m src.utils.cache evict --engine gpt-4 --older-than 7d [--dry-run]
+  python -m src.utils.cache gc [--namespace generation]
+  python -m src.utils.cache export snapshot.jsonl.gz --namespace eval [--engine gpt-4] [--keys-file keys.txt]
+  python -m src.utils.cache import snapshot.jsonl.gz [--ttl 30d]
+
+Keys are walked incrementally (SCAN on redis, keyset pages on sqlite), so this is safe to run against a live cache.
+Use --backend / --path (or MUSR_CACHE_BACKEND / MUSR_CACHE_PATH) to pick the cache like the generation scripts do.
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import re
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from src.utils import cache_codec
+from src.utils.redis_cache import EPOCH_PREFIX, KEY_VERSION, RedisCache
+
+
+AGE_BUCKETS = [('<1d', 86400), ('1-7d', 7 * 86400), ('7-30d', 30 * 86400), ('>30d', float('inf'))]
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_duration(text: str) -> float:
+    """'90s', '30m', '12h', '7d', '2w' -> seconds."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhdw])\s*', text)
+    if not match:
+        raise argparse.ArgumentTypeError(f'Invalid duration: {text} (use e.g. 30m, 12h, 7d)')
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def parse_key(key: str) -> Dict[str, Optional[str]]:
+    """
+    Split a key (ns:eval:0|v2|OpenAIModel.inference|engine=gpt-4,...|digest[.sample]) into its namespace, epoch,
+    function, engine and parameters.  Keys from other layouts give None fields.
+    """
+    parsed = {'namespace': None, 'epoch': None, 'function': None, 'engine': None, 'params': None}
+    parts = key.split('|', 3)
+    if len(parts) < 4 or not parts[0].startswith('ns:') or '|' not in parts[3]:
+        return parsed
+    parsed['namespace'], _, parsed['epoch'] = parts[0][len('ns:'):].rpartition(':')
+    parsed['function'] = parts[2]
+    parsed['params'] = parts[3].rsplit('|', 1)[0]
+    for param in parsed['params'].split(','):
+        if param.startswith('engine='):
+            parsed['engine'] = param[len('engine='):]
+            break
+    return parsed
+
+
+def matching_entries(
+        cache: RedisCache,
+        engine: str = None,
+        function: str = None,
+        older_than: float = None,
+        namespace: str = None,
+        keys: Set[str] = None
+) -> Iterator[Tuple[str, bytes, Dict[str, Optional[str]], Optional[float]]]:
+    """(key, payload, parsed key, age in seconds or None) for every entry passing the filters."""
+    now = time.time()
+    if keys is not None:
+        entries = fetch_entries(cache, sorted(keys))
+    else:
+        entries = cache.iter_entries(f'ns:{namespace or "*"}:*|{KEY_VERSION}|*')
+    for key, payload in entries:
+        parsed = parse_key(key)
+        if namespace is not None and parsed['namespace'] != namespace:
+            continue
+        if engine is not None and parsed['engine'] != engine:
+            continue
+        if function is not None and parsed['function'] != function:
+            continue
+        created_at = cache_codec.created_at(payload)
+        age = now - created_at if created_at is not None else None
+        if older_than is not None and (age is None or age < older_than):
+            continue
+        yield key, payload, parsed, age
+
+
+def fetch_entries(cache: RedisCache, keys: List[str], batch: int = 500) -> Iterator[Tuple[str, bytes]]:
+    for start in range(0, len(keys), batch):
+        chunk = keys[start:start + batch]
+        yield from ((k, p) for k, p in zip(chunk, cache.backend.mget(chunk)) if p is not None)
+
+
+def age_bucket(age: Optional[float]) -> str:
+    if age is None:
+        return 'unknown'
+    for name, limit in AGE_BUCKETS:
+        if age < limit:
+            return name
+
+
+def format_bytes(n: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+
+
+def cmd_stats(cache: RedisCache, args):
+    counters = cache.persisted_stats()
+    print(f'{"function":<40} {"hits":>8} {"misses":>8} {"hit rate":>8} {"saved $":>10}')
+    for name, c in sorted(counters.items()):
+        hit_rate = f'{c["hit_rate"]:.1%}' if c['hit_rate'] is not None else '-'
+        print(f'{name:<40} {c["hits"]:>8} {c["misses"]:>8} {hit_rate:>8} {c["saved_usd"]:>10.2f}')
+
+    entries = defaultdict(int)
+    size = defaultdict(int)
+    ages = defaultdict(lambda: defaultdict(int))
+    for key, payload, parsed, age in matching_entries(
+            cache, args.engine, args.function, args.older_than, args.namespace
+    ):
+        group = f"{parsed['namespace']}:{parsed['epoch']}/{parsed['engine'] or parsed['function']}"
+        entries[group] += 1
+        size[group] += len(payload)
+        ages[group][age_bucket(age)] += 1
+
+    buckets = [name for name, _ in AGE_BUCKETS] + ['unknown']
+    print(f'\n{"namespace:epoch/engine":<32} {"entries":>8} {"bytes":>10} ' + ' '.join(f'{b:>7}' for b in buckets))
+    for group in sorted(entries):
+        print(
+            f'{group:<32} {entries[group]:>8} {format_bytes(size[group]):>10} ' +
+            ' '.join(f'{ages[group][b]:>7}' for b in buckets)
+        )
+    print(f'\n{sum(entries.values())} entries, {format_bytes(sum(size.values()))} on {cache.backend.name}')
+
+
+def cmd_ls(cache: RedisCache, args):
+    for n, (key, payload, parsed, age) in enumerate(
+            matching_entries(cache, args.engine, args.function, args.older_than, args.namespace)
+    ):
+        if args.limit is not None and n >= args.limit:
+            break
+        age_text = f'{age / 86400:.1f}d' if age is not None else '-'
+        print(f'{format_bytes(len(payload)):>10} {age_text:>7}  {key}')
+
+
+def cmd_evict(cache: RedisCache, args):
+    if args.engine is None and args.function is None and args.older_than is None and args.namespace is None:
+        raise SystemExit('Refusing to evict everything, give --namespace, --engine, --function and/or --older-than.')
+
+    evicted = 0
+    freed = 0
+    batch = []
+    for key, payload, _, _ in matching_entries(cache, args.engine, args.function, args.older_than, args.namespace):
+        evicted += 1
+        freed += len(payload)
+        if args.dry_run:
+            continue
+        batch.append(key)
+        if len(batch) >= 500:
+            cache.delete(*batch)
+            batch = []
+    if batch:
+        cache.delete(*batch)
+    print(f'{"Would evict" if args.dry_run else "Evicted"} {evicted} entries ({format_bytes(freed)}).')
+
+
+def cmd_gc(cache: RedisCache, args):
+    """Remove the entries of every epoch before the current one, in one namespace or all of them."""
+    if args.namespace is not None:
+        namespaces = [args.namespace]
+    else:
+        namespaces = [key[len(EPOCH_PREFIX):] for key in cache.backend.scan(f'{EPOCH_PREFIX}*')]
+    for namespace in namespaces:
+        epoch = cache.use_namespace(namespace, gc=False)
+        removed = cache.collect_old_epochs(namespace, epoch)
+        print(f'{namespace}: epoch {epoch}, removed {removed} entries of older epochs.')
+
+
+SNAPSHOT_FORMAT = 'musr-cache-snapshot'
+SNAPSHOT_VERSION = 1
+
+
+def export_snapshot(
+        cache: RedisCache,
+        path: str,
+        engine: str = None,
+        function: str = None,
+        namespace: str = None,
+        keys: Set[str] = None,
+        all_epochs: bool = False,
+        older_than: float = None
+) -> int:
+    """
+    Write matching entries to a gzip compressed JSONL file: a header line, then one {key, payload} line per entry with
+    the payload (as stored, base64) so created_at and the compression survive.  Only the current epoch of each
+    namespace is exported unless all_epochs is set.
+
+    :return: Number of entries written.
+    """
+    epochs: Dict[str, int] = {}
+    written = 0
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        header = {
+            'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION, 'key_version': KEY_VERSION, 'created_at': time.time()
+        }
+        f.write(json.dumps(header) + '\n')
+        for key, payload, parsed, _ in matching_entries(cache, engine, function, older_than, namespace, keys):
+            if not all_epochs and keys is None:
+                if parsed['namespace'] not in epochs:
+                    epochs[parsed['namespace']] = cache.current_epoch(parsed['namespace'])
+                if parsed['epoch'] != str(epochs[parsed['namespace']]):
+                    continue
+            f.write(json.dumps({'key': key, 'payload': base64.b64encode(payload).decode('ascii')}) + '\n')
+            written += 1
+    return written
+
+
+def import_snapshot(cache: RedisCache, path: str, ttl: float = None, keep_epochs: bool = False, batch: int = 500) -> int:
+    """
+    Load a snapshot into the cache's backend.  Entries are moved to the current epoch of their namespace in this
+    backend (so they are found by the next run) unless keep_epochs is set.
+
+    :param ttl: Expiry of the imported entries in seconds, None keeps them forever.
+    :return: Number of entries imported.
+    """
+    epochs: Dict[str, int] = {}
+    imported = 0
+    items = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != SNAPSHOT_FORMAT or header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f'{path} is not a cache snapshot (or from an unknown version): {header}')
+        for line in f:
+            record = json.loads(line)
+            key = record['key']
+            parsed = parse_key(key)
+            if not keep_epochs and parsed['namespace'] is not None:
+                if parsed['namespace'] not in epochs:
+                    epochs[parsed['namespace']] = cache.current_epoch(parsed['namespace'])
+                key = f'ns:{parsed["namespace"]}:{epochs[parsed["namespace"]]}|{key.split("|", 1)[1]}'
+            items.append((key, base64.b64decode(record['payload']), ttl))
+            if len(items) >= batch:
+                cache.backend.set_many(items)
+                imported += len(items)
+                items = []
+    if items:
+        cache.backend.set_many(items)
+        imported += len(items)
+    return imported
+
+
+def read_keys_file(path: Optional[str]) -> Optional[Set[str]]:
+    if path is None:
+        return None
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def cmd_export(cache: RedisCache, args):
+    written = export_snapshot(
+        cache,
+        args.file,
+        engine=args.engine,
+        function=args.function,
+        namespace=args.namespace,
+        keys=read_keys_file(args.keys_file),
+        all_epochs=args.all_epochs,
+        older_than=args.older_than
+    )
+    print(f'Exported {written} entries to {args.file}.')
+
+
+def cmd_import(cache: RedisCache, args):
+    imported = import_snapshot(cache, args.file, args.ttl, args.keep_epochs)
+    print(f'Imported {imported} entries into {cache.backend.name}.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and prune the response cache')
+    parser.add_argument('--backend', choices=['auto', 'redis', 'sqlite'], default=None)
+    parser.add_argument('--path', default=None, help='SQLite cache file')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument('--namespace', default=None, help='Only entries of this namespace (any epoch)')
+    filters.add_argument('--engine', default=None, help='Only entries of this engine (e.g. gpt-4)')
+    filters.add_argument('--function', default=None, help='Only entries of this function (e.g. OpenAIModel.inference)')
+    filters.add_argument('--older-than', type=parse_duration, default=None, help='Only entries older than this (e.g. 7d)')
+
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', parents=[filters], help='Hit rates, saved spend, bytes and ages per engine')
+    ls = commands.add_parser('ls', parents=[filters], help='List matching keys with size and age')
+    ls.add_argument('--limit', type=int, default=None)
+    evict = commands.add_parser('evict', parents=[filters], help='Delete matching entries')
+    evict.add_argument('--dry-run', action='store_true')
+    gc = commands.add_parser('gc', help='Remove entries of old epochs')
+    gc.add_argument('--namespace', default=None, help='Only this namespace (default: every namespace with an epoch)')
+    export = commands.add_parser('export', parents=[filters], help='Write matching entries to a snapshot file')
+    export.add_argument('file', help='Snapshot to write (gzip compressed JSONL)')
+    export.add_argument('--keys-file', default=None, help='Only these keys, one per line (see MUSR_CACHE_KEYS_OUT)')
+    export.add_argument('--all-epochs', action='store_true', help='Also export entries of old epochs')
+    load = commands.add_parser('import', help='Load a snapshot file into the cache')
+    load.add_argument('file', help='Snapshot to read')
+    load.add_argument('--ttl', type=parse_duration, default=None, help='Expire the imported entries after this')
+    load.add_argument('--keep-epochs', action='store_true', help='Keep the epochs of the keys as exported')
+    args = parser.parse_args()
+
+    cache = RedisCache(host=args.host, port=args.port, db=args.db, backend=args.backend, path=args.path)
+    if cache.disabled:
+        raise SystemExit('No cache backend available.')
+
+    handlers = {
+        'stats': cmd_stats,
+        'ls': cmd_ls,
+        'evict': cmd_evict,
+        'gc': cmd_gc,
+        'export': cmd_export,
+        'import': cmd_import,
+    }
+    handlers[args.command](cache, args)
+
+
+if __name__ == '__main__':
+    main()
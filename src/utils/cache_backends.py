@@ -0,0 +1,362 @@
+"""
+Storage backends for RedisCache.  The cache decorator only needs raw byte payloads by key with an optional expiry, so
+anything that can do that (and a handful of bulk/maintenance operations) can sit behind it.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from src.utils.memory_cache import to_seconds
+
+
+Expiry = Union[None, int, float, timedelta]
+
+
+class CacheBackend:
+    """Byte payloads by string key, with optional per key expiry (seconds or timedelta, None = forever)."""
+
+    name: str = 'backend'
+
+    def ping(self):
+        """Raise if the backend can't be reached."""
+        raise NotImplementedError()
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self.get(key) for key in keys]
+
+    def set(self, key: str, payload: bytes, ex: Expiry = None):
+        raise NotImplementedError()
+
+    def set_many(self, items: List[Tuple[str, bytes, Expiry]]):
+        for key, payload, ex in items:
+            self.set(key, payload, ex)
+
+    def delete(self, *keys: str):
+        raise NotImplementedError()
+
+    def unlink(self, *keys: str):
+        """Delete without blocking other clients on large values (frees memory in the background where supported)."""
+        self.delete(*keys)
+
+    def incr(self, key: str, amount: int = 1, ex: Expiry = None) -> int:
+        """Atomically add amount to an integer counter (created at 0), optionally (re)setting its expiry."""
+        raise NotImplementedError()
+
+    def scan(self, match: str = '*', count: int = 1000) -> Iterator[str]:
+        """Iterate over (unexpired) keys matching a glob pattern without loading them all at once."""
+        raise NotImplementedError()
+
+    def flush(self):
+        """Drop every key."""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def async_backend(self) -> 'AsyncCacheBackend':
+        """An async view of this backend for the async cache decorator."""
+        return ThreadedAsyncBackend(self)
+
+
+class RedisBackend(CacheBackend):
+    """Redis through a shared, health checked connection pool."""
+
+    name = 'redis'
+
+    def __init__(
+            self,
+            host: str = 'localhost',
+            port: int = 6379,
+            db: int = 0,
+            max_connections: int = 64,
+            health_check_interval: int = 30,
+            socket_timeout: float = 30.0,
+            socket_connect_timeout: float = 5.0,
+    ):
+        """
+        :param max_connections: Size of the connection pool (shared by all threads).
+        :param health_check_interval: Seconds a pooled connection may sit idle before it is checked with a PING.
+        :param socket_timeout: Seconds to wait on a reply.
+        :param socket_connect_timeout: Seconds to wait for a connection.
+        """
+        # Only pay for the redis client when the redis backend is actually used.
+        import redis
+
+        pool = redis.ConnectionPool(
+            host=host,
+            port=port,
+            db=db,
+            max_connections=max_connections,
+            health_check_interval=health_check_interval,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_connect_timeout
+        )
+        self.client = redis.StrictRedis(connection_pool=pool)
+        # For AsyncRedisBackend, an asyncio pool can't be shared with this one (nor between event loops).
+        self.connection_kwargs = pool.connection_kwargs
+        self.max_connections = max_connections
+
+    def async_backend(self) -> 'AsyncCacheBackend':
+        try:
+            return AsyncRedisBackend({**self.connection_kwargs, 'max_connections': self.max_connections})
+        except ImportError:
+            # redis-py without redis.asyncio (< 4.2)
+            return ThreadedAsyncBackend(self)
+
+    def ping(self):
+        self.client.ping()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        if len(keys) == 1:
+            return [self.client.get(keys[0])]
+        return self.client.mget(keys)
+
+    def set(self, key: str, payload: bytes, ex: Expiry = None):
+        self.client.set(key, payload, ex)
+
+    def set_many(self, items: List[Tuple[str, bytes, Expiry]]):
+        pipe = self.client.pipeline(transaction=False)
+        for key, payload, ex in items:
+            pipe.set(key, payload, ex)
+        pipe.execute()
+
+    def delete(self, *keys: str):
+        if keys:
+            self.client.delete(*keys)
+
+    def unlink(self, *keys: str):
+        if keys:
+            self.client.unlink(*keys)
+
+    def incr(self, key: str, amount: int = 1, ex: Expiry = None) -> int:
+        pipe = self.client.pipeline(transaction=True)
+        pipe.incrby(key, amount)
+        if ex is not None:
+            pipe.expire(key, ex)
+        return int(pipe.execute()[0])
+
+    def scan(self, match: str = '*', count: int = 1000) -> Iterator[str]:
+        for key in self.client.scan_iter(match=match, count=count):
+            yield key.decode('utf-8') if isinstance(key, bytes) else key
+
+    def flush(self):
+        self.client.flushdb()
+
+    def close(self):
+        self.client.close()
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Embedded on-disk store for when there is no Redis server.  A single SQLite file in WAL mode, so any number of
+    readers (threads or worker processes) can read while one writer writes.  Expired rows are never returned and are
+    purged from time to time on write.
+    """
+
+    name = 'sqlite'
+
+    # Bound parameters per statement, stays below SQLITE_MAX_VARIABLE_NUMBER on old builds.
+    BATCH = 500
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: Union[str, Path], timeout: float = 30.0):
+        """
+        :param path: Database file, created (with its folder) if missing.
+        :param timeout: Seconds to wait for the write lock held by another thread/process.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+
+        self.local = threading.local()
+        self.writes = 0
+
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)')
+
+    def connection(self) -> sqlite3.Connection:
+        """One connection per thread (and per process, connections must not cross a fork)."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def expires_at(ex: Expiry) -> Optional[float]:
+        seconds = to_seconds(ex)
+        return time.time() + seconds if seconds is not None else None
+
+    def ping(self):
+        self.connection().execute('SELECT 1')
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self.connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, time.time())
+        ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        found = {}
+        now = time.time()
+        for start in range(0, len(keys), self.BATCH):
+            chunk = keys[start:start + self.BATCH]
+            rows = self.connection().execute(
+                f'SELECT key, value FROM cache WHERE key IN ({",".join("?" * len(chunk))}) '
+                f'AND (expires_at IS NULL OR expires_at > ?)',
+                (*chunk, now)
+            ).fetchall()
+            found.update((k, bytes(v)) for k, v in rows)
+        return [found.get(key) for key in keys]
+
+    def set(self, key: str, payload: bytes, ex: Expiry = None):
+        self.set_many([(key, payload, ex)])
+
+    def set_many(self, items: List[Tuple[str, bytes, Expiry]]):
+        conn = self.connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                [(key, sqlite3.Binary(payload), self.expires_at(ex)) for key, payload, ex in items]
+            )
+        self.writes += len(items)
+        if self.writes >= self.PURGE_EVERY:
+            self.writes = 0
+            self.purge_expired()
+
+    def delete(self, *keys: str):
+        conn = self.connection()
+        for start in range(0, len(keys), self.BATCH):
+            chunk = keys[start:start + self.BATCH]
+            conn.execute(f'DELETE FROM cache WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+
+    def incr(self, key: str, amount: int = 1, ex: Expiry = None) -> int:
+        conn = self.connection()
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT value, expires_at FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)', (key, now)
+            ).fetchone()
+            value = (int(bytes(row[0])) if row else 0) + amount
+            if ex is not None:
+                expires_at = self.expires_at(ex)
+            else:
+                expires_at = row[1] if row else None
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, sqlite3.Binary(str(value).encode()), expires_at)
+            )
+        return value
+
+    def scan(self, match: str = '*', count: int = 1000) -> Iterator[str]:
+        last = ''
+        while True:
+            rows = self.connection().execute(
+                'SELECT key FROM cache WHERE key > ? AND key GLOB ? AND (expires_at IS NULL OR expires_at > ?) '
+                'ORDER BY key LIMIT ?',
+                (last, match, time.time(), count)
+            ).fetchall()
+            if not rows:
+                return
+            for (key,) in rows:
+                yield key
+            last = rows[-1][0]
+
+    def purge_expired(self):
+        self.connection().execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),))
+
+    def flush(self):
+        self.connection().execute('DELETE FROM cache')
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+class AsyncCacheBackend:
+    """The part of CacheBackend the async cache decorator needs, as coroutines."""
+
+    name: str = 'backend'
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        raise NotImplementedError()
+
+    async def set_many(self, items: List[Tuple[str, bytes, Expiry]]):
+        raise NotImplementedError()
+
+    async def incr(self, key: str, amount: int = 1, ex: Expiry = None) -> int:
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+class AsyncRedisBackend(AsyncCacheBackend):
+    """Redis through redis.asyncio, a connection pool of its own with the same settings as the sync one."""
+
+    name = 'redis'
+
+    def __init__(self, connection_kwargs: Dict[str, Any]):
+        import redis.asyncio
+
+        self.client = redis.asyncio.StrictRedis(connection_pool=redis.asyncio.ConnectionPool(**connection_kwargs))
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        if len(keys) == 1:
+            return [await self.client.get(keys[0])]
+        return await self.client.mget(keys)
+
+    async def set_many(self, items: List[Tuple[str, bytes, Expiry]]):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, payload, ex in items:
+                pipe.set(key, payload, ex)
+            await pipe.execute()
+
+    async def incr(self, key: str, amount: int = 1, ex: Expiry = None) -> int:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.incrby(key, amount)
+            if ex is not None:
+                pipe.expire(key, ex)
+            return int((await pipe.execute())[0])
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class ThreadedAsyncBackend(AsyncCacheBackend):
+    """Any (blocking) CacheBackend with its calls moved to a worker thread, so they don't block the event loop."""
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.name = backend.name
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await asyncio.to_thread(self.backend.mget, keys)
+
+    async def set_many(self, items: List[Tuple[str, bytes, Expiry]]):
+        await asyncio.to_thread(self.backend.set_many, items)
+
+    async def incr(self, key: str, amount: int = 1, ex: Expiry = None) -> int:
+        return await asyncio.to_thread(self.backend.incr, key, amount, ex)
@@ -0,0 +1,109 @@
+"""
+Serialization of cached values.
+
+Payload layout: b'MC' | version (1 byte) | codec (1 byte) | format (1 byte) | created_at (8 byte float, unix time) | body
+
+Completion responses (and plain str / number / None results) are stored as JSON records, anything else is pickled.
+Bodies above a small threshold are compressed with zstd when the zstandard package is installed, zlib otherwise.
+Payloads without the header are entries written before this layout existed (plain pickles) and are still read.
+"""
+
+import json
+import pickle
+import struct
+import time
+import zlib
+from typing import Any, Optional
+
+from src.model.response import CompletionResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'MC'
+VERSION = 1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+FORMAT_JSON = 0
+FORMAT_RESPONSE = 1
+FORMAT_PICKLE = 2
+
+HEADER = struct.Struct('<2sBBBd')
+
+# Below this many bytes compression costs more than it saves.
+COMPRESS_MIN_BYTES = 256
+
+
+class CacheCodecError(ValueError):
+    """A payload that can't be decoded (corrupt, or written by a newer layout)."""
+
+
+def encode(value: Any, created_at: Optional[float] = None) -> bytes:
+    if isinstance(value, CompletionResponse):
+        fmt, body = FORMAT_RESPONSE, json.dumps(value.to_record(), separators=(',', ':')).encode('utf-8')
+    elif value is None or isinstance(value, (str, int, float, bool)):
+        fmt, body = FORMAT_JSON, json.dumps(value, separators=(',', ':')).encode('utf-8')
+    else:
+        fmt, body = FORMAT_PICKLE, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    codec = CODEC_NONE
+    if len(body) >= COMPRESS_MIN_BYTES:
+        if zstandard is not None:
+            codec, body = CODEC_ZSTD, zstandard.ZstdCompressor(level=3).compress(body)
+        else:
+            codec, body = CODEC_ZLIB, zlib.compress(body, 6)
+
+    return HEADER.pack(MAGIC, VERSION, codec, fmt, created_at if created_at is not None else time.time()) + body
+
+
+def decode(payload: bytes) -> Any:
+    if not is_framed(payload):
+        # Written before the framed layout.
+        try:
+            return pickle.loads(payload)
+        except Exception as e:
+            raise CacheCodecError(f'Unreadable legacy payload: {e}')
+
+    _, version, codec, fmt, _ = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise CacheCodecError(f'Unknown payload version {version}')
+
+    body = payload[HEADER.size:]
+    try:
+        if codec == CODEC_ZLIB:
+            body = zlib.decompress(body)
+        elif codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise CacheCodecError('Payload is zstd compressed but the zstandard package is not installed')
+            body = zstandard.ZstdDecompressor().decompress(body)
+        elif codec != CODEC_NONE:
+            raise CacheCodecError(f'Unknown codec {codec}')
+
+        if fmt == FORMAT_RESPONSE:
+            return CompletionResponse.from_record(json.loads(body))
+        if fmt == FORMAT_JSON:
+            return json.loads(body)
+        if fmt == FORMAT_PICKLE:
+            return pickle.loads(body)
+    except CacheCodecError:
+        raise
+    except Exception as e:
+        raise CacheCodecError(f'Corrupt payload: {e}')
+    raise CacheCodecError(f'Unknown format {fmt}')
+
+
+def is_framed(payload: bytes) -> bool:
+    return len(payload) >= HEADER.size and payload[:len(MAGIC)] == MAGIC
+
+
+def created_at(payload: bytes) -> Optional[float]:
+    """Unix time the payload was written (None for legacy payloads)."""
+    if not is_framed(payload):
+        return None
+    return HEADER.unpack_from(payload)[4]
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Optional, Tuple, Union
+
+
+def to_seconds(ex: Union[None, int, float, timedelta]) -> Optional[float]:
+    """Expiry as given to the cache decorator (seconds or timedelta) in seconds, None means forever."""
+    if ex is None:
+        return None
+    if isinstance(ex, timedelta):
+        return ex.total_seconds()
+    return float(ex)
+
+
+class MemoryLRU:
+    """
+    Bounded in-process LRU of serialized cache payloads, limited by entry count and by total payload bytes.
+
+    Payloads are kept serialized (the same bytes that go to Redis) so a hit hands out a fresh copy, callers mutating a
+    cached response can't change what the next caller gets.  Entries honour the same expiry as the backend entry.
+    """
+
+    def __init__(self, max_entries: int = 4096, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param max_entries: Max number of entries kept (0 disables the tier).
+        :param max_bytes: Max total size of the kept payloads.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # key -> (payload, expires_at (monotonic) or None)
+        self.entries: 'OrderedDict[str, Tuple[bytes, Optional[float]]]' = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, payload: bytes, ex: Union[None, int, float, timedelta] = None):
+        if self.max_entries <= 0 or len(payload) > self.max_bytes:
+            self.delete(key)
+            return
+
+        seconds = to_seconds(ex)
+        expires_at = time.monotonic() + seconds if seconds is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (payload, expires_at)
+            self.size += len(payload)
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def _remove(self, key: str):
+        """Must hold the lock."""
+        payload, _ = self.entries.pop(key)
+        self.size -= len(payload)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
@@ -1,18 +1,63 @@
-from typing import Optional
+from typing import Optional, Dict, Any, List, Tuple, Iterator, Callable, ContextManager
+from contextlib import nullcontext
 from functools import wraps, partial
+import asyncio
+import contextvars
+import atexit
 import hashlib
 import json
-import pickle
-from pickle import UnpicklingError
-import redis
+import os
+import threading
+import uuid
+import weakref
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from src.utils import cache_codec
+from src.utils.cache_backends import AsyncCacheBackend, CacheBackend, RedisBackend, SQLiteBackend
+from src.utils.memory_cache import MemoryLRU
+from src.utils.paths import ROOT_FOLDER
+from src.utils.telemetry import annotate
+
+
+DEFAULT_SQLITE_PATH = ROOT_FOLDER / '.cache' / 'musr_cache.sqlite'
+
+# Bump when the key layout changes so old entries are simply never looked up again.
+KEY_VERSION = 'v2'
+
+# Persistent per function counters live next to the entries as stats|<function>|<field> (integers, see flush_stats).
+STATS_PREFIX = 'stats|'
+STATS_FIELDS = ('hits', 'misses', 'saved_micro_usd')
+
+# Sample counters of a run (see _next_sample) are ctr:<run id>|<entry key>, kept long enough to resume a run.
+COUNTER_PREFIX = 'ctr:'
+SAMPLE_COUNTER_TTL = timedelta(days=7)
+
+# Entry keys start with ns:<namespace>:<epoch>|, the current epoch of a namespace is the counter epoch|<namespace>.
+DEFAULT_NAMESPACE = 'default'
+EPOCH_PREFIX = 'epoch|'
 
 
 class RedisCache:
-    redis_backend: Optional[redis.StrictRedis]
+    """
+    Two tier cache: a bounded in-process LRU (MemoryLRU) in front of a storage backend (Redis, or an on-disk SQLite file
+    when there is no Redis server, see cache_backends).  Lookups try the memory tier first, backend hits are promoted
+    into it and every write goes to both, so both tiers always hold the same payload for a key.
+    """
+
+    backend: Optional[CacheBackend]
     bust_cache: bool
     disabled: bool
 
     keystore: dict
+    run_id: str
+    memory: MemoryLRU
+
+    namespace: str
+    epoch: int
+
+    # Calls counted in process before their counts are added to the backend counters.
+    STATS_FLUSH_EVERY = 100
 
     def __init__(
             self,
@@ -25,6 +70,25 @@ class RedisCache:
             **kwargs
     ):
         self.keystore = {}
+        self.keystore_lock = threading.Lock()
+        self.run_id = os.environ.get('MUSR_CACHE_RUN_ID') or uuid.uuid4().hex
+        self.memory = MemoryLRU()
+        self.backend = None
+        # event loop -> (backend, its async view), see _async_backend
+        self.async_backends = weakref.WeakKeyDictionary()
+        self.async_backends_lock = threading.Lock()
+        self.namespace = DEFAULT_NAMESPACE
+        self.epoch = 0
+        self.gc_thread = None
+        self.accessed_keys: Optional[set] = None
+        self.backend_hits = 0
+        self.backend_misses = 0
+        self.stats_lock = threading.Lock()
+        # function -> {'hits', 'misses', 'saved_cost'} for this process, and the increments not yet in the backend.
+        self.function_stats: Dict[str, Dict[str, float]] = {}
+        self.pending_stats: Dict[Tuple[str, str], int] = {}
+        self.pending_calls = 0
+        atexit.register(self.flush_stats)
         if disabled:
             self.disable()
         else:
@@ -36,29 +100,316 @@ class RedisCache:
             port: int = 6379,
             db: int = 0,
             bust_cache: bool = False,
+            memory_max_entries: int = 4096,
+            memory_max_bytes: int = 64 * 1024 * 1024,
+            max_connections: int = 64,
+            health_check_interval: int = 30,
+            socket_timeout: float = 30.0,
+            socket_connect_timeout: float = 5.0,
+            backend: str = None,
+            path: str = None,
+            run_id: str = None,
             *args,
             **kwargs
     ):
-        self.redis_backend = None
+        """
+        :param memory_max_entries: Max entries in the in-process tier (0 turns it off).
+        :param memory_max_bytes: Max total payload bytes in the in-process tier.
+        :param max_connections: Size of the Redis connection pool (shared by all threads).
+        :param health_check_interval: Seconds a pooled connection may sit idle before it is checked with a PING.
+        :param socket_timeout: Seconds to wait on a Redis reply.
+        :param socket_connect_timeout: Seconds to wait for a connection (also bounds the startup PING).
+        :param backend: 'redis', 'sqlite' or 'auto' (redis, falling back to sqlite when it can't connect).  Defaults to
+            MUSR_CACHE_BACKEND or 'auto'.
+        :param path: SQLite database file.  Defaults to MUSR_CACHE_PATH or .cache/musr_cache.sqlite in the repo.
+        :param run_id: Run the sample counters belong to, see _next_sample.  Defaults to MUSR_CACHE_RUN_ID or a new id
+            per process, so give every worker of one run the same MUSR_CACHE_RUN_ID.
+        """
+        self.run_id = run_id or os.environ.get('MUSR_CACHE_RUN_ID') or uuid.uuid4().hex
+        backend = (backend or os.environ.get('MUSR_CACHE_BACKEND') or 'auto').lower()
+        path = path or os.environ.get('MUSR_CACHE_PATH') or DEFAULT_SQLITE_PATH
+        if backend not in ('auto', 'redis', 'sqlite'):
+            raise ValueError(f'Unknown cache backend: {backend} (use auto, redis or sqlite)')
+
+        self.memory = MemoryLRU(max_entries=memory_max_entries, max_bytes=memory_max_bytes)
+        self.disable()
+
+        if backend in ('auto', 'redis'):
+            try:
+                redis_backend = RedisBackend(
+                    host=host,
+                    port=port,
+                    db=db,
+                    max_connections=max_connections,
+                    health_check_interval=health_check_interval,
+                    socket_timeout=socket_timeout,
+                    socket_connect_timeout=socket_connect_timeout
+                )
+                # Redis connects lazily, ping so a missing server is noticed here and not on the first lookup.
+                redis_backend.ping()
+                self.backend = redis_backend
+                print("Redis server connected.")
+            except Exception as e:
+                if backend == 'redis':
+                    print(
+                        f"WARNING: Redis could not connect to the database, cache disabled. ERROR: {e}"
+                    )
+                    return
+                print(f"WARNING: Redis could not connect to the database, using the on-disk cache at {path}. ERROR: {e}")
+
+        if self.backend is None:
+            try:
+                self.backend = SQLiteBackend(path)
+                print(f"On-disk cache opened at {path}.")
+            except Exception as e:
+                print(f"WARNING: On-disk cache could not be opened, cache disabled. ERROR: {e}")
+                return
+
+        self.bust_cache = bust_cache
+        self.disabled = False
+
+        keys_out = os.environ.get('MUSR_CACHE_KEYS_OUT')
+        if keys_out:
+            self.track_keys()
+            atexit.register(self.write_accessed_keys, keys_out)
+
+    def track_keys(self):
+        """Remember every entry key read or written from now on (see write_accessed_keys)."""
+        with self.stats_lock:
+            if self.accessed_keys is None:
+                self.accessed_keys = set()
+
+    def write_accessed_keys(self, path: str):
+        """
+        Write the tracked keys, one per line, e.g. to export a snapshot of exactly the entries one dataset run used
+        (python -m src.utils.cache export --keys-file path).
+        """
+        with self.stats_lock:
+            keys = sorted(self.accessed_keys or ())
+        with open(path, 'w') as f:
+            f.writelines(f'{key}\n' for key in keys)
+        print(f'Wrote {len(keys)} accessed cache keys to {path}.')
+
+    def _track(self, keys: List[str]):
+        if self.accessed_keys is not None:
+            with self.stats_lock:
+                self.accessed_keys.update(keys)
+
+    def disable(self):
+        self.backend = None
         self.bust_cache = True
         self.disabled = True
+        self.memory.clear()
+        with self.async_backends_lock:
+            self.async_backends.clear()
+
+    def _async_backend(self) -> Optional[AsyncCacheBackend]:
+        """Async view of the current backend for the running event loop (async redis clients can't cross loops)."""
+        backend = self.backend
+        if backend is None:
+            return None
+        loop = asyncio.get_running_loop()
+        with self.async_backends_lock:
+            entry = self.async_backends.get(loop)
+            if entry is None or entry[0] is not backend:
+                entry = (backend, backend.async_backend())
+                self.async_backends[loop] = entry
+            return entry[1]
+
+    def use_namespace(self, namespace: str, new_epoch: bool = False, gc: bool = True) -> int:
+        """
+        Read and write entries of a namespace from now on.  Namespaces share one backend without sharing entries, e.g.
+        generation runs that want fresh samples and eval runs that reuse answers.
+
+        :param namespace: Name of the namespace (no '|' or ':').
+        :param new_epoch: Start a new epoch of the namespace: every entry written so far becomes unreachable at once, no
+            flush needed (and other namespaces are untouched).
+        :param gc: Delete the entries of older epochs of the namespace in a background thread.
+        :return: The epoch now in use.
+        """
+        if not namespace or '|' in namespace or ':' in namespace:
+            raise ValueError(f'Invalid cache namespace: {namespace!r}')
+
+        self.namespace = namespace
+        self.epoch = 0
+        if self.backend is None:
+            return self.epoch
+
+        if new_epoch:
+            self.epoch = self.backend.incr(f'{EPOCH_PREFIX}{namespace}')
+        else:
+            self.epoch = self.current_epoch(namespace)
+
+        if gc:
+            self.gc_thread = threading.Thread(
+                target=self.collect_old_epochs, args=(namespace, self.epoch), name=f'cache-gc-{namespace}', daemon=True
+            )
+            self.gc_thread.start()
+        return self.epoch
+
+    def current_epoch(self, namespace: str) -> int:
+        payload = self.backend.get(f'{EPOCH_PREFIX}{namespace}') if self.backend is not None else None
+        return int(payload) if payload is not None else 0
 
+    @property
+    def key_prefix(self) -> str:
+        return f'ns:{self.namespace}:{self.epoch}|'
+
+    def collect_old_epochs(self, namespace: str, current_epoch: int, batch: int = 500) -> int:
+        """
+        Unlink every entry of namespace from an epoch before current_epoch, a page of keys at a time.  Safe to stop at
+        any point, the next run picks up what is left.
+
+        :return: Number of entries removed.
+        """
+        backend = self.backend
+        if backend is None:
+            return 0
+        removed = 0
+        stale = []
         try:
-            self.redis_backend = redis.StrictRedis(host=host, port=port, db=db)
-            self.bust_cache = bust_cache
-            self.disabled = False
+            for key in backend.scan(f'ns:{namespace}:*', count=batch):
+                epoch = key[len(f'ns:{namespace}:'):].split('|', 1)[0]
+                if epoch.isdigit() and int(epoch) < current_epoch:
+                    stale.append(key)
+                if len(stale) >= batch:
+                    backend.unlink(*stale)
+                    removed += len(stale)
+                    stale = []
+            if stale:
+                backend.unlink(*stale)
+                removed += len(stale)
+        except Exception as e:
+            print(f"WARNING: Cache garbage collection of namespace {namespace} stopped: {e}")
+        return removed
+
+    @property
+    def redis_backend(self):
+        """The raw redis client when the redis backend is in use (None otherwise)."""
+        return self.backend.client if isinstance(self.backend, RedisBackend) else None
+
+    def flush(self):
+        """Drop every cached entry in both tiers."""
+        self.memory.clear()
+        if self.backend is not None:
+            self.backend.flush()
 
-            print("Redis server connected.")
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Hit/miss counters per tier (a memory miss that hits the backend counts as a memory miss and a backend hit) and
+        per decorated function.
+        """
+        with self.stats_lock:
+            lookups = self.backend_hits + self.backend_misses
+            backend_stats = {
+                'name': self.backend.name if self.backend is not None else None,
+                'hits': self.backend_hits,
+                'misses': self.backend_misses,
+                'hit_rate': self.backend_hits / lookups if lookups else None,
+            }
+        return {'memory': self.memory.stats(), 'backend': backend_stats, 'functions': self.function_stats_summary()}
+
+    def function_stats_summary(self) -> Dict[str, Dict[str, Any]]:
+        """Hits, misses, hit rate and saved spend (USD) per decorated function, for this process."""
+        with self.stats_lock:
+            return {
+                name: {**counts, 'hit_rate': counts['hits'] / (counts['hits'] + counts['misses'])}
+                for name, counts in self.function_stats.items()
+            }
+
+    def persisted_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per function counters accumulated in the backend by every process that used it."""
+        if self.backend is None:
+            return {}
+        self.flush_stats()
+        keys = list(self.backend.scan(f'{STATS_PREFIX}*'))
+        out: Dict[str, Dict[str, Any]] = {}
+        for key, payload in zip(keys, self.backend.mget(keys)):
+            if payload is None:
+                continue
+            name, field = key[len(STATS_PREFIX):].rsplit('|', 1)
+            if field in STATS_FIELDS:
+                out.setdefault(name, {f: 0 for f in STATS_FIELDS})[field] = int(payload)
+        for counts in out.values():
+            lookups = counts['hits'] + counts['misses']
+            counts['hit_rate'] = counts['hits'] / lookups if lookups else None
+            counts['saved_usd'] = counts.pop('saved_micro_usd') / 1e6
+        return out
+
+    def flush_stats(self):
+        """Add the counts gathered since the last flush to the backend counters (every STATS_FLUSH_EVERY calls, at exit)."""
+        with self.stats_lock:
+            pending, self.pending_stats = self.pending_stats, {}
+            self.pending_calls = 0
+        backend = self.backend
+        if backend is None or not pending:
+            return
+        try:
+            for (name, field), amount in pending.items():
+                if amount:
+                    backend.incr(f'{STATS_PREFIX}{name}|{field}', amount)
         except Exception as e:
+            print(f"WARNING: Could not write cache stats: {e}")
+
+    def _record_call(self, name: str, hit: bool, saved_cost: float = 0.0):
+        if self._count_call(name, hit, saved_cost):
+            self.flush_stats()
 
-            print(
-                f"WARNING: Redis could not connect to the database, cache disabled. ERROR: {e}"
+    def _count_call(self, name: str, hit: bool, saved_cost: float = 0.0) -> bool:
+        """Count a cached call, True when the counts are due to be flushed to the backend."""
+        with self.stats_lock:
+            counts = self.function_stats.setdefault(name, {'hits': 0, 'misses': 0, 'saved_cost': 0.0})
+            field = 'hits' if hit else 'misses'
+            counts[field] += 1
+            counts['saved_cost'] += saved_cost
+            self.pending_stats[(name, field)] = self.pending_stats.get((name, field), 0) + 1
+            if saved_cost:
+                key = (name, 'saved_micro_usd')
+                self.pending_stats[key] = self.pending_stats.get(key, 0) + round(saved_cost * 1e6)
+            self.pending_calls += 1
+            return self.pending_calls >= self.STATS_FLUSH_EVERY
+
+    @staticmethod
+    def _call_cost(args: tuple, v: Any) -> float:
+        """What a cached response cost when it was made, from its usage and the model's token prices (0 if unknown)."""
+        usage = getattr(v, 'usage', None)
+        if not args or usage is None:
+            return 0.0
+        model = args[0]
+        try:
+            return (
+                usage.prompt_tokens * getattr(model, 'prompt_cost', 0.0) +
+                usage.completion_tokens * getattr(model, 'completion_cost', 0.0)
             )
+        except (AttributeError, TypeError):
+            return 0.0
 
-    def disable(self):
-        self.redis_backend = None
-        self.bust_cache = True
-        self.disabled = True
+    def iter_entries(self, match: str = f'ns:*|{KEY_VERSION}|*', batch: int = 500) -> Iterator[Tuple[str, bytes]]:
+        """(key, payload) for every backend entry matching a glob pattern, scanned and fetched batch by batch."""
+        if self.backend is None:
+            return
+        keys = []
+        for key in self.backend.scan(match, count=batch):
+            keys.append(key)
+            if len(keys) >= batch:
+                yield from ((k, p) for k, p in zip(keys, self.backend.mget(keys)) if p is not None)
+                keys = []
+        if keys:
+            yield from ((k, p) for k, p in zip(keys, self.backend.mget(keys)) if p is not None)
+
+    def delete(self, *keys: str):
+        """Remove entries from both tiers."""
+        for key in keys:
+            self.memory.delete(key)
+        if self.backend is not None:
+            self.backend.delete(*keys)
+
+    def _count_backend(self, hit: bool):
+        with self.stats_lock:
+            if hit:
+                self.backend_hits += 1
+            else:
+                self.backend_misses += 1
 
     @staticmethod
     def make_hash(o):
@@ -66,14 +417,11 @@ class RedisCache:
         Make a stable hash out of anything that is json serializable.  See json.JSONEncoder if you need to serialize
         a custom class.
         """
-        obj_str = json.dumps(o, sort_keys=True)
-        f_str_enc = obj_str.encode()
-
-        m = hashlib.md5(f_str_enc)
-        h = m.hexdigest()
-        return h
+        h = hashlib.blake2b(digest_size=16)
+        RedisCache._update_hash(h, o)
+        return h.hexdigest()
 
-    def cached(self, f=None, data_ex=None, no_data_ex=None, prepended_key_attr: str = None):
+    def cached(self, f=None, data_ex=None, no_data_ex=None, prepended_key_attr: str = None, key_name: str = None):
 
         """
         A cache decorator.
@@ -83,89 +431,369 @@ class RedisCache:
         :param f: the method to decorate
         :param data_ex: how long to cache the data in seconds. None means forever.
         :param no_data_ex: how long to cache no data in seconds (None, [], etc...). None means forever.
-        :param prepended_key_attr: extra string to add to the computed hash that serves as a redis key
+        :param prepended_key_attr: comma separated attributes of self (the model parameters) that are part of the key,
+            name=value makes calls only share entries while the attribute has that value
+        :param key_name: Name of the function in the key (default its qualified name), functions with the same
+            key_name share entries
         :return: A wrapper function that performs caching
         """
 
         if f is None:
-            return partial(self.cached, data_ex=data_ex, no_data_ex=no_data_ex, prepended_key_attr=prepended_key_attr)
+            return partial(
+                self.cached,
+                data_ex=data_ex,
+                no_data_ex=no_data_ex,
+                prepended_key_attr=prepended_key_attr,
+                key_name=key_name
+            )
+
+        key_attrs = self.parse_key_attrs(prepended_key_attr)
+        name = key_name or f.__qualname__
 
         @wraps(f)
         def wrapper(*args, **kwargs):
-
-            # If there are conditional values in the prepended key args that aren't satisfied, we do not cache.
-            no_cache = False
-            key = self._key(f, *args, **kwargs)
-            if prepended_key_attr:
-                prepended_key_attrs = prepended_key_attr.split(',')
-                prepended_str = ''
-                check_keystore = False
-                for attr in prepended_key_attrs:
-                    # conditional on if we only allow to cache attributes at specific values.
-                    if '=' in attr:
-                        name, val = attr.split('=')
-                        attr = getattr(args[0], name)
-                        prepended_str += f'{str(attr)}'
-                        if attr != eval(val):
-                            check_keystore = True
-                    else:
-                        prepended_str += f'{str(getattr(args[0], attr))}'
-                key = f'{prepended_str}{key}'
-                if check_keystore:
-                    self.keystore[key] = self.keystore.get(key, -1) + 1
-                    key = f'{key}.{self.keystore[key]}'
+            key = self._cache_key(name, key_attrs, *args, **kwargs)
 
             # look in the cache unless we're busting the cache
-            if not self.bust_cache and not self.disabled and not no_cache:
-                if self.redis_backend.exists(key):
-
-                    pickled = self.redis_backend.get(key)
-                    try:
-                        return pickle.loads(pickled)
-                    except UnpicklingError:
-                        pass
+            if not self.bust_cache and not self.disabled:
+                (hit, v, tier), = self._lookup_many([key], data_ex, no_data_ex)
+                if hit:
+                    annotate(cache_hit=True, cache_tier=tier)
+                    self._record_call(name, hit=True, saved_cost=self._call_cost(args, v))
+                    return v
+                annotate(cache_hit=False)
+                self._record_call(name, hit=False)
 
             # run the function
             v = f(*args, **kwargs)
 
-            if not self.disabled and not no_cache:
-                # pickle and cache the result
-                pickled = pickle.dumps(v)
+            if not self.disabled:
+                self.set_many([(key, v, self._expiry(v, data_ex, no_data_ex))])
+
+            # return the result
+            return v
 
-                if data_ex and v is not None:
-                    ex = data_ex
-                elif no_data_ex and v is None:
-                    ex = no_data_ex
-                else:
-                    ex = None
+        def call_many(
+                calls: List[Tuple[tuple, dict]],
+                max_workers: int = 1,
+                return_exceptions: bool = False,
+                span: Callable[[tuple], ContextManager] = None
+        ) -> List[Any]:
+            """
+            Run many calls of the decorated function with one batched read for all lookups and one batched write (MGET and
+            a pipeline on redis, a single query / transaction on sqlite).
 
-                self.redis_backend.set(key, pickled, ex)
+            :param calls: (args, kwargs) per call, args include self for methods.
+            :param max_workers: Threads running the cache misses.
+            :param return_exceptions: Put a failing call's exception in its result slot instead of raising it (the
+                other calls still run and get cached).
+            :param span: Context manager per call (given args), e.g. a telemetry span.  Set by telemetry.instrumented,
+                so a batch is recorded like the same calls one by one (misses run in a copy of the caller's context).
+            :return: One result per call, in order.
+            """
+            span = span or (lambda a: nullcontext())
+            lookup = not self.bust_cache and not self.disabled
 
-            # return the result
+            # Keys are built in order so sample counters advance exactly as for sequential calls.
+            keys = [self._cache_key(name, key_attrs, *a, **kw) for a, kw in calls]
+
+            results: List[Any] = [None] * len(calls)
+            misses = list(range(len(calls)))
+            if lookup:
+                looked_up = self._lookup_many(keys, data_ex, no_data_ex)
+                misses = [i for i, (hit, _, _) in enumerate(looked_up) if not hit]
+                for i, (hit, v, tier) in enumerate(looked_up):
+                    if hit:
+                        results[i] = v
+                        with span(calls[i][0]):
+                            annotate(cache_hit=True, cache_tier=tier)
+                    self._record_call(name, hit=hit, saved_cost=self._call_cost(calls[i][0], v) if hit else 0.0)
+
+            def run(i):
+                a, kw = calls[i]
+                try:
+                    with span(a):
+                        if lookup:
+                            annotate(cache_hit=False)
+                        return f(*a, **kw), None
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    return e, e
+
+            contexts = [contextvars.copy_context() for _ in misses]
+            if max_workers > 1 and len(misses) > 1:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    outs = list(executor.map(lambda i, context: context.run(run, i), misses, contexts))
+            else:
+                outs = [run(i) for i in misses]
+
+            writes = []
+            for i, (v, error) in zip(misses, outs):
+                results[i] = v
+                if error is None:
+                    writes.append((keys[i], v, self._expiry(v, data_ex, no_data_ex)))
+            if writes and not self.disabled:
+                self.set_many(writes)
+            return results
+
+        def lookup(calls: List[Tuple[tuple, dict]]) -> List[Tuple[Optional[str], bool, Any]]:
+            """
+            (key, hit, value) per call of the decorated function, without running it, for callers that answer several
+            calls at once some other way and store() the answers under the calls' own keys.  Sampled calls (see
+            parse_key_attrs) get (None, False, None), they have no single entry to share.  Only hits are counted in the
+            call stats, a miss is counted by the call that answers it (if it goes through the decorated function).
+            """
+            keys = []
+            for a, kw in calls:
+                key, sampled = self._base_key(name, key_attrs, *a, **kw)
+                keys.append(None if sampled else key)
+
+            out: List[Tuple[Optional[str], bool, Any]] = [(key, False, None) for key in keys]
+            known = [i for i, key in enumerate(keys) if key is not None]
+            if known and not self.bust_cache and not self.disabled:
+                looked_up = self._lookup_many([keys[i] for i in known], data_ex, no_data_ex)
+                for i, (hit, v, _) in zip(known, looked_up):
+                    out[i] = (keys[i], hit, v)
+                    if hit:
+                        self._record_call(name, hit=True, saved_cost=self._call_cost(calls[i][0], v))
+            return out
+
+        def store(entries: List[Tuple[str, Any]]):
+            """Cache (key from lookup, value) pairs with the decorated function's expiry rules."""
+            if not self.disabled:
+                self.set_many([(key, v, self._expiry(v, data_ex, no_data_ex)) for key, v in entries if key is not None])
+
+        wrapper.call_many = call_many
+        wrapper.lookup = lookup
+        wrapper.store = store
+        return wrapper
+
+    def acached(self, f=None, data_ex=None, no_data_ex=None, prepended_key_attr: str = None, key_name: str = None):
+        """
+        cached for `async def` functions: the same keys, expiry rules and prepended_key_attr handling, with the backend
+        I/O awaited (redis.asyncio for redis, a worker thread for sqlite) instead of blocking the event loop.  Give it
+        the key_name of a sync cached function to share its entries.
+        """
+        if f is None:
+            return partial(
+                self.acached,
+                data_ex=data_ex,
+                no_data_ex=no_data_ex,
+                prepended_key_attr=prepended_key_attr,
+                key_name=key_name
+            )
+
+        key_attrs = self.parse_key_attrs(prepended_key_attr)
+        name = key_name or f.__qualname__
+
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            key = await self._acache_key(name, key_attrs, *args, **kwargs)
+
+            if not self.bust_cache and not self.disabled:
+                (hit, v, tier), = await self._alookup_many([key], data_ex, no_data_ex)
+                if hit:
+                    annotate(cache_hit=True, cache_tier=tier)
+                    if self._count_call(name, hit=True, saved_cost=self._call_cost(args, v)):
+                        await asyncio.to_thread(self.flush_stats)
+                    return v
+                annotate(cache_hit=False)
+                if self._count_call(name, hit=False):
+                    await asyncio.to_thread(self.flush_stats)
+
+            v = await f(*args, **kwargs)
+
+            if not self.disabled:
+                await self.aset_many([(key, v, self._expiry(v, data_ex, no_data_ex))])
             return v
 
         return wrapper
 
-    def _key(self, f, *args, **kwargs):
-        func_name = f.__qualname__
-        s = func_name
+    def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """Cached values for raw keys (None where missing), memory tier first then one batched backend read."""
+        if self.disabled:
+            return [None] * len(keys)
+        return [v for _, v, _ in self._lookup_many(keys)]
+
+    def set_many(self, items: List[Tuple[str, Any, Any]]):
+        """Cache (key, value, expiry) triples in one batched backend write (expiry in seconds/timedelta or None)."""
+        if self.disabled or not items:
+            return
+        payloads = self._encode_many(items)
+        self.backend.set_many(payloads)
+        for key, payload, ex in payloads:
+            self.memory.set(key, payload, ex)
+
+    async def aset_many(self, items: List[Tuple[str, Any, Any]]):
+        """set_many without blocking the event loop."""
+        if self.disabled or not items:
+            return
+        payloads = self._encode_many(items)
+        await self._async_backend().set_many(payloads)
+        for key, payload, ex in payloads:
+            self.memory.set(key, payload, ex)
+
+    def _encode_many(self, items: List[Tuple[str, Any, Any]]) -> List[Tuple[str, bytes, Any]]:
+        payloads = [(key, cache_codec.encode(v), ex) for key, v, ex in items]
+        self._track([key for key, _, _ in payloads])
+        return payloads
+
+    def _lookup_many(self, keys: List[str], data_ex=None, no_data_ex=None) -> List[Tuple[bool, Any, Optional[str]]]:
+        """(hit, value, tier) per key.  Memory tier first, everything it misses in one backend read."""
+        out, remote = self._lookup_memory(keys)
+        if remote:
+            payloads = self.backend.mget([keys[i] for i in remote])
+            self._resolve_remote(keys, out, remote, payloads, data_ex, no_data_ex)
+        return out
+
+    async def _alookup_many(self, keys: List[str], data_ex=None, no_data_ex=None) -> List[Tuple[bool, Any, Optional[str]]]:
+        """_lookup_many with the backend read awaited."""
+        out, remote = self._lookup_memory(keys)
+        if remote:
+            payloads = await self._async_backend().mget([keys[i] for i in remote])
+            self._resolve_remote(keys, out, remote, payloads, data_ex, no_data_ex)
+        return out
+
+    def _lookup_memory(self, keys: List[str]) -> Tuple[List[Tuple[bool, Any, Optional[str]]], List[int]]:
+        """(hit, value, tier) per key from the memory tier, and the indices of the keys it doesn't have."""
+        out: List[Tuple[bool, Any, Optional[str]]] = [(False, None, None)] * len(keys)
+        self._track(keys)
+
+        remote = []
+        for i, key in enumerate(keys):
+            payload = self.memory.get(key)
+            if payload is not None:
+                try:
+                    out[i] = (True, cache_codec.decode(payload), 'memory')
+                    continue
+                except cache_codec.CacheCodecError:
+                    self.memory.delete(key)
+            remote.append(i)
+        return out, remote
+
+    def _resolve_remote(self, keys, out, remote, payloads, data_ex, no_data_ex):
+        """Decode the backend payloads of the remote keys into out and promote the hits to the memory tier."""
+        for i, payload in zip(remote, payloads):
+            hit = False
+            if payload is not None:
+                try:
+                    v = cache_codec.decode(payload)
+                    hit = True
+                    out[i] = (True, v, self.backend.name)
+                    # Promoted entries expire like a fresh write would, never later than data_ex/no_data_ex.
+                    self.memory.set(keys[i], payload, self._expiry(v, data_ex, no_data_ex))
+                except cache_codec.CacheCodecError:
+                    pass
+            self._count_backend(hit=hit)
+
+    @staticmethod
+    def parse_key_attrs(prepended_key_attr: Optional[str]) -> List[Tuple[str, bool, Any]]:
+        """
+        Parse prepended_key_attr once per decorated function: 'engine,temperature=float(0)' ->
+        [('engine', False, None), ('temperature', True, 0.0)].  Attributes with an expected value only share cache
+        entries at that value, otherwise every call gets its own numbered sample key.
+        """
+        attrs = []
+        for attr in (prepended_key_attr or '').split(','):
+            attr = attr.strip()
+            if not attr:
+                continue
+            if '=' in attr:
+                name, val = attr.split('=')
+                attrs.append((name, True, eval(val)))
+            else:
+                attrs.append((attr, False, None))
+        return attrs
+
+    def _cache_key(self, name: str, key_attrs: List[Tuple[str, bool, Any]], *args, **kwargs) -> str:
+        """
+        Namespaced, versioned key: ns:<namespace>:<epoch>|v2|<function>|<model params>|<argument digest>, i.e.
+        ns:eval:0|v2|OpenAIModel.inference|engine=gpt-4,temperature=0.0,max_tokens=500|9f86d081884c7d65...
+        (with a .<sample> suffix for sampled calls, see _next_sample)
+        """
+        key, sampled = self._base_key(name, key_attrs, *args, **kwargs)
+        if sampled:
+            key = f'{key}.{self._next_sample(key)}'
+        return key
+
+    async def _acache_key(self, name: str, key_attrs: List[Tuple[str, bool, Any]], *args, **kwargs) -> str:
+        key, sampled = self._base_key(name, key_attrs, *args, **kwargs)
+        if sampled:
+            key = f'{key}.{await self._anext_sample(key)}'
+        return key
+
+    def _base_key(self, name: str, key_attrs: List[Tuple[str, bool, Any]], *args, **kwargs) -> Tuple[str, bool]:
+        """The key without the sample suffix, and whether the call is sampled (an attribute off its expected value)."""
+        params = []
+        sampled = False
+        for attr, conditional, expected in key_attrs:
+            value = getattr(args[0], attr)
+            params.append(f'{attr}={value}')
+            # conditional on if we only allow to cache attributes at specific values.
+            if conditional and value != expected:
+                sampled = True
+
+        return f'{self.key_prefix}{KEY_VERSION}|{name}|{",".join(params)}|{self._key(*args, **kwargs)}', sampled
+
+    def _next_sample(self, key: str) -> int:
+        """
+        Index of the next sample for a key (0, 1, 2, ... within a run).  The counter is an INCR in the backend, so every
+        worker sharing the run id draws distinct indices and a new run replays samples #0, #1, ... from the cache in
+        the same order.  Falls back to a per process counter without a backend.
+        """
+        backend = self.backend
+        if backend is not None:
+            try:
+                return backend.incr(f'{COUNTER_PREFIX}{self.run_id}|{key}', 1, ex=SAMPLE_COUNTER_TTL) - 1
+            except Exception as e:
+                print(f"WARNING: Could not increment the sample counter in the cache backend, counting in process: {e}")
+        return self._next_local_sample(key)
 
-        # args[0] is the calling class, if there is one
-        if len(args) > 1:
-            for arg in args[1:]:
+    async def _anext_sample(self, key: str) -> int:
+        backend = self._async_backend()
+        if backend is not None:
+            try:
+                return await backend.incr(f'{COUNTER_PREFIX}{self.run_id}|{key}', 1, ex=SAMPLE_COUNTER_TTL) - 1
+            except Exception as e:
+                print(f"WARNING: Could not increment the sample counter in the cache backend, counting in process: {e}")
+        return self._next_local_sample(key)
 
-                arg_hash = self.make_hash(arg)
-                s += "_{0}".format(arg_hash)
+    def _next_local_sample(self, key: str) -> int:
+        with self.keystore_lock:
+            self.keystore[key] = self.keystore.get(key, -1) + 1
+            return self.keystore[key]
+
+    @staticmethod
+    def _expiry(v, data_ex, no_data_ex):
+        if data_ex and v is not None:
+            return data_ex
+        elif no_data_ex and v is None:
+            return no_data_ex
+        return None
 
-        elif len(args) == 1:
-            # calling code is not in a named class
-            arg_hash = self.make_hash(args[0])
-            s += "_{0}".format(arg_hash)
+    def _key(self, *args, **kwargs) -> str:
+        """Streaming BLAKE2b digest of the call arguments (str arguments are hashed as is, without json)."""
+        h = hashlib.blake2b(digest_size=16)
+
+        # args[0] is the calling class, if there is one (a single arg means the calling code is not in a named class)
+        for arg in (args[1:] if len(args) > 1 else args):
+            self._update_hash(h, arg)
 
         for k in sorted(kwargs.keys()):
+            h.update(b'k' + k.encode('utf-8') + b'\x00')
+            self._update_hash(h, kwargs[k])
 
-            v = kwargs[k]
-            v_hash = self.make_hash(v)
-            s += "_{0}={1}".format(k, v_hash)
+        return h.hexdigest()
 
-        return s
+    @staticmethod
+    def _update_hash(h, value):
+        # Type tag and length prefix keep ('ab', 'c') and ('a', 'bc') (or the str '1' and the int 1) apart.
+        if isinstance(value, str):
+            data = value.encode('utf-8')
+            h.update(b's')
+        else:
+            data = json.dumps(value, sort_keys=True).encode('utf-8')
+            h.update(b'j')
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
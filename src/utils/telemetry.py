@@ -0,0 +1,339 @@
+"""
+Per-call telemetry for model inference.
+
+Every instrumented call opens a span that becomes one record: wall latency, queue wait, retries, prompt/completion
+tokens, cost, cache hit/miss, errors and the caller tags (asset_key, validator, ablation, ...) active when the call was
+made.  Code deeper in the call (the cache wrapper, retry loops, cost tracking) adds to the open record with annotate()
+without needing a handle on it.
+
+Records are aggregated in-process (Telemetry.summary / report) and written to any configured sinks (JSONL, Prometheus
+textfile).  Tags and the open record live in contextvars so they follow the call across asyncio and to_thread.
+"""
+
+import atexit
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+
+_tags: contextvars.ContextVar = contextvars.ContextVar('telemetry_tags', default={})
+_record: contextvars.ContextVar = contextvars.ContextVar('telemetry_record', default=None)
+
+# Numeric fields that accumulate when annotated more than once in a single span.
+SUMMED_FIELDS = ('prompt_tokens', 'completion_tokens', 'cost')
+
+
+def annotate(**fields):
+    """Add fields to the record of the currently open span (no-op when no span is open)."""
+    record = _record.get()
+    if record is None:
+        return
+    for k, v in fields.items():
+        if k in SUMMED_FIELDS and v is not None and record.get(k) is not None:
+            record[k] += v
+        else:
+            record[k] = v
+
+
+def current_tags() -> Dict[str, str]:
+    return dict(_tags.get())
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Nearest rank percentile (p in [0, 100]) of values, None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[idx]
+
+
+class TelemetryAggregator:
+    """Rolls records up per (model, caller tags)."""
+
+    def __init__(self):
+        self.groups: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, record: Dict[str, Any]):
+        key = (record.get('model') or 'unknown', tuple(sorted(record.get('tags', {}).items())))
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = {
+                    'calls': 0, 'errors': 0, 'cache_hits': 0, 'cache_misses': 0, 'retries': 0, 'hedged': 0, 'hedge_wins': 0,
+                    'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0,
+                    'latency_s': [], 'queue_wait_s': 0.0,
+                }
+                self.groups[key] = group
+
+            group['calls'] += 1
+            group['errors'] += 1 if record.get('error') else 0
+            if record.get('cache_hit') is True:
+                group['cache_hits'] += 1
+            elif record.get('cache_hit') is False:
+                group['cache_misses'] += 1
+            group['retries'] += record.get('retries') or 0
+            group['hedged'] += 1 if record.get('hedged') else 0
+            group['hedge_wins'] += 1 if record.get('hedge_won') else 0
+            group['prompt_tokens'] += record.get('prompt_tokens') or 0
+            group['completion_tokens'] += record.get('completion_tokens') or 0
+            group['cost'] += record.get('cost') or 0.0
+            group['queue_wait_s'] += record.get('queue_wait_s') or 0.0
+            group['latency_s'].append(record.get('latency_s') or 0.0)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        rows = []
+        with self.lock:
+            for (model, tags), g in sorted(self.groups.items()):
+                lookups = g['cache_hits'] + g['cache_misses']
+                rows.append({
+                    'model': model,
+                    'tags': dict(tags),
+                    'calls': g['calls'],
+                    'errors': g['errors'],
+                    'cache_hit_rate': g['cache_hits'] / lookups if lookups else None,
+                    'retries': g['retries'],
+                    'hedged': g['hedged'],
+                    'hedge_wins': g['hedge_wins'],
+                    'prompt_tokens': g['prompt_tokens'],
+                    'completion_tokens': g['completion_tokens'],
+                    'cost': g['cost'],
+                    'latency_total_s': sum(g['latency_s']),
+                    'latency_p50_s': percentile(g['latency_s'], 50),
+                    'latency_p95_s': percentile(g['latency_s'], 95),
+                    'queue_wait_total_s': g['queue_wait_s'],
+                })
+        return rows
+
+    def reset(self):
+        with self.lock:
+            self.groups = {}
+
+
+class JsonlSink:
+    """Appends one json line per record."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            with self.path.open('a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def close(self):
+        pass
+
+
+class PrometheusTextfileSink:
+    """
+    Keeps counters per (model, cache state, caller tags) and rewrites a Prometheus textfile (node_exporter textfile
+    collector format) with them, at most every flush_interval seconds and once more on close.
+    """
+
+    def __init__(self, path: Union[str, Path], prefix: str = 'musr_model', flush_interval: float = 5.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+
+        self.series: Dict[Tuple[Tuple[str, str], ...], Dict[str, float]] = {}
+        self.lock = threading.Lock()
+        self.last_flush = 0.0
+
+    def write(self, record: Dict[str, Any]):
+        cache_state = {True: 'hit', False: 'miss'}.get(record.get('cache_hit'), 'none')
+        labels = {**record.get('tags', {}), 'model': record.get('model') or 'unknown', 'cache': cache_state}
+        key = tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+        with self.lock:
+            s = self.series.setdefault(key, {
+                'requests_total': 0, 'errors_total': 0, 'latency_seconds_sum': 0.0, 'queue_wait_seconds_sum': 0.0,
+                'retries_total': 0, 'hedged_total': 0, 'hedge_wins_total': 0, 'prompt_tokens_total': 0, 'completion_tokens_total': 0, 'cost_dollars_total': 0.0,
+            })
+            s['requests_total'] += 1
+            s['errors_total'] += 1 if record.get('error') else 0
+            s['latency_seconds_sum'] += record.get('latency_s') or 0.0
+            s['queue_wait_seconds_sum'] += record.get('queue_wait_s') or 0.0
+            s['retries_total'] += record.get('retries') or 0
+            s['hedged_total'] += 1 if record.get('hedged') else 0
+            s['hedge_wins_total'] += 1 if record.get('hedge_won') else 0
+            s['prompt_tokens_total'] += record.get('prompt_tokens') or 0
+            s['completion_tokens_total'] += record.get('completion_tokens') or 0
+            s['cost_dollars_total'] += record.get('cost') or 0.0
+
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        lines = []
+        metrics = sorted({m for s in self.series.values() for m in s})
+        for metric in metrics:
+            name = f'{self.prefix}_{metric}'
+            lines.append(f'# TYPE {name} counter')
+            for key, s in sorted(self.series.items()):
+                label_str = ','.join(f'{k}="{v}"' for k, v in key)
+                lines.append(f'{name}{{{label_str}}} {s[metric]}')
+
+        # Write then rename so the collector never reads a half written file.
+        tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+        tmp.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        os.replace(tmp, self.path)
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.series:
+                self._flush()
+
+
+class Telemetry:
+    """
+    Collects a record per instrumented call.  Usually used through the global `telemetry` instance in src.
+
+    Example:
+        with telemetry.tag(asset_key='law_l1_l2'):
+            model.inference(prompt)   # record carries tags={'asset_key': 'law_l1_l2'}
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.aggregator = TelemetryAggregator()
+        self.sinks = []
+        atexit.register(self.close)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def configure_from_env(self):
+        """Add sinks named by MUSR_TELEMETRY_JSONL / MUSR_TELEMETRY_PROM (file paths) if they are set."""
+        if os.environ.get('MUSR_TELEMETRY_JSONL'):
+            self.add_sink(JsonlSink(os.environ['MUSR_TELEMETRY_JSONL']))
+        if os.environ.get('MUSR_TELEMETRY_PROM'):
+            self.add_sink(PrometheusTextfileSink(os.environ['MUSR_TELEMETRY_PROM']))
+
+    def push_tags(self, **tags) -> contextvars.Token:
+        """Add caller tags until pop_tags(token) is called (use tag() when a with block fits)."""
+        return _tags.set({**_tags.get(), **{k: str(v) for k, v in tags.items()}})
+
+    def pop_tags(self, token: contextvars.Token):
+        _tags.reset(token)
+
+    @contextmanager
+    def tag(self, **tags):
+        token = self.push_tags(**tags)
+        try:
+            yield
+        finally:
+            self.pop_tags(token)
+
+    @contextmanager
+    def span(self, model: str, **fields):
+        """
+        Time a call and emit its record when the block exits.  Nested spans (i.e. a validator calling a model) are
+        separate records.
+        """
+        if not self.enabled:
+            yield {}
+            return
+
+        record = {
+            'ts': time.time(),
+            'model': model,
+            'tags': current_tags(),
+            'latency_s': None,
+            'queue_wait_s': None,
+            'retries': 0,
+            'prompt_tokens': None,
+            'completion_tokens': None,
+            'cost': None,
+            'cache_hit': None,
+            'error': None,
+            **fields
+        }
+        token = _record.set(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            record['latency_s'] = time.perf_counter() - start
+            _record.reset(token)
+            self.emit(record)
+
+    def instrumented(self, model_attr: str = 'engine', **fields):
+        """
+        Decorator for model methods: every call becomes a span named after getattr(self, model_attr).  Put it above
+        cache.cached so cache hits are recorded too.
+        """
+        def decorator(f):
+            if inspect.iscoroutinefunction(f):
+                @wraps(f)
+                async def async_wrapper(*args, **kwargs):
+                    model = str(getattr(args[0], model_attr, type(args[0]).__name__))
+                    with self.span(model, method=f.__name__, **fields):
+                        return await f(*args, **kwargs)
+                return async_wrapper
+
+            def call_span(args: tuple):
+                model = str(getattr(args[0], model_attr, type(args[0]).__name__))
+                return self.span(model, method=f.__name__, **fields)
+
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with call_span(args):
+                    return f(*args, **kwargs)
+
+            # cache.cached's call_many runs f itself, give it the span so every call of the batch is recorded too.
+            if hasattr(f, 'call_many'):
+                call_many = f.call_many
+                wrapper.call_many = wraps(call_many)(lambda calls, **kwargs: call_many(calls, span=call_span, **kwargs))
+            return wrapper
+        return decorator
+
+    def emit(self, record: Dict[str, Any]):
+        self.aggregator.add(record)
+        for sink in self.sinks:
+            try:
+                sink.write(record)
+            except Exception as e:
+                print(f'WARNING: telemetry sink {type(sink).__name__} failed: {e}')
+
+    def summary(self) -> List[Dict[str, Any]]:
+        return self.aggregator.summary()
+
+    def report(self) -> str:
+        """Human readable table of the aggregated records."""
+        lines = [f'{"model":<22} {"caller":<40} {"calls":>6} {"hit%":>6} {"p50 s":>7} {"p95 s":>7} {"tokens in/out":>15} {"cost":>8} {"retries":>7} {"hedged":>6} {"errors":>6}']
+        for row in self.summary():
+            caller = ','.join(f'{k}={v}' for k, v in row['tags'].items()) or '-'
+            hit = f'{row["cache_hit_rate"] * 100:.0f}' if row['cache_hit_rate'] is not None else '-'
+            tokens = f'{row["prompt_tokens"]}/{row["completion_tokens"]}'
+            lines.append(
+                f'{row["model"][:22]:<22} {caller[:40]:<40} {row["calls"]:>6} {hit:>6} {row["latency_p50_s"]:>7.2f} '
+                f'{row["latency_p95_s"]:>7.2f} {tokens:>15} {row["cost"]:>8.3f} {row["retries"]:>7} {row["hedged"]:>6} {row["errors"]:>6}'
+            )
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.aggregator.reset()
+
+    def close(self):
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                pass
@@ -1,4 +1,6 @@
 from src.validators.validator import Validator
 from src.validators.types.structure_validator import StructureValidator
 from src.validators.types.forbidden_text_validator import ForbiddenTextValidator
-from src.validators.types.model_validator import ModelValidator
+from src.validators.types.model_validator import ModelValidator, ValidationBatcher
+from src.validators.types.near_duplicate_validator import NearDuplicateValidator, FactIndex
+from src.validators.pipeline import ValidatorPipeline
@@ -0,0 +1,377 @@
+"""
+Local (CPU only) tier for ModelValidator: a logistic model over hashed word and character n-grams, trained on the
+decisions the validation models made before.
+
+Every ModelValidator answer is logged to the cache backend (log_decision, keys decision|<engine>|<tier>|<digest>).
+Train on them and check the model against the validation models' answers with:
+
+  python -m src.validators.local_classifier train [--target-precision 0.99] [--out .cache/validator_classifier.npz]
+  python -m src.validators.local_classifier eval [--model .cache/validator_classifier.npz]
+
+Decisions are split by their (question, deduction) into train, calibration and test: the weights are fit on train,
+the thresholds tuned on calibration, and precision / recall are reported on test only, which neither step has seen.
+
+Labels: with the default --tiers early_escape main, a deduction's label is the answer of the strongest tier that
+answered it, i.e. what ModelValidator decided (the early escape's "valid" where it escaped, GPT-4's answer otherwise).
+The local model answers before the early escape, so that is the decision it replaces.  --tiers main uses GPT-4 answers
+only, but the main model is only asked about deductions the early escape did not accept, so those labels (and the test
+split) are skewed towards doubtful deductions and say little about the ones the early escape waves through.
+
+Use --backend / --path (or MUSR_CACHE_BACKEND / MUSR_CACHE_PATH) to pick the cache.
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import time
+import zlib
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from src import cache
+from src.utils import cache_codec
+from src.utils.paths import ROOT_FOLDER
+from src.utils.redis_cache import RedisCache
+
+
+DECISION_PREFIX = 'decision|'
+DECISION_TTL = timedelta(days=90)
+DEFAULT_MODEL_PATH = ROOT_FOLDER / '.cache' / 'validator_classifier.npz'
+
+# (question, deduction, answer of the model: True = the deduction is valid)
+Example = Tuple[str, str, bool]
+
+WORD = re.compile(r'\w+')
+
+
+def log_decision(question: str, deduction: str, engine: str, tier: str, valid: bool):
+    """Keep a validation model's answer as training data for the local classifier (no-op while the cache is off)."""
+    if cache.disabled:
+        return
+    key = f'{DECISION_PREFIX}{engine}|{tier}|{RedisCache.make_hash([question, deduction])}'
+    record = {'question': question, 'deduction': deduction, 'engine': engine, 'tier': tier, 'valid': valid}
+    try:
+        cache.set_many([(key, record, DECISION_TTL)])
+    except Exception as e:
+        print(f'WARNING: Could not log validator decision: {e}')
+
+
+def iter_decisions(cache: RedisCache, tiers: Tuple[str, ...] = ('early_escape', 'main')) -> Iterator[Tuple[str, dict]]:
+    """(key, decision record) for every logged decision of the given tiers."""
+    for key, payload in cache.iter_entries(match=f'{DECISION_PREFIX}*'):
+        try:
+            record = cache_codec.decode(payload)
+        except Exception:
+            continue
+        if isinstance(record, dict) and record.get('tier') in tiers:
+            yield key, record
+
+
+SPLITS = ('train', 'calibration', 'test')
+
+
+def split_of(question: str, deduction: str, calibration: float, test: float) -> str:
+    """
+    Stable split of a deduction (train and eval put the same deductions in the same split, and every tier's answer to
+    a deduction lands in the same one): the first test share is test, the next calibration share calibration.
+    """
+    x = zlib.crc32(RedisCache.make_hash([question, deduction]).encode('utf-8')) % 10000 / 10000
+    if x < test:
+        return 'test'
+    return 'calibration' if x < test + calibration else 'train'
+
+
+class HashedNgramClassifier:
+    """
+    P(valid) for a (question, deduction) pair from a logistic model over hashed word uni/bigrams and character n-grams of
+    the deduction.  Every n-gram is also hashed together with the question kind (its first paragraph, without the case
+    description) so one model learns the law, econ and proc purity checks apart.
+
+    decide answers True at or above accept_threshold, False at or below reject_threshold (None never rejects, like the
+    early escape model) and None in between, where the LLM tiers have to answer.
+    """
+
+    def __init__(
+            self,
+            n_features: int = 2 ** 18,
+            char_ngram: int = 4,
+            accept_threshold: float = 0.95,
+            reject_threshold: Optional[float] = None
+    ):
+        """
+        :param n_features: Size of the hashed feature space.
+        :param char_ngram: Length of the character n-grams (0 for words only).
+        :param accept_threshold: Lowest P(valid) answered as valid locally.
+        :param reject_threshold: Highest P(valid) answered as invalid locally, None to leave every reject to the LLM.
+        """
+        self.n_features = n_features
+        self.char_ngram = char_ngram
+        self.accept_threshold = accept_threshold
+        self.reject_threshold = reject_threshold
+        self.weights = np.zeros(n_features, dtype=np.float32)
+        self.bias = 0.0
+
+    @staticmethod
+    def question_kind(question: str) -> str:
+        return question.split('\n\n', 1)[0].strip().lower()
+
+    def features(self, question: str, deduction: str) -> np.ndarray:
+        """Indices of the hashed features present (each counted once)."""
+        words = WORD.findall(deduction.lower())
+        grams = [*words, *(f'{a} {b}' for a, b in zip(words, words[1:]))]
+        if self.char_ngram:
+            text = ' '.join(words)
+            grams.extend(f'#{text[i:i + self.char_ngram]}' for i in range(len(text) - self.char_ngram + 1))
+
+        kind = f'{zlib.crc32(self.question_kind(question).encode("utf-8")):x}|'
+        indices = {zlib.crc32(b'^' + kind.encode('utf-8')) % self.n_features}
+        for gram in grams:
+            encoded = gram.encode('utf-8')
+            indices.add(zlib.crc32(encoded) % self.n_features)
+            indices.add(zlib.crc32(kind.encode('utf-8') + encoded) % self.n_features)
+        return np.fromiter(indices, dtype=np.int64, count=len(indices))
+
+    def logit(self, indices: np.ndarray) -> float:
+        # Binary features scaled to unit length, so long and short deductions are on the same scale.
+        return float(self.weights[indices].sum()) / math.sqrt(max(len(indices), 1)) + self.bias
+
+    def predict_proba(self, question: str, deduction: str) -> float:
+        """P(the validation model answers valid)."""
+        z = self.logit(self.features(question, deduction))
+        return 1.0 / (1.0 + math.exp(-max(min(z, 30.0), -30.0)))
+
+    def decide(self, question: str, deduction: str) -> Optional[bool]:
+        """True / False when confident, None to defer to the LLM."""
+        p = self.predict_proba(question, deduction)
+        if p >= self.accept_threshold:
+            return True
+        if self.reject_threshold is not None and p <= self.reject_threshold:
+            return False
+        return None
+
+    def fit(self, examples: List[Example], epochs: int = 8, learning_rate: float = 2.0, l2: float = 1e-6, seed: int = 0):
+        """Logistic regression by SGD, classes weighted so the rarer answer counts as much as the common one."""
+        if not examples:
+            raise ValueError('No examples to train on.')
+        data = [(self.features(q, d), 1.0 if valid else 0.0) for q, d, valid in examples]
+        positives = sum(y for _, y in data)
+        weight = {
+            1.0: len(data) / (2 * positives) if positives else 1.0,
+            0.0: len(data) / (2 * (len(data) - positives)) if positives < len(data) else 1.0,
+        }
+
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate / (1 + epoch)
+            for indices, y in data:
+                scale = 1.0 / math.sqrt(max(len(indices), 1))
+                p = 1.0 / (1.0 + math.exp(-max(min(self.logit(indices), 30.0), -30.0)))
+                gradient = (y - p) * weight[y]
+                self.weights[indices] *= (1.0 - rate * l2)
+                self.weights[indices] += rate * gradient * scale
+                self.bias += rate * gradient
+        return self
+
+    # An accept threshold no probability reaches, the local tier then never accepts.
+    NEVER_ACCEPT = 2.0
+
+    @staticmethod
+    def best_cut(scored: List[Tuple[float, bool]], target_precision: float) -> Optional[float]:
+        """
+        The score of the last cut in scored (ordered from most to least confident) at which the examples up to it agree
+        with the label at least target_precision of the time.  Cuts only fall where the score changes, so examples tied
+        with the cut score are always counted (decide treats every one of them the same).
+        """
+        agreed, threshold = 0, None
+        for i, (p, agrees) in enumerate(scored, start=1):
+            agreed += agrees
+            if i < len(scored) and scored[i][0] == p:
+                continue
+            if agreed / i >= target_precision:
+                threshold = p
+        return threshold
+
+    def tune_thresholds(self, examples: List[Example], target_precision: float, reject: bool = False):
+        """
+        Lowest accept threshold (and with reject, highest reject threshold) whose local answers agree with the examples'
+        labels at least target_precision of the time.  When no accept threshold gets there, local accepts are turned off
+        (NEVER_ACCEPT), when no reject threshold does, local rejects are.  A reject threshold is always below the accept
+        threshold.
+        """
+        scored = sorted(((self.predict_proba(q, d), valid) for q, d, valid in examples), key=lambda x: -x[0])
+
+        threshold = self.best_cut(scored, target_precision)
+        if threshold is None:
+            print(f'WARNING: no accept threshold reaches precision {target_precision} on {len(scored)} examples, '
+                  f'local accepts are off')
+            threshold = self.NEVER_ACCEPT
+        self.accept_threshold = threshold
+
+        if reject:
+            below_accept = [(p, not valid) for p, valid in reversed(scored) if p < self.accept_threshold]
+            self.reject_threshold = self.best_cut(below_accept, target_precision)
+            if self.reject_threshold is None:
+                print(f'WARNING: no reject threshold reaches precision {target_precision}, local rejects are off')
+
+    def evaluate(self, examples: List[Example]) -> Dict[str, Optional[float]]:
+        """Precision and recall of the local accepts (and rejects) against the examples' labels, and the share decided."""
+        counts = {'accept_tp': 0, 'accept_fp': 0, 'reject_tp': 0, 'reject_fp': 0}
+        valid_total = sum(1 for _, _, valid in examples if valid)
+        for q, d, valid in examples:
+            decision = self.decide(q, d)
+            if decision is True:
+                counts['accept_tp' if valid else 'accept_fp'] += 1
+            elif decision is False:
+                counts['reject_tp' if not valid else 'reject_fp'] += 1
+
+        accepted = counts['accept_tp'] + counts['accept_fp']
+        rejected = counts['reject_tp'] + counts['reject_fp']
+        invalid_total = len(examples) - valid_total
+        return {
+            'examples': len(examples),
+            'decided_locally': (accepted + rejected) / len(examples) if examples else None,
+            'accept_precision': counts['accept_tp'] / accepted if accepted else None,
+            'accept_recall': counts['accept_tp'] / valid_total if valid_total else None,
+            'reject_precision': counts['reject_tp'] / rejected if rejected else None,
+            'reject_recall': counts['reject_tp'] / invalid_total if invalid_total else None,
+        }
+
+    def save(self, path: Union[str, Path]):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        config = {
+            'n_features': self.n_features,
+            'char_ngram': self.char_ngram,
+            'accept_threshold': self.accept_threshold,
+            'reject_threshold': self.reject_threshold,
+            'bias': self.bias,
+        }
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, weights=self.weights, config=np.array(json.dumps(config)))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'HashedNgramClassifier':
+        with np.load(path) as data:
+            config = json.loads(str(data['config']))
+            model = cls(
+                n_features=config['n_features'],
+                char_ngram=config['char_ngram'],
+                accept_threshold=config['accept_threshold'],
+                reject_threshold=config['reject_threshold']
+            )
+            model.weights = data['weights'].astype(np.float32)
+            model.bias = config['bias']
+        return model
+
+
+def load_examples(
+        cache: RedisCache,
+        tiers: Tuple[str, ...],
+        calibration: float,
+        test: float
+) -> Dict[str, List[Example]]:
+    """
+    Split -> examples from the logged decisions, one per (question, deduction) labeled with the answer of the last
+    tier in tiers (ordered weakest to strongest) that answered it.
+    """
+    rank = {tier: i for i, tier in enumerate(tiers)}
+    labels: Dict[Tuple[str, str], Tuple[int, bool]] = {}
+    for _, record in iter_decisions(cache, tiers):
+        pair = (record['question'], record['deduction'])
+        if pair not in labels or rank[record['tier']] >= labels[pair][0]:
+            labels[pair] = (rank[record['tier']], bool(record['valid']))
+
+    splits: Dict[str, List[Example]] = {name: [] for name in SPLITS}
+    for (question, deduction), (_, valid) in labels.items():
+        splits[split_of(question, deduction, calibration, test)].append((question, deduction, valid))
+    return splits
+
+
+def format_report(report: Dict[str, Optional[float]]) -> str:
+    return '  '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}' for k, v in report.items())
+
+
+def cmd_train(cache: RedisCache, args):
+    splits = load_examples(cache, tuple(args.tiers), args.calibration, args.test)
+    if not splits['train']:
+        raise SystemExit(f'No logged decisions of tier(s) {", ".join(args.tiers)} to train on.')
+
+    started = time.perf_counter()
+    model = HashedNgramClassifier(n_features=2 ** args.bits, char_ngram=args.char_ngram)
+    model.fit(splits['train'], epochs=args.epochs)
+    print(f'Trained on {len(splits["train"])} decisions in {time.perf_counter() - started:.1f} s')
+
+    if args.target_precision is not None:
+        if splits['calibration']:
+            model.tune_thresholds(splits['calibration'], args.target_precision, reject=args.reject)
+        else:
+            print('WARNING: no calibration decisions to tune the thresholds on, local accepts are off')
+            model.accept_threshold = HashedNgramClassifier.NEVER_ACCEPT
+    print(f'Thresholds: accept >= {model.accept_threshold:.3f}, reject <= {model.reject_threshold} '
+          f'(tuned on {len(splits["calibration"])} calibration decisions)')
+    if splits['test']:
+        print(f'Test: {format_report(model.evaluate(splits["test"]))}')
+
+    model.save(args.out)
+    print(f'Wrote {args.out}')
+
+
+def cmd_eval(cache: RedisCache, args):
+    model = HashedNgramClassifier.load(args.model)
+    splits = load_examples(cache, tuple(args.tiers), args.calibration, args.test)
+    examples = [x for name in SPLITS for x in splits[name]] if args.all else splits['test']
+    if not examples:
+        raise SystemExit('No logged decisions to evaluate on.')
+
+    started = time.perf_counter()
+    report = model.evaluate(examples)
+    elapsed = time.perf_counter() - started
+    print(format_report(report))
+    print(f'{elapsed / len(examples) * 1e6:.0f} us per decision')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train / evaluate the local validator classifier on logged decisions')
+    parser.add_argument('--backend', choices=['auto', 'redis', 'sqlite'], default=None)
+    parser.add_argument('--path', default=None, help='SQLite cache file')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument(
+        '--tiers',
+        nargs='+',
+        default=['early_escape', 'main'],
+        help='Decisions used as labels, weakest to strongest (the strongest answer of a deduction is its label, main '
+             'alone = GPT-4 answers, which only exist for deductions the early escape did not accept)'
+    )
+    parser.add_argument('--calibration', type=float, default=0.2, help='Share of decisions the thresholds are tuned on')
+    parser.add_argument('--test', type=float, default=0.2, help='Share of decisions only used to report on')
+
+    commands = parser.add_subparsers(dest='command', required=True)
+    train = commands.add_parser('train', help='Fit the classifier, tune its thresholds and report on the test split')
+    train.add_argument('--out', default=str(DEFAULT_MODEL_PATH))
+    train.add_argument('--bits', type=int, default=18, help='log2 of the hashed feature space')
+    train.add_argument('--char-ngram', type=int, default=4)
+    train.add_argument('--epochs', type=int, default=8)
+    train.add_argument('--target-precision', type=float, default=0.99, help='Precision the thresholds are tuned to')
+    train.add_argument('--reject', action='store_true', help='Also answer confident rejects locally')
+    evaluate = commands.add_parser('eval', help='Precision / recall of the local answers against the labels')
+    evaluate.add_argument('--model', default=str(DEFAULT_MODEL_PATH))
+    evaluate.add_argument('--all', action='store_true', help='Evaluate on every decision, not only the test split')
+    args = parser.parse_args()
+
+    cache = RedisCache(host=args.host, port=args.port, db=args.db, backend=args.backend, path=args.path)
+    if cache.disabled:
+        raise SystemExit('No cache backend available.')
+
+    {'train': cmd_train, 'eval': cmd_eval}[args.command](cache, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import contextvars
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from src.logic_tree.tree import LogicNode
+from src.validators.validator import Validator
+
+
+class ValidatorPipeline:
+    """
+    Runs a set of validators on a deduction cheapest first and stops at the first failure, so an output a free check
+    rejects never reaches an LLM validator.
+
+    Validators are ordered by their cost_rank (structure, then forbidden text, then model) and within a rank by their
+    measured run time (an exponential moving average).  Validators at or above expensive_rank that are still left once
+    the cheap ones passed run concurrently.  Results are memoized per (validator, node context, output), so the same
+    output seen again on a retry or by another worker sharing the pipeline is not revalidated.  The memo assumes a
+    validator's result only depends on those, validators with memoizable = False always run.
+
+    Call it like a single validator: pipeline(template, explicit_facts, commonsense_facts, raw_output) returns
+    (valid, retry_prompt).  Iterating it yields the validators in their current order (for validate_partial).
+    """
+
+    def __init__(
+            self,
+            validators: Union[Validator, Sequence[Validator]],
+            on_accept: Optional[Callable[[LogicNode, List[str], List[str], str], None]] = None,
+            expensive_rank: int = Validator.EXPENSIVE_COST_RANK,
+            max_workers: int = 4,
+            memo_size: int = 4096,
+            ema_alpha: float = 0.2
+    ):
+        """
+        :param validators: The validators (a single validator is fine too).
+        :param on_accept: Called with (template, explicit_facts, commonsense_facts, raw_output) when every validator
+            accepted a deduction.
+        :param expensive_rank: Validators with at least this cost_rank run concurrently with each other.
+        :param max_workers: Threads for the expensive validators (1 runs them one by one, still short-circuiting).
+        :param memo_size: Max memoized results (oldest dropped first), 0 turns memoization off.
+        :param ema_alpha: Weight of the newest run time in the moving average.
+        """
+        if isinstance(validators, Validator):
+            validators = [validators]
+        self.validators: List[Validator] = list(validators)
+        self.on_accept = on_accept
+        self.expensive_rank = expensive_rank
+        self.max_workers = max_workers
+        self.memo_size = memo_size
+        self.ema_alpha = ema_alpha
+
+        # id(validator) -> seconds per run; the pipeline holds the validators so their ids stay unique.
+        self.ema_s: Dict[int, float] = {}
+        self.memo: 'OrderedDict[Tuple[int, str, str], Tuple[bool, Optional[str]]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.calls = 0
+        self.memo_hits = 0
+        self.short_circuits = 0
+
+    def __iter__(self) -> Iterator[Validator]:
+        return iter(self.ordered())
+
+    def __len__(self) -> int:
+        return len(self.validators)
+
+    def ordered(self) -> List[Validator]:
+        with self.lock:
+            return sorted(self.validators, key=lambda v: (v.cost_rank, self.ema_s.get(id(v), 0.0)))
+
+    def __call__(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str],
+            raw_output: str,
+            *args,
+            **kwargs
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        :return: (True, None) if every validator accepts, otherwise (False, retry prompt of the first validator in
+            order that rejected).
+        """
+        node_key = self.node_key(template)
+        output_key = self.output_key(explicit_facts, commonsense_facts, raw_output)
+        call = (template, explicit_facts, commonsense_facts, raw_output, *args)
+        with self.lock:
+            self.calls += 1
+
+        ordered = self.ordered()
+        cheap = [v for v in ordered if v.cost_rank < self.expensive_rank]
+        expensive = [v for v in ordered if v.cost_rank >= self.expensive_rank]
+
+        for validator in cheap:
+            valid, retry_prompt = self.run(validator, node_key, output_key, call, kwargs)
+            if not valid:
+                self.count_short_circuit(validator, ordered)
+                return valid, retry_prompt
+
+        if len(expensive) > 1 and self.max_workers > 1:
+            results = self.run_concurrently(expensive, node_key, output_key, call, kwargs)
+        else:
+            results = []
+            for validator in expensive:
+                results.append(self.run(validator, node_key, output_key, call, kwargs))
+                if not results[-1][0]:
+                    break
+
+        for validator, (valid, retry_prompt) in zip(expensive, results):
+            if not valid:
+                self.count_short_circuit(validator, ordered)
+                return valid, retry_prompt
+
+        if self.on_accept is not None:
+            self.on_accept(template, explicit_facts, commonsense_facts, raw_output)
+        return True, None
+
+    def run(
+            self,
+            validator: Validator,
+            node_key: str,
+            output_key: str,
+            call: tuple,
+            kwargs: dict
+    ) -> Tuple[bool, Optional[str]]:
+        """One validator through the memo (unless it isn't memoizable), timing real runs."""
+        key = (id(validator), node_key, output_key)
+        memoize = self.memo_size > 0 and validator.memoizable
+        if memoize:
+            with self.lock:
+                result = self.memo.get(key)
+                if result is not None:
+                    self.memo.move_to_end(key)
+                    self.memo_hits += 1
+                    return result
+
+        started = time.perf_counter()
+        result = validator(*call, **kwargs)
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            previous = self.ema_s.get(id(validator))
+            self.ema_s[id(validator)] = elapsed if previous is None else previous + self.ema_alpha * (elapsed - previous)
+            if memoize:
+                self.memo[key] = result
+                while len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+        return result
+
+    def run_concurrently(
+            self,
+            validators: List[Validator],
+            node_key: str,
+            output_key: str,
+            call: tuple,
+            kwargs: dict
+    ) -> List[Tuple[bool, Optional[str]]]:
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(validators)), thread_name_prefix='validator')
+        try:
+            # Each validator runs in a copy of the caller's context so its model calls keep the caller's telemetry tags.
+            futures = [
+                executor.submit(contextvars.copy_context().run, self.run, v, node_key, output_key, call, kwargs)
+                for v in validators
+            ]
+            results = []
+            for future in futures:
+                results.append(future.result())
+                if not results[-1][0]:
+                    break
+            return results
+        finally:
+            # Validators that haven't started yet are not needed anymore once one rejected.
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def count_short_circuit(self, failed: Validator, ordered: List[Validator]):
+        if ordered and ordered[-1] is not failed:
+            with self.lock:
+                self.short_circuits += 1
+
+    @staticmethod
+    def node_key(template: LogicNode) -> str:
+        """What validators look at besides the output: the node, its parents and the fact types it asks for."""
+        h = hashlib.blake2b(digest_size=16)
+        p = template
+        while p is not None:
+            h.update(p.value.encode('utf-8') + b'\x00')
+            p = p.parent
+        h.update(b'\x01' + ','.join(str(c.fact_type) for c in template.children).encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def output_key(explicit_facts: List[str], commonsense_facts: List[str], raw_output: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for part in (*explicit_facts, '\x01', *commonsense_facts, '\x01', raw_output):
+            h.update(part.encode('utf-8') + b'\x00')
+        return h.hexdigest()
+
+    def stats(self) -> Dict[str, object]:
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'memo_hits': self.memo_hits,
+                'short_circuits': self.short_circuits,
+                'ema_s': {type(v).__name__ + f'#{i}': self.ema_s.get(id(v)) for i, v in enumerate(self.validators)},
+            }
@@ -1,10 +1,58 @@
-from typing import List, Union, Tuple
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Pattern, Tuple, Union
 
 
 from src.logic_tree.tree import LogicNode, LogicNodeFactType
 from src.validators.validator import Validator
 
 
+# Joins the facts (and the parent node values) into one text to scan, never part of a word so no match spans two facts.
+SEPARATOR = '\x00'
+
+
+class WordMatcher:
+    """
+    Finds which of a fixed list of words occur in an already lowercased text.
+
+    Plain substring matching runs one C level substring search per word over the whole text (for the word list sizes
+    used here that beats a single regex alternation, which CPython's regex engine tries branch by branch at every
+    position).  Whole word matching needs the regex: one alternation, longest words first, between word boundaries.
+    """
+
+    def __init__(self, words: Tuple[str, ...], word_boundaries: bool = False):
+        """
+        :param words: The words, matched case-insensitively.
+        :param word_boundaries: Only match whole words (no letter/digit/underscore right before or after).
+        """
+        self.words = tuple(dict.fromkeys(w.lower() for w in words))
+        self.pattern: Optional[Pattern] = None
+        # word -> its own whole word pattern, to recheck words that only occur inside a longer match
+        self.word_patterns: Dict[str, Pattern] = {}
+        if word_boundaries and self.words:
+            alternation = '|'.join(re.escape(w) for w in sorted(self.words, key=lambda w: (-len(w), w)))
+            self.pattern = re.compile(rf'(?<!\w)(?:{alternation})(?!\w)')
+            self.word_patterns = {w: re.compile(rf'(?<!\w){re.escape(w)}(?!\w)') for w in self.words}
+
+    def found(self, text: str) -> List[str]:
+        """The words occurring in text (lowercased), in list order."""
+        if self.pattern is None:
+            return [w for w in self.words if w in text]
+        matches = {m.group(0) for m in self.pattern.finditer(text)}
+        if not matches:
+            return []
+        # Matches don't overlap, so a word inside a longer match ("tax" in "tax return") or overlapping one ("b c"
+        # after "a b" in "a b c") is hidden by it.  Every word not matched is searched again on its own.
+        return [w for w in self.words if w in matches or self.word_patterns[w].search(text) is not None]
+
+
+@lru_cache(maxsize=256)
+def word_matcher(words: Tuple[str, ...], word_boundaries: bool = False) -> WordMatcher:
+    """The matcher for a word list, built once per distinct list and shared by every validator using it."""
+    return WordMatcher(words, word_boundaries)
+
+
 class ForbiddenTextValidator(Validator):
     """
     A validator that checks the text of the explicit and commonsense facts for keywords.  If they appear, the deduction
@@ -12,22 +60,96 @@ class ForbiddenTextValidator(Validator):
 
     You can also condition the keywords based on parent node content (prune deductions mentioning "motive" in the
     "means" branch for example.)
+
+    The facts are joined and lowercased once per check, the words are grouped into one shared WordMatcher for the
+    unconditional words and one per condition, and the parents are only scanned once for all conditions.
     """
 
     def __init__(
             self,
             forbidden_words: List[Union[Tuple[str, str], str]],
-            reason_why: str = None
+            reason_why: str = None,
+            word_boundaries: bool = False
     ):
         """
         :param forbidden_words: A list where strings are forbidden words anywhere, a sublist is formatted as
             [conditional word, forbidden word] where the "conditional word" must appear in a parent branch before we
             check for the "forbidden word" in the new deduction.
         :param reason_why: Used in the retry prompt to explain why we don't want a specific word.
+        :param word_boundaries: Only forbid whole words ("tax" would not match "taxation"), off by default so any
+            substring matches like before.
         """
 
         self.forbidden_words = [x for x in forbidden_words if x != '']
         self.reason_why = reason_why
+        self.word_boundaries = word_boundaries
+
+        unconditional: List[str] = []
+        # condition (lowercased) -> forbidden words, in list order
+        self.conditional_words: Dict[str, List[str]] = {}
+        for word in self.forbidden_words:
+            if isinstance(word, str):
+                unconditional.append(word)
+            else:
+                self.conditional_words.setdefault(word[0].lower(), []).append(word[1])
+
+        self.unconditional_words = unconditional
+        self.unconditional_matcher = word_matcher(tuple(unconditional), word_boundaries)
+        self.conditional_matchers = {
+            condition: word_matcher(tuple(words), word_boundaries)
+            for condition, words in self.conditional_words.items()
+        }
+
+        # The last check per thread, retry_prompt follows validate on the same thread with the same arguments.
+        self.memo = threading.local()
+
+    def check(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str]
+    ) -> Tuple[List[str], List[str]]:
+        """
+        :return: (forbidden words that apply to this node, the ones of them found in the facts) in list order.
+        """
+        key = (id(template), getattr(template, 'value', None), tuple(explicit_facts), tuple(commonsense_facts))
+        memo = getattr(self.memo, 'last', None)
+        if memo is not None and memo[0] == key:
+            return memo[1]
+
+        active = self.active_conditions(template)
+        applicable = list(self.unconditional_words)
+        matchers = [self.unconditional_matcher]
+        for condition, words in self.conditional_words.items():
+            if condition in active:
+                applicable.extend(words)
+                matchers.append(self.conditional_matchers[condition])
+
+        text = SEPARATOR.join([*explicit_facts, *commonsense_facts]).lower()
+        found = set()
+        for matcher in matchers:
+            found.update(matcher.found(text))
+
+        hits = []
+        for word in applicable:
+            if word.lower() in found and word not in hits:
+                hits.append(word)
+
+        result = (applicable, hits)
+        self.memo.last = (key, result)
+        return result
+
+    def active_conditions(self, template: LogicNode) -> set:
+        """The conditions that appear in the node or any of its parents (lowercased once, whatever the word count)."""
+        if not self.conditional_words:
+            return set()
+        values = []
+        p = template
+        while p is not None:
+            values.append(p.value)
+            p = p.parent
+        ancestry = SEPARATOR.join(values).lower()
+        return {condition for condition in self.conditional_words if condition in ancestry}
 
     def validate(
             self,
@@ -38,30 +160,20 @@ class ForbiddenTextValidator(Validator):
             *args,
             **kwargs
     ) -> bool:
+        _, hits = self.check(template, explicit_facts, commonsense_facts)
+        return not hits
 
-        for word in self.forbidden_words:
-            if isinstance(word, str):
-                # If it's just a word, check the deduction as is.
-                forbidden_word = word
-            else:
-                # If it's a list, check if the conditional word appears in any parent nodes, then check the deduction.
-                conditional_text = word[0]
-                forbidden_word = word[1]
-
-                check_validity = False
-
-                p = template
-                while p is not None:
-                    if conditional_text.lower() in p.value.lower():
-                        check_validity = True
-                        break
-                    p = p.parent
-
-                if not check_validity:
-                    continue
-            if any([forbidden_word.lower() in x.lower() for x in explicit_facts]) or  any([forbidden_word.lower() in x.lower() for x in commonsense_facts]):
-                return False
-        return True
+    def validate_partial(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str],
+            raw_output: str,
+            *args,
+            **kwargs
+    ) -> bool:
+        # A forbidden word in any finished fact already fails the whole deduction.
+        return self.validate(template, explicit_facts, commonsense_facts, raw_output, *args, **kwargs)
 
     def retry_prompt(
             self,
@@ -72,30 +184,12 @@ class ForbiddenTextValidator(Validator):
             *args,
             **kwargs
     ) -> str:
-        used_forbidden_words = []
-        for word in self.forbidden_words:
-            if isinstance(word, str):
-                forbidden_word = word
-            else:
-                conditional_text = word[0]
-                forbidden_word = word[1]
-
-                check_validity = False
-
-                p = template.parent
-                while p is not None:
-                    if conditional_text.lower() in p.value.lower():
-                        check_validity = True
-                        break
-                    p = p.parent
-
-                if not check_validity:
-                    continue
-            used_forbidden_words.append(forbidden_word)
+        # Reuses the check validate just did for these facts (no second pass over the parents or the facts).
+        used_forbidden_words, _ = self.check(template, explicit_facts, commonsense_facts)
         used_forbidden_words_str = '\n'.join([f'- {x}' for x in used_forbidden_words])
         reason_str = f'\nThe reason why we want to avoid using these is because {self.reason_why}' if self.reason_why else ''
         return f'''
-        
+
 Your old output:
 
 {raw_output}
@@ -1,9 +1,17 @@
+import re
 import sys
-from typing import List, Union, Tuple, Optional
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Union, Tuple, Optional
 
 from src.logic_tree.tree import LogicNode, LogicNodeFactType
 from src.validators.validator import Validator
-from src.model import Model
+from src.model import Model, ModelAPIError, ModelRouter
+from src.model.response import CompletionResponse
+from src import telemetry
+
+if TYPE_CHECKING:
+    from src.validators.local_classifier import HashedNgramClassifier
 
 
 class ModelValidator(Validator):
@@ -12,6 +20,9 @@ class ModelValidator(Validator):
 
     You can specify an early escape model if one model has a low false positive rate (we use gpt3.5 to early escape)
     """
+
+    cost_rank = Validator.EXPENSIVE_COST_RANK
+
     def __init__(
             self,
             model: Model,
@@ -19,7 +30,13 @@ class ModelValidator(Validator):
             reason_why: str,
             answer_for_validity: str = 'no',
             conditional: Optional[str] = None,
-            early_escape_model: Optional[Model] = None
+            early_escape_model: Optional[Model] = None,
+            result_on_api_error: Optional[bool] = None,
+            router: Optional[ModelRouter] = None,
+            route_step: Optional[str] = None,
+            batcher: Optional['ValidationBatcher'] = None,
+            local_model: Optional['HashedNgramClassifier'] = None,
+            log_decisions: bool = True
     ):
         """
         :param model: The main model you will prompt.
@@ -29,6 +46,16 @@ class ModelValidator(Validator):
         :param conditional: Conditional content/word that a parent node must have before calling this.
         :param early_escape_model: Model that is called first and if it matches answer_for_validity we escape before
             calling the main model.
+        :param result_on_api_error: What validate returns when the main model fails (ModelAPIError, including an open
+            circuit).  None re-raises the error.  A failing early escape model always falls through to the main model.
+        :param router: If given, every answer is recorded on the router under route_step (passed = the deduction was
+            accepted) so its report shows how often each validation model accepts.
+        :param route_step: Step name the answers are recorded under.
+        :param batcher: If given, questions to a model are asked together with the ones other validators (on other
+            threads) are waiting for at the same time, see ValidationBatcher.
+        :param local_model: Local classifier asked before the early escape model, its confident answers are final and
+            only the uncertain deductions go to the models (see local_classifier).
+        :param log_decisions: Log the models' answers to the cache backend as training data for the local classifier.
         """
 
         self.model = model
@@ -37,6 +64,18 @@ class ModelValidator(Validator):
         self.answer_for_validity = answer_for_validity
         self.condtional = conditional
         self.early_escape_model = early_escape_model
+        self.result_on_api_error = result_on_api_error
+        self.router = router
+        self.route_step = route_step
+        self.batcher = batcher
+        self.local_model = local_model
+        self.log_decisions = log_decisions
+
+    def record(self, model: Model, passed: bool, started: float, cost_before: float):
+        if self.router is None or self.route_step is None:
+            return
+        cost = model.total_cost - cost_before if hasattr(model, 'total_cost') else None
+        self.router.record(self.route_step, getattr(model, 'engine', type(model).__name__), passed, time.perf_counter() - started, cost)
 
     def validate(
             self,
@@ -61,23 +100,54 @@ class ModelValidator(Validator):
             if not check_validity:
                 return True
 
+        if self.local_model is not None:
+            started = time.perf_counter()
+            local = self.local_model.decide(self.prompt, raw_output)
+            if local is not None:
+                if self.router is not None and self.route_step is not None:
+                    self.router.record(self.route_step, 'local', local, time.perf_counter() - started, 0.0)
+                return local
+
         if self.early_escape_model:
-            early_prompt = f'{self.prompt}\n\nThe Deduction:\n{raw_output}\n\nWrite your answer in the following format:\nANSWER: (yes/no)'
-            early_output = self.early_escape_model.inference(early_prompt)
-            early_output = early_output.choices[0]['message']['content']
-            early_answer = early_output.split('ANSWER:')[-1]
+            started, cost_before = time.perf_counter(), getattr(self.early_escape_model, 'total_cost', 0.0)
+            try:
+                with telemetry.tag(validator=type(self).__name__, tier='early_escape'):
+                    early_answer = self.ask(self.early_escape_model, raw_output, reasoning=False)
 
-            if self.answer_for_validity.lower() in early_answer.lower():
-                return True
+                escaped = self.answer_for_validity.lower() in early_answer.lower()
+                self.record(self.early_escape_model, escaped, started, cost_before)
+                self.log(self.early_escape_model, 'early_escape', raw_output, escaped)
+                if escaped:
+                    return True
+            except ModelAPIError as e:
+                print(f'WARNING: early escape model unavailable, asking the main model: {e}')
 
-        prompt = f'{self.prompt}\n\nThe Deduction:\n{raw_output}\n\nWrite a short description of your reasoning then answer in the following format:\nANSWER: (yes/no)'
-        output = self.model.inference(prompt)
-        output = output.choices[0]['message']['content']
-        answer = output.split('ANSWER:')[-1]
+        started, cost_before = time.perf_counter(), getattr(self.model, 'total_cost', 0.0)
+        try:
+            with telemetry.tag(validator=type(self).__name__, tier='main'):
+                answer = self.ask(self.model, raw_output, reasoning=True)
+        except ModelAPIError as e:
+            if self.result_on_api_error is None:
+                raise
+            print(f'WARNING: validator model unavailable, treating the deduction as {"valid" if self.result_on_api_error else "invalid"}: {e}')
+            return self.result_on_api_error
 
-        if self.answer_for_validity.lower() in answer.lower():
-            return True
-        return False
+        valid = self.answer_for_validity.lower() in answer.lower()
+        self.record(self.model, valid, started, cost_before)
+        self.log(self.model, 'main', raw_output, valid)
+        return valid
+
+    def log(self, model: Model, tier: str, raw_output: str, valid: bool):
+        if self.log_decisions:
+            # Imported here, so running `python -m src.validators.local_classifier` doesn't find it imported already.
+            from src.validators.local_classifier import log_decision
+            log_decision(self.prompt, raw_output, getattr(model, 'engine', type(model).__name__), tier, valid)
+
+    def ask(self, model: Model, raw_output: str, reasoning: bool) -> str:
+        """The model's answer for this deduction, through the batcher if there is one."""
+        if self.batcher is not None:
+            return self.batcher.ask(model, self.prompt, raw_output, reasoning)
+        return ask_single(model, self.prompt, raw_output, reasoning)
 
     def retry_prompt(
             self,
@@ -97,3 +167,224 @@ This is incorrect.
 
 {self.reason_why}
         '''
+
+
+def single_prompt(question: str, deduction: str, reasoning: bool) -> str:
+    if reasoning:
+        return f'{question}\n\nThe Deduction:\n{deduction}\n\nWrite a short description of your reasoning then answer in the following format:\nANSWER: (yes/no)'
+    return f'{question}\n\nThe Deduction:\n{deduction}\n\nWrite your answer in the following format:\nANSWER: (yes/no)'
+
+
+def batch_prompt(items: List['PendingQuestion'], reasoning: bool) -> str:
+    """One prompt for several deductions, every distinct question is written once and answered per deduction."""
+    questions: Dict[str, int] = {}
+    for item in items:
+        questions.setdefault(item.question, len(questions) + 1)
+
+    parts = [f'Answer the question for each of the {len(items)} deductions below independently.']
+    for question, q in questions.items():
+        parts.append(f'QUESTION {q}:\n{question}')
+    for i, item in enumerate(items, start=1):
+        parts.append(f'DEDUCTION {i} (answer QUESTION {questions[item.question]}):\n{item.deduction}')
+    if reasoning:
+        parts.append('For every deduction, in order, write a short description of your reasoning then answer in the '
+                     'following format:\nANSWER <deduction number>: (yes/no)')
+    else:
+        parts.append('For every deduction, in order, answer in the following format:\nANSWER <deduction number>: (yes/no)')
+    return '\n\n'.join(parts)
+
+
+def ask_single(model: Model, question: str, deduction: str, reasoning: bool) -> str:
+    output = model.inference(single_prompt(question, deduction, reasoning))
+    return output.choices[0]['message']['content'].split('ANSWER:')[-1]
+
+
+class PendingQuestion:
+    """One deduction waiting in a ValidationBatcher batch."""
+
+    def __init__(self, question: str, deduction: str):
+        self.question = question
+        self.deduction = deduction
+        self.answer: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        # cache key of its single deduction prompt, if the model's inference is cached (see ValidationBatcher.send)
+        self.key: Optional[str] = None
+        self.done = threading.Event()
+
+
+class PendingBatch:
+    def __init__(self):
+        self.items: List[PendingQuestion] = []
+        self.full = threading.Event()
+
+
+class ValidationBatcher:
+    """
+    Gathers the questions ModelValidators on different threads (parallel node expansions) ask the same model at the
+    same time and sends up to max_batch of them in one prompt with an "ANSWER <i>:" line per deduction, so the
+    instructions and the case description are sent once per batch instead of once per deduction.
+
+    The first caller of a batch waits up to max_wait_s for more questions (or until the batch is full), sends it and
+    hands every caller its own answer.  Batches are only as large as the number of validators asking at the same time,
+    so with the two case trees of a run expanding in parallel they mostly hold two deductions (stats() reports the
+    sizes actually sent).
+
+    The batch prompt depends on which questions happened to arrive together, so it is not what gets reused from the
+    cache: every deduction is first looked up under its single deduction prompt (the entry an unbatched run writes),
+    only the misses are sent, and each batched answer is cached under its single deduction prompt afterwards.  A batch
+    of one is asked with the single deduction prompt, and deductions the batched answer has no line for are asked on
+    their own.  A ModelAPIError of the batched call is raised to every caller, which handles it like an unbatched
+    failure.
+    """
+
+    ANSWER_LINE = re.compile(r'^\W*ANSWER\W*(\d+)\W*:\s*(.*)$', re.IGNORECASE | re.MULTILINE)
+
+    def __init__(self, max_batch: int = 8, max_wait_s: float = 0.05):
+        """
+        :param max_batch: Most deductions per prompt.
+        :param max_wait_s: How long the first question of a batch waits for others before it is sent anyway.
+        """
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_s
+
+        # (id(model), reasoning) -> batch still taking questions
+        self.open: Dict[Tuple[int, bool], PendingBatch] = {}
+        self.lock = threading.Lock()
+
+        self.questions = 0
+        self.requests = 0
+        self.fallbacks = 0
+        self.cached = 0
+        # deductions per sent prompt -> prompts
+        self.batch_sizes: Dict[int, int] = {}
+
+    def ask(self, model: Model, question: str, deduction: str, reasoning: bool) -> str:
+        """The text after this deduction's ANSWER marker (blocks until its batch was answered)."""
+        item = PendingQuestion(question, deduction)
+        key = (id(model), reasoning)
+        with self.lock:
+            self.questions += 1
+            batch = self.open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.open[key] = PendingBatch()
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                del self.open[key]
+                batch.full.set()
+
+        if leader:
+            if self.max_batch > 1:
+                batch.full.wait(self.max_wait_s)
+            with self.lock:
+                if self.open.get(key) is batch:
+                    del self.open[key]
+            self.send(model, batch.items, reasoning)
+
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.answer
+
+    def send(self, model: Model, items: List[PendingQuestion], reasoning: bool):
+        try:
+            items = self.answer_cached(model, items, reasoning)
+            if not items:
+                return
+            self.count(requests=1, batch_size=len(items))
+            if len(items) == 1:
+                items[0].answer = ask_single(model, items[0].question, items[0].deduction, reasoning)
+                return
+
+            with telemetry.tag(batch='yes'):
+                output = model.inference(batch_prompt(items, reasoning))
+            answers = {}
+            for match in self.ANSWER_LINE.finditer(output.choices[0]['message']['content']):
+                answers.setdefault(int(match.group(1)), match.group(2))
+
+            answered = []
+            for i, item in enumerate(items, start=1):
+                if i in answers:
+                    item.answer = answers[i]
+                    answered.append(item)
+                else:
+                    self.count(requests=1, fallbacks=1)
+                    item.answer = ask_single(model, item.question, item.deduction, reasoning)
+            self.store_answers(model, answered, reasoning)
+        except BaseException as e:
+            for item in items:
+                if item.answer is None:
+                    item.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            for item in items:
+                item.done.set()
+
+    @staticmethod
+    def single_calls(model: Model, items: List[PendingQuestion], reasoning: bool) -> List[Tuple[tuple, dict]]:
+        return [((model, single_prompt(item.question, item.deduction, reasoning)), {}) for item in items]
+
+    def answer_cached(self, model: Model, items: List[PendingQuestion], reasoning: bool) -> List[PendingQuestion]:
+        """
+        Answer the items the cache has an answer for under their single deduction prompt (from unbatched runs or an
+        earlier batch), and return the rest, which still need to be asked.
+        """
+        lookup = getattr(model.inference, 'lookup', None)
+        if lookup is None or len(items) < 2:
+            return items
+
+        misses = []
+        for item, (key, hit, output) in zip(items, lookup(self.single_calls(model, items, reasoning))):
+            if hit:
+                item.answer = output.choices[0]['message']['content'].split('ANSWER:')[-1]
+                item.done.set()
+            else:
+                item.key = key
+                misses.append(item)
+        self.count(cached=len(items) - len(misses))
+        return misses
+
+    def store_answers(self, model: Model, items: List[PendingQuestion], reasoning: bool):
+        """Cache every batched answer under its single deduction prompt, so later runs find it batched or not."""
+        store = getattr(model.inference, 'store', None)
+        if store is None:
+            return
+        store([
+            (item.key, CompletionResponse.from_record({
+                'v': CompletionResponse.VERSION,
+                'model': getattr(model, 'engine', None),
+                'choices': [{
+                    'index': 0,
+                    'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': f'ANSWER: {item.answer}'}
+                }],
+                'usage': None
+            }))
+            for item in items
+        ])
+
+    def count(self, requests: int = 0, fallbacks: int = 0, cached: int = 0, batch_size: int = None):
+        with self.lock:
+            self.requests += requests
+            self.fallbacks += fallbacks
+            self.cached += cached
+            if batch_size is not None:
+                self.batch_sizes[batch_size] = self.batch_sizes.get(batch_size, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Questions asked, answered from the cache, requests sent (batches, single prompts and fallbacks), fallbacks and
+        the sizes of the sent batches (deductions per prompt -> prompts, the mean and the largest).
+        """
+        with self.lock:
+            sent = sum(self.batch_sizes.values())
+            return {
+                'questions': self.questions,
+                'cached': self.cached,
+                'requests': self.requests,
+                'fallbacks': self.fallbacks,
+                'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                'mean_batch': sum(size * n for size, n in self.batch_sizes.items()) / sent if sent else 0.0,
+                'max_batch': max(self.batch_sizes, default=0),
+            }
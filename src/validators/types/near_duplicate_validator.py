@@ -0,0 +1,237 @@
+import json
+import re
+import threading
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from src.logic_tree.tree import LogicNode, LogicNodeFactType
+from src.validators.validator import Validator
+
+
+WORD = re.compile(r'\w+')
+
+
+class FactIndex:
+    """
+    Every fact generated so far (in a run, optionally seeded with the facts of a dataset) as character shingle sets
+    with MinHash signatures in an LSH index, so the facts most like a new one are found without comparing it to all of
+    them.
+
+    A fact is a near-duplicate of an indexed one when the Jaccard similarity of their shingle sets is at least
+    threshold.  LSH candidates (facts sharing one band of the signature) are confirmed on the exact shingle sets, so
+    the index never reports a pair below the threshold, and with the default 16 bands of 4 rows a pair at 0.8 is a
+    candidate over 99.9% of the time.  Thread safe, one index is shared by every worker of a run.
+    """
+
+    def __init__(
+            self,
+            threshold: float = 0.8,
+            num_perm: int = 64,
+            bands: int = 16,
+            shingle_size: int = 5,
+            seed: int = 0
+    ):
+        """
+        :param threshold: Jaccard similarity of the shingle sets at which two facts are near-duplicates.
+        :param num_perm: MinHash signature length.
+        :param bands: LSH bands (num_perm must be a multiple), more bands find less similar candidates.
+        :param shingle_size: Characters per shingle (of the lowercased words joined by single spaces).
+        :param seed: Seed of the MinHash permutations.
+        """
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        # MinHash permutations x -> a * x + b (mod 2**64, numpy wraps around), with odd a so each is a bijection.
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) << np.uint64(1) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64)
+
+        self.facts: List[str] = []
+        self.shingle_sets: List[FrozenSet[int]] = []
+        # (band, band bytes) -> indices of the facts in that bucket
+        self.buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.facts)
+
+    def shingles(self, text: str) -> FrozenSet[int]:
+        """
+        Hashes of the text's character shingles.  Python's str hash is only stable within a process, which is all an
+        index needs (it is built, seeded and queried in the same run).
+        """
+        normalized = ' '.join(WORD.findall(text.lower()))
+        k = self.shingle_size
+        return frozenset([hash(normalized[i:i + k]) for i in range(max(len(normalized) - k + 1, 1))])
+
+    def signature(self, shingles: FrozenSet[int]) -> np.ndarray:
+        x = np.fromiter(shingles, dtype=np.int64, count=len(shingles)).view(np.uint64)
+        return (self.a * x + self.b).min(axis=1)
+
+    def band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    @staticmethod
+    def jaccard(a: FrozenSet[int], b: FrozenSet[int]) -> float:
+        return len(a & b) / len(a | b) if a or b else 1.0
+
+    def query(self, text: str, shingles: FrozenSet[int] = None) -> Optional[Tuple[str, float]]:
+        """(most similar indexed fact, similarity) if any reaches the threshold, otherwise None."""
+        if shingles is None:
+            shingles = self.shingles(text)
+        keys = self.band_keys(self.signature(shingles))
+        with self.lock:
+            candidates = set()
+            for key in keys:
+                candidates.update(self.buckets.get(key, ()))
+            best = None
+            for i in candidates:
+                similarity = self.jaccard(shingles, self.shingle_sets[i])
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (self.facts[i], similarity)
+        return best
+
+    def add(self, text: str):
+        if not text or not text.strip():
+            return
+        shingles = self.shingles(text)
+        keys = self.band_keys(self.signature(shingles))
+        with self.lock:
+            i = len(self.facts)
+            self.facts.append(text)
+            self.shingle_sets.append(shingles)
+            for key in keys:
+                self.buckets.setdefault(key, []).append(i)
+
+    def add_many(self, texts: Iterable[str]):
+        for text in texts:
+            self.add(text)
+
+    def add_deduction(self, template: LogicNode, explicit_facts: List[str], commonsense_facts: List[str], raw_output: str):
+        """ValidatorPipeline on_accept hook: index the explicit facts of an accepted deduction."""
+        self.add_many(explicit_facts)
+
+    @classmethod
+    def from_dataset(cls, path: Union[str, Path], **kwargs) -> 'FactIndex':
+        """An index seeded with the generated explicit facts of every reasoning tree in a dataset file (if it exists)."""
+        index = cls(**kwargs)
+        path = Path(path)
+        if not path.exists():
+            return index
+        for item in json.loads(path.read_text(encoding='utf-8')):
+            for question in item.get('questions', []):
+                for trees in question.get('intermediate_trees', []):
+                    for tree in trees:
+                        for node in tree.get('nodes', []):
+                            index.add_many(explicit_values(node))
+        return index
+
+
+def explicit_values(node: dict, depth: int = 0, min_depth: int = 2) -> Iterable[str]:
+    """
+    Values of the explicit fact nodes in tree json, from min_depth down (the root and the level-1 element nodes are
+    written from templates, not generated, and the same for every case).
+    """
+    if depth >= min_depth and node.get('fact_type') == LogicNodeFactType.EXPLICIT and node.get('value'):
+        yield node['value']
+    for child in node.get('children', []):
+        yield from explicit_values(child, depth + 1, min_depth)
+
+
+class NearDuplicateValidator(Validator):
+    """
+    Rejects deductions with an explicit fact that is (nearly) the same as another fact of the deduction, or as any fact
+    already in the FactIndex (earlier nodes, the other case of the comparison, the seeded dataset).  Accepted facts are
+    added to the index by the pipeline (ValidatorPipeline(on_accept=index.add_deduction)), so a rejected deduction never
+    blocks its own retry.  The index grows during the run, so the pipeline must not reuse an earlier result.
+    """
+
+    cost_rank = 1
+    memoizable = False
+
+    def __init__(self, index: FactIndex, include_commonsense: bool = False):
+        """
+        :param index: The facts generated so far, shared by every validator of a run.
+        :param include_commonsense: Also check the commonsense facts (they repeat general rules more legitimately).
+        """
+        self.index = index
+        self.include_commonsense = include_commonsense
+        # The last check per thread, retry_prompt follows validate on the same thread with the same arguments.
+        self.memo = threading.local()
+
+    def duplicates(self, explicit_facts: List[str], commonsense_facts: List[str]) -> List[Tuple[str, str, float]]:
+        """(new fact, the fact it duplicates, similarity) for every near-duplicate fact."""
+        facts = tuple(explicit_facts) + (tuple(commonsense_facts) if self.include_commonsense else ())
+        memo = getattr(self.memo, 'last', None)
+        if memo is not None and memo[0] == (facts, len(self.index)):
+            return memo[1]
+
+        found = []
+        # The few facts of one deduction are compared with each other directly.
+        earlier: List[Tuple[str, FrozenSet[int]]] = []
+        for fact in facts:
+            shingles = self.index.shingles(fact)
+            match = self.index.query(fact, shingles)
+            if match is None:
+                similar = [(other, FactIndex.jaccard(shingles, s)) for other, s in earlier]
+                similar = [x for x in similar if x[1] >= self.index.threshold]
+                match = max(similar, key=lambda x: x[1]) if similar else None
+            if match is not None:
+                found.append((fact, match[0], match[1]))
+            earlier.append((fact, shingles))
+
+        self.memo.last = ((facts, len(self.index)), found)
+        return found
+
+    def validate(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str],
+            raw_output: str,
+            *args,
+            **kwargs
+    ) -> bool:
+        return not self.duplicates(explicit_facts, commonsense_facts)
+
+    def validate_partial(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str],
+            raw_output: str,
+            *args,
+            **kwargs
+    ) -> bool:
+        # Finished facts don't change, a duplicate among them already fails the whole deduction.
+        return self.validate(template, explicit_facts, commonsense_facts, raw_output, *args, **kwargs)
+
+    def retry_prompt(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str],
+            raw_output: str,
+            *args,
+            **kwargs
+    ) -> str:
+        duplicates_str = '\n'.join(
+            f'- "{fact}" repeats "{existing}"' for fact, existing, _ in self.duplicates(explicit_facts, commonsense_facts)
+        )
+        return f'''
+
+Your old output:
+
+{raw_output}
+
+Some of the facts in your output (nearly) repeat a fact that was already written.  Regenerate this deduction with facts that add new information:
+
+{duplicates_str}
+        '''.strip()
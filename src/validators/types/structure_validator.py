@@ -10,6 +10,8 @@ class StructureValidator(Validator):
     lengths of the ones generated.
     """
 
+    cost_rank = 0
+
     def validate(
             self,
             template: LogicNode,
@@ -27,6 +29,24 @@ class StructureValidator(Validator):
                 x for x in template.children if x.fact_type == LogicNodeFactType.COMMONSENSE
             ])
 
+    def validate_partial(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str],
+            raw_output: str,
+            *args,
+            **kwargs
+    ) -> bool:
+        # More facts of one type than the template asks for can never be fixed by waiting for more output.
+        return \
+            len(explicit_facts) <= len([
+                x for x in template.children if x.fact_type == LogicNodeFactType.EXPLICIT
+            ]) and \
+            len(commonsense_facts) <= len([
+                x for x in template.children if x.fact_type == LogicNodeFactType.COMMONSENSE
+            ])
+
     def retry_prompt(
             self,
             template: LogicNode,
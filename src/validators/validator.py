@@ -4,6 +4,13 @@ from src.logic_tree.tree import LogicNode
 
 
 class Validator:
+    # Relative cost of a validate call, ValidatorPipeline runs lower ranks first (0 = counting, 1 = text scans,
+    # EXPENSIVE_COST_RANK and up = model calls, which may run concurrently).
+    cost_rank: int = 1
+    EXPENSIVE_COST_RANK = 10
+    # Whether the result is a pure function of (node, facts, output), so ValidatorPipeline may reuse it.  False for
+    # validators that depend on state that changes during a run.
+    memoizable: bool = True
 
     def retry_prompt(
             self,
@@ -46,6 +53,27 @@ class Validator:
         """
         raise NotImplemented("Implement a validate function for every validator")
 
+    def validate_partial(
+            self,
+            template: LogicNode,
+            explicit_facts: List[str],
+            commonsense_facts: List[str],
+            raw_output: str,
+            *args,
+            **kwargs
+    ) -> bool:
+        """
+        Called while a completion is still streaming in.  Only return False when the partial output can already never
+        become valid (so the request can be cancelled early).  By default we can't tell, so everything is valid.
+
+        :param template: Node we are trying to fill in
+        :param explicit_facts: The explicit facts that have been generated so far.
+        :param commonsense_facts: The commonsense facts that have been generated so far.
+        :param raw_output: The raw output from the LLM so far (unparsed)
+        :return: False if the partial output is already invalid (should cancel and retry)
+        """
+        return True
+
     def __call__(
             self,
             template: LogicNode,
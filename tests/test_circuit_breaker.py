@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from src.model.circuit_breaker import CircuitBreaker, CircuitOpenError, ModelAPIError
+from src.model.openai import OpenAIModel
+
+
+class BadRequestError(Exception):
+    status_code = 400
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+class FakeClient:
+    """Stands in for the openai client, chat.completions.create raises the next queued error."""
+
+    def __init__(self):
+        self.errors = []
+        self.calls = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, **kwargs):
+        self.calls += 1
+        raise self.errors.pop(0)
+
+
+def make_model(engine: str) -> OpenAIModel:
+    model = OpenAIModel(
+        engine,
+        api_max_attempts=1,
+        circuit_failure_threshold=2,
+        circuit_reset_timeout=0.05
+    )
+    model.client = FakeClient()
+    return model
+
+
+def test_permanent_error_on_half_open_probe_closes_the_circuit():
+    model = make_model('test-permanent-probe')
+    breaker = model.circuit_breaker
+
+    model.client.errors = [APIConnectionError('connection reset'), APIConnectionError('connection reset')]
+    for _ in range(2):
+        with pytest.raises(ModelAPIError):
+            model.__safe_openai_chat_call__('hi')
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        model.__safe_openai_chat_call__('hi')
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    # The probe is rejected for the request itself: the server answered, so the circuit closes.
+    model.client.errors = [BadRequestError('maximum context length exceeded')]
+    with pytest.raises(ModelAPIError) as raised:
+        model.__safe_openai_chat_call__('hi')
+    assert not isinstance(raised.value, CircuitOpenError)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    # Later calls reach the api again.
+    calls = model.client.calls
+    model.client.errors = [BadRequestError('maximum context length exceeded')]
+    with pytest.raises(ModelAPIError) as raised:
+        model.__safe_openai_chat_call__('hi')
+    assert not isinstance(raised.value, CircuitOpenError)
+    assert model.client.calls == calls + 1
+
+
+def test_interrupted_probe_is_released():
+    breaker = CircuitBreaker('test-release-probe', failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.before_call() is True
+    breaker.release_probe()
+    assert breaker.before_call() is True